@@ -0,0 +1,193 @@
+import struct
+import warnings
+
+import numpy as np
+
+from audio_protocol import CODEC_ADPCM, CODEC_OPUS, CODEC_PCM16, ProtocolError
+
+try:
+    import opuslib
+except Exception:  # missing module or missing native libopus
+    opuslib = None
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        import audioop
+except ImportError:
+    audioop = None
+
+ADPCM_STATE = struct.Struct('!hBx')
+
+ADPCM_INDEX_TABLE = (-1, -1, -1, -1, 2, 4, 6, 8, -1, -1, -1, -1, 2, 4, 6, 8)
+ADPCM_STEP_TABLE = (
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767,
+)
+
+
+def _clamp(value, low, high):
+    return low if value < low else high if value > high else value
+
+
+def adpcm_encode(pcm, valpred, index):
+    # IMA/DVI ADPCM, first sample in the high nibble (same layout as audioop)
+    samples = np.frombuffer(pcm, dtype=np.int16).tolist()
+    deltas = []
+    for sample in samples:
+        step = ADPCM_STEP_TABLE[index]
+        diff = sample - valpred
+        sign = 8 if diff < 0 else 0
+        if sign:
+            diff = -diff
+        delta = 0
+        vpdiff = step >> 3
+        if diff >= step:
+            delta = 4
+            diff -= step
+            vpdiff += step
+        step >>= 1
+        if diff >= step:
+            delta |= 2
+            diff -= step
+            vpdiff += step
+        step >>= 1
+        if diff >= step:
+            delta |= 1
+            vpdiff += step
+        valpred = _clamp(valpred - vpdiff if sign else valpred + vpdiff, -32768, 32767)
+        delta |= sign
+        index = _clamp(index + ADPCM_INDEX_TABLE[delta], 0, 88)
+        deltas.append(delta)
+    nibbles = np.array(deltas, dtype=np.uint8)
+    packed = (nibbles[0::2] << 4) | nibbles[1::2]
+    return packed.tobytes(), (valpred, index)
+
+
+def adpcm_decode(data, valpred, index):
+    packed = np.frombuffer(data, dtype=np.uint8)
+    nibbles = np.empty(len(packed) * 2, dtype=np.uint8)
+    nibbles[0::2] = packed >> 4
+    nibbles[1::2] = packed & 0x0F
+    samples = []
+    for delta in nibbles.tolist():
+        step = ADPCM_STEP_TABLE[index]
+        index = _clamp(index + ADPCM_INDEX_TABLE[delta], 0, 88)
+        vpdiff = step >> 3
+        if delta & 4:
+            vpdiff += step
+        if delta & 2:
+            vpdiff += step >> 1
+        if delta & 1:
+            vpdiff += step >> 2
+        valpred = _clamp(valpred - vpdiff if delta & 8 else valpred + vpdiff, -32768, 32767)
+        samples.append(valpred)
+    return np.array(samples, dtype=np.int16).tobytes()
+
+
+class PcmCodec:
+    name = 'pcm16'
+    codec_id = CODEC_PCM16
+
+    def __init__(self, rate, chunk):
+        self.rate = rate
+        self.chunk = chunk
+
+    @staticmethod
+    def supports(rate, chunk):
+        return True
+
+    def encode(self, pcm):
+        return bytes(pcm)
+
+    def decode(self, payload):
+        return bytes(payload)
+
+
+class AdpcmCodec:
+    # 4:1 IMA-ADPCM. Each frame carries the predictor state it was encoded from, so
+    # frames decode independently and a lost packet never corrupts the next one.
+    name = 'adpcm'
+    codec_id = CODEC_ADPCM
+
+    def __init__(self, rate, chunk):
+        self.rate = rate
+        self.chunk = chunk
+        self.state = (0, 0)
+
+    @staticmethod
+    def supports(rate, chunk):
+        return chunk % 2 == 0
+
+    def encode(self, pcm):
+        valpred, index = self.state
+        if audioop:
+            data, self.state = audioop.lin2adpcm(bytes(pcm), 2, self.state)
+        else:
+            data, self.state = adpcm_encode(pcm, valpred, index)
+        return ADPCM_STATE.pack(valpred, index) + data
+
+    def decode(self, payload):
+        if len(payload) < ADPCM_STATE.size:
+            raise ProtocolError("truncated ADPCM frame")
+        valpred, index = ADPCM_STATE.unpack_from(payload)
+        if index > 88:
+            raise ProtocolError(f"invalid ADPCM step index {index}")
+        data = bytes(payload[ADPCM_STATE.size:])
+        if audioop:
+            return audioop.adpcm2lin(data, 2, (valpred, index))[0]
+        return adpcm_decode(data, valpred, index)
+
+
+class OpusCodec:
+    name = 'opus'
+    codec_id = CODEC_OPUS
+    RATES = (8000, 12000, 16000, 24000, 48000)
+    FRAME_UNITS = (1, 2, 4, 8, 16, 24)  # 2.5 ms units: 2.5, 5, 10, 20, 40, 60 ms
+
+    def __init__(self, rate, chunk):
+        self.rate = rate
+        self.chunk = chunk
+        self.encoder = opuslib.Encoder(rate, 1, opuslib.APPLICATION_VOIP)
+        self.decoder = opuslib.Decoder(rate, 1)
+
+    @classmethod
+    def supports(cls, rate, chunk):
+        if opuslib is None or rate not in cls.RATES:
+            return False
+        return chunk * 400 % rate == 0 and chunk * 400 // rate in cls.FRAME_UNITS
+
+    def encode(self, pcm):
+        return self.encoder.encode(bytes(pcm), self.chunk)
+
+    def decode(self, payload):
+        try:
+            return self.decoder.decode(bytes(payload), self.chunk)
+        except opuslib.OpusError as e:
+            raise ProtocolError(f"undecodable Opus frame: {e}") from None
+
+
+# Most preferred first
+CODECS = {codec.name: codec for codec in (OpusCodec, AdpcmCodec, PcmCodec)}
+
+
+def available_codecs(rate, chunk):
+    return [name for name, codec in CODECS.items() if codec.supports(rate, chunk)]
+
+
+def negotiate_codec(offered, rate, chunk):
+    # The first codec in the client's preference list that we can run wins
+    available = available_codecs(rate, chunk)
+    for name in offered:
+        if name in available:
+            return name
+    return PcmCodec.name
+
+
+def create_codec(name, rate, chunk):
+    return CODECS[name](rate, chunk)
@@ -0,0 +1,29 @@
+CHANNELS = 1
+SAMPLE_WIDTH = 2  # paInt16
+SUPPORTED_RATES = (8000, 11025, 16000, 22050, 24000, 32000, 44100, 48000)
+MIN_FRAME_MS = 2.5
+MAX_FRAME_MS = 120
+
+# Speech defaults: 16 kHz with 20 ms frames
+RATE = 16000
+FRAME_MS = 20
+CHUNK = RATE * FRAME_MS // 1000
+
+
+def frame_samples(rate, frame_ms):
+    return int(rate * frame_ms / 1000)
+
+
+def validate_audio_params(rate, chunk, max_payload):
+    # Returns None when the rate/frame size pair is usable, otherwise the reason it is not
+    # Both come straight from a client's hello, so bools and floats are refused here
+    if type(rate) is not int or type(chunk) is not int:
+        return "sample rate and frame size must be integers"
+    if rate not in SUPPORTED_RATES:
+        return f"unsupported sample rate {rate}"
+    frame_ms = chunk * 1000 / rate
+    if not MIN_FRAME_MS <= frame_ms <= MAX_FRAME_MS:
+        return f"frame of {chunk} samples is {frame_ms:.1f} ms, outside {MIN_FRAME_MS}-{MAX_FRAME_MS} ms"
+    if chunk * SAMPLE_WIDTH * CHANNELS > max_payload:
+        return f"frame of {chunk} samples does not fit in a packet"
+    return None
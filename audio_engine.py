@@ -0,0 +1,196 @@
+import threading
+import time
+
+import pyaudio
+
+from audio_config import CHANNELS, SAMPLE_WIDTH
+from metrics import Histogram
+
+FORMAT = pyaudio.paInt16
+PERIOD_MS = 10  # device buffer; a frame is delivered in several of these
+CAPTURE_FRAMES = 4
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.03, 0.05, 0.1)
+
+
+class FrameRing:
+    # Preallocated frame slots passed from one producer thread to one consumer thread.
+    # The producer fills a slot in place and publishes it; the consumer gets a read-only
+    # view of the slot and releases it when done, so frames are never copied into new
+    # objects. Consumers may hold several frames (the VAD looks ahead); the producer
+    # only ever writes slots that have been released, and drops frames when none are.
+    def __init__(self, frames, frame_bytes):
+        self.frames = frames
+        self.buffer = bytearray(frames * frame_bytes)
+        view = memoryview(self.buffer)
+        self.slots = [view[index * frame_bytes:(index + 1) * frame_bytes] for index in range(frames)]
+        self.views = [slot.toreadonly() for slot in self.slots]
+        self.stamps = [0.0] * frames
+        self.ready = threading.Condition()
+        # Each counter is only advanced by one side
+        self.written = 0
+        self.read = 0
+        self.released = 0
+        self.overruns = 0
+
+    def writable(self):
+        # The slot to fill next, or None while the consumer holds every slot
+        if self.written - self.released >= self.frames:
+            return None
+        return self.slots[self.written % self.frames]
+
+    def publish(self):
+        self.stamps[self.written % self.frames] = time.perf_counter()
+        with self.ready:
+            self.written += 1
+            self.ready.notify()
+
+    def acquire(self, timeout=None):
+        # Returns (view, seconds the frame waited), or (None, 0.0) on timeout
+        with self.ready:
+            if self.read == self.written and not self.ready.wait_for(lambda: self.read < self.written, timeout):
+                return None, 0.0
+        index = self.read % self.frames
+        self.read += 1
+        return self.views[index], time.perf_counter() - self.stamps[index]
+
+    def release(self, count=1):
+        self.released = min(self.released + count, self.read)
+
+    def clear(self):
+        # Consumer side: drop everything published but not yet taken
+        with self.ready:
+            self.read = self.released = self.written
+
+
+class AudioEngine:
+    # Microphone and speaker in PyAudio callback mode. PortAudio calls us once per
+    # device period: capture copies each period into the current ring slot and
+    # publishes it once the slot holds a full frame; playback pulls one frame from
+    # `source` (the jitter buffer) per frame and hands PortAudio period-sized slices of
+    # it. Capture never allocates audio buffers per frame, and the device
+    # period can be shorter than a network frame to cut device latency.
+    def __init__(self, audio, rate, chunk, period_ms=PERIOD_MS, capture_frames=CAPTURE_FRAMES):
+        self.audio = audio
+        self.rate = rate
+        self.chunk = chunk
+        self.frame_bytes = chunk * SAMPLE_WIDTH * CHANNELS
+        period = min(chunk, max(1, int(rate * period_ms / 1000)))
+        # Periods tile frames exactly, so a frame never straddles two slots
+        while chunk % period:
+            period -= 1
+        self.period = period
+        self.capture = FrameRing(capture_frames, self.frame_bytes)
+        self.fill = 0
+        self.frame_adc_time = 0.0
+        self.input_stream = None
+        self.output_stream = None
+        self.source = None
+        # PyAudio only takes bytes back from a callback (memoryviews make it abort the
+        # stream), so playback hands out the jitter buffer's frames or slices of them
+        self.silence = bytes(self.frame_bytes)
+        self.playing = self.silence
+        self.play_offset = self.frame_bytes
+        # capture: first sample hitting the ADC to its frame being complete;
+        # queue: a complete frame waiting for the network thread;
+        # playback: a frame leaving the jitter buffer to reaching the DAC
+        self.latency = {name: Histogram(LATENCY_BUCKETS) for name in ('capture', 'queue', 'playback')}
+        self.reported = {}
+        self.input_overflows = 0
+        self.output_underflows = 0
+
+    def start_capture(self):
+        self.capture.clear()
+        self.fill = 0
+        self.input_stream = self.audio.open(format=FORMAT, channels=CHANNELS, rate=self.rate, input=True,
+                                            frames_per_buffer=self.period, stream_callback=self._on_capture)
+
+    def stop_capture(self):
+        if self.input_stream:
+            self.input_stream.stop_stream()
+            self.input_stream.close()
+            self.input_stream = None
+
+    def start_playback(self, source):
+        self.source = source
+        self.playing = self.silence
+        self.play_offset = self.frame_bytes
+        self.output_stream = self.audio.open(format=FORMAT, channels=CHANNELS, rate=self.rate, output=True,
+                                             frames_per_buffer=self.period, stream_callback=self._on_playback)
+
+    def stop_playback(self):
+        if self.output_stream:
+            self.output_stream.stop_stream()
+            self.output_stream.close()
+            self.output_stream = None
+        self.source = None
+
+    def read_frame(self, timeout=None):
+        # Network thread: the next captured frame as a read-only view, or None on
+        # timeout. The view stays valid until release_frame() is called for it.
+        view, waited = self.capture.acquire(timeout)
+        if view is not None:
+            self.latency['queue'].observe(waited)
+        return view
+
+    def release_frame(self, count=1):
+        self.capture.release(count)
+
+    def stats(self):
+        # Mean latencies in ms since the previous call, plus device glitch counts
+        result = {}
+        for name, histogram in self.latency.items():
+            last_sum, last_count = self.reported.get(name, (0.0, 0))
+            total, count = histogram.sum, histogram.count
+            result[f'{name}_ms'] = (total - last_sum) / (count - last_count) * 1000 if count > last_count else 0.0
+            self.reported[name] = (total, count)
+        result['dropped_frames'] = self.capture.overruns
+        result['input_overflows'] = self.input_overflows
+        result['output_underflows'] = self.output_underflows
+        return result
+
+    def _on_capture(self, in_data, frame_count, time_info, status):
+        if status & pyaudio.paInputOverflow:
+            self.input_overflows += 1
+        ring = self.capture
+        data = memoryview(in_data)
+        while data:
+            slot = ring.writable()
+            if slot is None:
+                # The network thread is behind; losing this frame beats delaying the rest
+                ring.overruns += 1
+                self.fill = 0
+                break
+            if self.fill == 0:
+                self.frame_adc_time = time_info['input_buffer_adc_time']
+            size = min(len(data), self.frame_bytes - self.fill)
+            slot[self.fill:self.fill + size] = data[:size]
+            self.fill += size
+            data = data[size:]
+            if self.fill == self.frame_bytes:
+                self.fill = 0
+                if self.frame_adc_time > 0:  # not every host API reports stream times
+                    self.latency['capture'].observe(time_info['current_time'] - self.frame_adc_time)
+                ring.publish()
+        return None, pyaudio.paContinue
+
+    def _on_playback(self, in_data, frame_count, time_info, status):
+        if status & pyaudio.paOutputUnderflow:
+            self.output_underflows += 1
+        if self.play_offset >= self.frame_bytes:
+            frame = self.source() if self.source else None
+            # A frame of the wrong size (a decoder hiccup) is played as silence
+            if frame is not None and len(frame) == self.frame_bytes:
+                self.playing = bytes(frame)
+            else:
+                self.playing = self.silence
+            self.play_offset = 0
+            dac_time = time_info['output_buffer_dac_time']
+            if dac_time > 0:
+                self.latency['playback'].observe(dac_time - time_info['current_time'])
+        size = frame_count * SAMPLE_WIDTH * CHANNELS
+        if self.play_offset == 0 and size == self.frame_bytes:
+            data = self.playing  # the period is a whole frame: no slice needed
+        else:
+            data = self.playing[self.play_offset:self.play_offset + size]
+        self.play_offset += size
+        return data, pyaudio.paContinue
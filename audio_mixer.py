@@ -0,0 +1,217 @@
+import collections
+import heapq
+import threading
+
+import numpy as np
+
+INT16_MIN = -32768
+INT16_MAX = 32767
+LEVEL_SMOOTHING = 0.3
+# A newcomer has to be this much louder (in power) than a selected speaker to replace them
+SPEAKER_SWITCH_RATIO = 2.0
+LEVEL_FLOOR = 254  # quietest level byte; 255 means the sender did not measure
+
+
+class LossConcealer:
+    # Covers short gaps by repeating the last good frame with a fade to silence
+    def __init__(self, max_frames=3):
+        self.max_frames = max_frames
+        self.last = None
+        self.missing = 0
+
+    def update(self, frame):
+        self.last = frame
+        self.missing = 0
+
+    def conceal(self):
+        if self.last is None or self.missing >= self.max_frames:
+            return None
+        start = 1.0 - self.missing / self.max_frames
+        self.missing += 1
+        end = 1.0 - self.missing / self.max_frames
+        samples = np.frombuffer(self.last, dtype=np.int16)
+        ramp = np.linspace(start, end, len(samples), dtype=np.float32)
+        return (samples * ramp).astype(np.int16).tobytes()
+
+    def skip(self):
+        # Counts a gap without producing audio; False once concealment would have run out
+        if self.last is None or self.missing >= self.max_frames:
+            return False
+        self.missing += 1
+        return True
+
+
+def frame_power(frame):
+    samples = np.frombuffer(frame, dtype=np.int16).astype(np.float32)
+    return float(np.dot(samples, samples)) / len(samples) if len(samples) else 0.0
+
+
+def frame_level(frame):
+    # The frame's power as the level byte of the frame header: dB below full scale
+    power = frame_power(frame)
+    if power <= 0:
+        return LEVEL_FLOOR
+    return int(min(LEVEL_FLOOR, max(0, round(-10 * np.log10(power / 32768 ** 2)))))
+
+
+def level_power(level):
+    return 32768 ** 2 * 10 ** (-level / 10)
+
+
+class AudioMixer:
+    # With max_speakers set, only the loudest few active senders are mixed (selective
+    # mixing for big rooms): the per-tick mix costs O(max_speakers) however many people
+    # talk at once, and `speakers` lists who is currently audible. Frames queued with
+    # push_encoded() are ranked by the level their sender measured and only decoded if
+    # their sender is picked, so the unheard cost no decoding either.
+    def __init__(self, chunk, rate, jitter_frames=2, max_frames=8, max_speakers=None):
+        self.chunk = chunk
+        self.rate = rate
+        self.frame_bytes = chunk * 2  # mono int16
+        self.jitter_frames = jitter_frames
+        self.max_frames = max_frames
+        self.silence = bytes(self.frame_bytes)
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.pending = {}
+        self.concealers = {}
+        # Only senders with buffered speech are visited on each tick
+        self.active = set()
+        self.max_speakers = max_speakers
+        self.levels = {}
+        self.speakers = ()
+
+    @property
+    def tick_interval(self):
+        return self.chunk / self.rate
+
+    def add_client(self, key):
+        with self.lock:
+            self.queues[key] = collections.deque()
+            self.pending[key] = bytearray()
+            self.concealers[key] = LossConcealer()
+
+    def remove_client(self, key):
+        with self.lock:
+            self.queues.pop(key, None)
+            self.pending.pop(key, None)
+            self.concealers.pop(key, None)
+            self.levels.pop(key, None)
+            self.active.discard(key)
+
+    def push(self, key, data):
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is None:
+                return
+            pending += data
+            queue = self.queues[key]
+            usable = len(pending) - len(pending) % self.frame_bytes
+            for offset in range(0, usable, self.frame_bytes):
+                frame = bytes(pending[offset:offset + self.frame_bytes])
+                queue.append(frame)
+                if self.max_speakers:
+                    level = self.levels.get(key, 0.0)
+                    self.levels[key] = level + (frame_power(frame) - level) * LEVEL_SMOOTHING
+            del pending[:usable]
+            # Drop the oldest frames once a sender gets too far ahead of the clock
+            while len(queue) > self.max_frames:
+                queue.popleft()
+            if len(queue) >= self.jitter_frames:
+                self.active.add(key)
+
+    def push_encoded(self, key, payload, level, decode):
+        # One whole frame, still encoded: decode(payload) must give frame_bytes of PCM
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is None:
+                return
+            queue.append((payload, decode))
+            previous = self.levels.get(key, 0.0)
+            self.levels[key] = previous + (level_power(level) - previous) * LEVEL_SMOOTHING
+            while len(queue) > self.max_frames:
+                queue.popleft()
+            if len(queue) >= self.jitter_frames:
+                self.active.add(key)
+
+    def _decode(self, frame):
+        if type(frame) is not tuple:
+            return frame
+        payload, decode = frame
+        try:
+            pcm = decode(payload)
+        except ValueError:  # codec errors, e.g. a truncated ADPCM frame
+            return None
+        return pcm if len(pcm) == self.frame_bytes else None
+
+    def set_inactive(self, key):
+        # The sender went silent on purpose (DTX); flush it rather than conceal
+        with self.lock:
+            if key not in self.queues:
+                return
+            self.active.discard(key)
+            self.queues[key].clear()
+            self.pending[key].clear()
+            self.concealers[key].last = None
+            self.levels.pop(key, None)
+
+    def mix(self):
+        # Returns the full room mix plus one mix-minus-self frame per client
+        with self.lock:
+            keys = list(self.queues)
+            speakers = []
+            frames = []
+            candidates = list(self.active)
+            if self.max_speakers and len(candidates) > self.max_speakers:
+                candidates = self._select(candidates)
+            for key in candidates:
+                queue = self.queues[key]
+                concealer = self.concealers[key]
+                frame = self._decode(queue.popleft()) if queue else None
+                if frame is not None:
+                    concealer.update(frame)
+                else:
+                    # A sender that was skipped until now is only decoded once promoted
+                    concealer.last = self._decode(concealer.last)
+                    frame = concealer.conceal()
+                    if frame is None:
+                        self.active.discard(key)
+                        continue
+                speakers.append(key)
+                frames.append(frame)
+            if self.max_speakers:
+                self.speakers = tuple(speakers)
+        if not keys:
+            return None, {}
+        if not frames:
+            return self.silence, dict.fromkeys(keys, self.silence)
+        stacked = np.frombuffer(b''.join(frames), dtype=np.int16).reshape(len(frames), self.chunk).astype(np.int32)
+        total = stacked.sum(axis=0)
+        room_mix = np.clip(total, INT16_MIN, INT16_MAX).astype(np.int16).tobytes()
+        # Listeners share the full mix; only speakers need their own voice taken out
+        outputs = dict.fromkeys(keys, room_mix)
+        minus_self = np.clip(total - stacked, INT16_MIN, INT16_MAX).astype(np.int16)
+        for row, key in enumerate(speakers):
+            outputs[key] = minus_self[row].tobytes()
+        return room_mix, outputs
+
+    def _select(self, candidates):
+        # Keeps the max_speakers loudest senders, favouring those already selected so
+        # the set does not flap between similar voices. Everyone else's frames are
+        # consumed unmixed (and undecoded), keeping their queues current for when they
+        # are picked.
+        current = set(self.speakers)
+        def rank(key):
+            level = self.levels.get(key, 0.0)
+            return level * SPEAKER_SWITCH_RATIO if key in current else level
+        selected = heapq.nlargest(self.max_speakers, candidates, key=rank)
+        chosen = set(selected)
+        for key in candidates:
+            if key in chosen:
+                continue
+            queue = self.queues[key]
+            if queue:
+                self.concealers[key].update(queue.popleft())
+            elif not self.concealers[key].skip():
+                self.active.discard(key)
+        return selected
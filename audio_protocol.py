@@ -0,0 +1,161 @@
+import collections
+import json
+import struct
+import time
+
+# length, sender id, sequence number, capture timestamp (us), codec id, level
+HEADER = struct.Struct('!HIIQBB')
+MAX_PAYLOAD = 8192
+CODEC_PCM16 = 0
+CODEC_ADPCM = 1
+CODEC_OPUS = 2
+CODEC_DTX = 254  # sender is silent; one byte payload carries its noise floor in -dBFS
+CODEC_CONTROL = 255  # JSON handshake messages share the framing with audio
+# Audio frames carry the sender's level in -dBFS, so a relay mixing only the loudest
+# speakers can rank them without decoding anyone
+LEVEL_UNKNOWN = 255
+
+FrameHeader = collections.namedtuple('FrameHeader', 'length sender_id seq timestamp codec level')
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def now_us():
+    return time.time_ns() // 1000
+
+
+def pack_frame(payload, sender_id, seq, timestamp, codec=CODEC_PCM16, level=LEVEL_UNKNOWN):
+    return HEADER.pack(len(payload), sender_id, seq & 0xFFFFFFFF, timestamp, codec, level) + payload
+
+
+def encode_control(message):
+    return json.dumps(message, separators=(',', ':')).encode()
+
+
+def decode_control(payload):
+    try:
+        message = json.loads(bytes(payload))
+    except ValueError as e:
+        raise ProtocolError(f"malformed control frame: {e}") from None
+    if not isinstance(message, dict) or 'type' not in message:
+        raise ProtocolError("control frame without a message type")
+    return message
+
+
+def unpack_frame(data, nbytes=None):
+    # Datagram transports carry exactly one frame per packet
+    if nbytes is None:
+        nbytes = len(data)
+    if nbytes < HEADER.size:
+        raise ProtocolError(f"datagram of {nbytes} bytes is shorter than a frame header")
+    header = FrameHeader._make(HEADER.unpack_from(data, 0))
+    if HEADER.size + header.length != nbytes:
+        raise ProtocolError(f"datagram of {nbytes} bytes does not match its {header.length} byte payload")
+    return header, memoryview(data)[HEADER.size:nbytes]
+
+
+class FrameWriter:
+    # Packs outgoing frames into one preallocated buffer instead of allocating per frame
+    def __init__(self, sender_id=0, max_payload=MAX_PAYLOAD):
+        self.sender_id = sender_id
+        self.seq = 0
+        self.buffer = bytearray(HEADER.size + max_payload)
+        self.view = memoryview(self.buffer)
+
+    def pack(self, payload, timestamp=None, codec=CODEC_PCM16, level=LEVEL_UNKNOWN):
+        size = len(payload)
+        if size > len(self.buffer) - HEADER.size:
+            raise ProtocolError(f"payload of {size} bytes does not fit in a frame")
+        if timestamp is None:
+            timestamp = now_us()
+        HEADER.pack_into(self.buffer, 0, size, self.sender_id, self.seq, timestamp, codec, level)
+        self.buffer[HEADER.size:HEADER.size + size] = payload
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        return self.view[:HEADER.size + size]
+
+
+class FrameParser:
+    # Reassembles frames from a byte stream without copying: callers recv_into
+    # get_buffer() and report the byte count through buffer_updated(). The payload
+    # memoryview handed to on_frame is only valid for the duration of the call.
+    def __init__(self, on_frame, max_payload=MAX_PAYLOAD):
+        self.on_frame = on_frame
+        self.max_payload = max_payload
+        self.buffer = bytearray(2 * (HEADER.size + max_payload))
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.paused = False
+
+    def get_buffer(self, sizehint=-1):
+        if len(self.buffer) - self.end < HEADER.size + self.max_payload:
+            pending = self.end - self.start
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        while not self.paused and self.end - self.start >= HEADER.size:
+            header = FrameHeader._make(HEADER.unpack_from(self.buffer, self.start))
+            if header.length > self.max_payload:
+                raise ProtocolError(f"frame of {header.length} bytes exceeds {self.max_payload}")
+            frame_end = self.start + HEADER.size + header.length
+            if frame_end > self.end:
+                break
+            self.on_frame(header, self.view[self.start + HEADER.size:frame_end])
+            self.start = frame_end
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def feed(self, data):
+        data = memoryview(data)
+        while data:
+            buffer = self.get_buffer()
+            nbytes = min(len(buffer), len(data))
+            buffer[:nbytes] = data[:nbytes]
+            data = data[nbytes:]
+            self.buffer_updated(nbytes)
+
+    def pause(self):
+        # Stops parsing after the current frame, e.g. before handing the stream elsewhere
+        self.paused = True
+
+    def resume(self):
+        # Picks up where pause() left off, parsing whatever arrived meanwhile
+        self.paused = False
+        self.buffer_updated(0)
+
+    def remaining(self):
+        return bytes(self.buffer[self.start:self.end])
+
+    def feed_from(self, sock):
+        nbytes = sock.recv_into(self.get_buffer())
+        if nbytes:
+            self.buffer_updated(nbytes)
+        return nbytes
+
+
+class SequenceTracker:
+    def __init__(self):
+        self.expected = None
+        self.received = 0
+        self.lost = 0
+        self.late = 0
+
+    def update(self, seq):
+        # Returns the number of frames missing before seq, or -1 for a late/duplicate frame
+        self.received += 1
+        if self.expected is None:
+            self.expected = (seq + 1) & 0xFFFFFFFF
+            return 0
+        gap = (seq - self.expected) & 0xFFFFFFFF
+        if gap >= 0x80000000:
+            self.late += 1
+            return -1
+        self.lost += gap
+        self.expected = (seq + 1) & 0xFFFFFFFF
+        return gap
@@ -0,0 +1,159 @@
+import collections
+import threading
+
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+CHAT_CAPACITY = 2000
+FRAME_INTERVAL_MS = 16  # at most one model update per screen frame
+INCOMING_COLOR = '#67C23A'
+OUTGOING_COLOR = '#409EFF'
+
+
+class ChatLogModel(QtCore.QAbstractListModel):
+    # Chat lines in a bounded ring: once full, the oldest lines fall off the top, so
+    # memory and layout cost stay fixed however long the room has been talking. Each
+    # message is a dict with at least 'sender' and 'text'; 'outgoing' marks our own.
+    def __init__(self, capacity=CHAT_CAPACITY, show_room=False, incoming_color=INCOMING_COLOR,
+                 outgoing_color=OUTGOING_COLOR, parent=None):
+        super().__init__(parent)
+        self.capacity = capacity
+        self.show_room = show_room
+        self.messages = collections.deque()
+        self.colors = {False: QtGui.QColor(incoming_color), True: QtGui.QColor(outgoing_color)}
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.messages):
+            return None
+        message = self.messages[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            sender = message['sender']
+            if self.show_room and message.get('room'):
+                sender = f"{sender} ({message['room']})"
+            return f"{sender}: {message['text']}"
+        if role == QtCore.Qt.ForegroundRole:
+            return self.colors[message.get('outgoing', False)]
+        if role == QtCore.Qt.ToolTipRole and message.get('timestamp'):
+            return QtCore.QDateTime.fromMSecsSinceEpoch(message['timestamp']).toString()
+        return None
+
+    def is_full(self):
+        return len(self.messages) >= self.capacity
+
+    def oldest_id(self):
+        for message in self.messages:
+            if message.get('id') is not None:
+                return message['id']
+        return None
+
+    def clear(self):
+        self.beginResetModel()
+        self.messages.clear()
+        self.endResetModel()
+
+    def append_messages(self, messages):
+        if not messages:
+            return
+        messages = messages[-self.capacity:]
+        overflow = len(self.messages) + len(messages) - self.capacity
+        if overflow > 0:
+            self.beginRemoveRows(QtCore.QModelIndex(), 0, overflow - 1)
+            for _ in range(overflow):
+                self.messages.popleft()
+            self.endRemoveRows()
+        start = len(self.messages)
+        self.beginInsertRows(QtCore.QModelIndex(), start, start + len(messages) - 1)
+        self.messages.extend(messages)
+        self.endInsertRows()
+
+    def prepend_messages(self, messages):
+        # Older history only fills what is left of the ring; it never pushes out newer lines
+        room = self.capacity - len(self.messages)
+        messages = messages[-room:] if room > 0 else []
+        if not messages:
+            return 0
+        self.beginInsertRows(QtCore.QModelIndex(), 0, len(messages) - 1)
+        self.messages.extendleft(reversed(messages))
+        self.endInsertRows()
+        return len(messages)
+
+
+class ChatLogView(QtWidgets.QListView):
+    # Only the visible rows are painted and rows are laid out in batches, so a full
+    # ring never stalls the event loop. Scrolling to the top asks for older history.
+    history_wanted = QtCore.pyqtSignal()
+
+    def __init__(self, model, parent=None):
+        super().__init__(parent)
+        self.setModel(model)
+        self.setWordWrap(True)
+        self.setLayoutMode(QtWidgets.QListView.Batched)
+        self.setBatchSize(100)
+        self.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        self.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.follow = True
+        self.history_pending = False
+        scrollbar = self.verticalScrollBar()
+        scrollbar.valueChanged.connect(self._scrolled)
+        scrollbar.rangeChanged.connect(self._range_changed)
+
+    def _scrolled(self, value):
+        scrollbar = self.verticalScrollBar()
+        # Stick to the bottom only while the user is already there
+        self.follow = value >= scrollbar.maximum()
+        if value == scrollbar.minimum() and scrollbar.maximum() > 0 and not self.history_pending:
+            self.history_pending = True
+            self.history_wanted.emit()
+
+    def _range_changed(self, minimum, maximum):
+        if self.follow:
+            self.verticalScrollBar().setValue(maximum)
+
+    def history_loaded(self, count):
+        # Keep the line that was at the top in place instead of jumping to the oldest one
+        self.history_pending = False
+        if count:
+            self.scrollTo(self.model().index(count, 0), QtWidgets.QAbstractItemView.PositionAtTop)
+
+
+class ChatFeed(QtCore.QObject):
+    # Hands items from socket threads to the GUI thread. Threads post() whenever they
+    # like; the GUI thread gets them as one list per frame interval, so a burst of
+    # messages costs one model update rather than one per message.
+    ready = QtCore.pyqtSignal()
+
+    def __init__(self, deliver, interval_ms=FRAME_INTERVAL_MS, parent=None):
+        super().__init__(parent)
+        self.deliver = deliver
+        self.lock = threading.Lock()
+        self.pending = []
+        self.scheduled = False
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self._flush)
+        # Queued, so the timer is always started from the thread that owns it
+        self.ready.connect(self._schedule, QtCore.Qt.QueuedConnection)
+
+    def post(self, item):
+        with self.lock:
+            self.pending.append(item)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.ready.emit()
+
+    def _schedule(self):
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def _flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+            self.scheduled = False
+        if batch:
+            self.deliver(batch)
@@ -0,0 +1,88 @@
+import collections
+
+
+class ConnectionTable:
+    # Connections sit in numbered slots and a connection's id is its slot, so ids stay
+    # put while others join and leave. Freed slots are reused oldest first, which keeps a
+    # stale id from pointing at a brand new client for as long as possible. Slot 0 is
+    # never handed out: it is the relay's own sender id.
+    #
+    # Writers are the event loop only. Readers iterate snapshot(), an immutable tuple
+    # rebuilt lazily after a change, so fan-out loops and other threads (the Qt front-end)
+    # never see the table half-updated and need no lock.
+    #
+    # A slot can also be held empty for a client expected back (see sessions.py); it is
+    # not reused until it is claimed or released.
+    def __init__(self):
+        self.slots = [None]
+        self.free = collections.deque()
+        self.held = set()
+        self.count = 0
+        self.version = 0
+        self._snapshot = (0, ())
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __contains__(self, conn):
+        slot = conn.id
+        return 0 < slot < len(self.slots) and self.slots[slot] is conn
+
+    def get(self, slot):
+        if 0 < slot < len(self.slots):
+            return self.slots[slot]
+        return None
+
+    def add(self, conn):
+        if self.free:
+            slot = self.free.popleft()
+            self.slots[slot] = conn
+        else:
+            slot = len(self.slots)
+            self.slots.append(conn)
+        conn.id = slot
+        self.count += 1
+        self.version += 1
+        return slot
+
+    def remove(self, conn, hold=False):
+        if conn not in self:
+            return False
+        self.slots[conn.id] = None
+        if hold:
+            self.held.add(conn.id)
+        else:
+            self.free.append(conn.id)
+        self.count -= 1
+        self.version += 1
+        return True
+
+    def claim(self, conn, slot):
+        # Moves conn into a held slot, giving up the one it had
+        if slot not in self.held or conn not in self:
+            return False
+        self.held.remove(slot)
+        self.slots[conn.id] = None
+        self.free.append(conn.id)
+        self.slots[slot] = conn
+        conn.id = slot
+        self.version += 1
+        return True
+
+    def release(self, slot):
+        if slot in self.held:
+            self.held.remove(slot)
+            self.free.append(slot)
+
+    def snapshot(self):
+        # The cache is tagged with the version it was built from; a rebuild that raced a
+        # change is tagged with the older version and simply gets rebuilt next time
+        version = self.version
+        built, snapshot = self._snapshot
+        if built != version:
+            snapshot = tuple(conn for conn in self.slots if conn is not None)
+            self._snapshot = (version, snapshot)
+        return snapshot
@@ -0,0 +1,135 @@
+import queue
+import sqlite3
+import threading
+import time
+
+HISTORY_PATH = 'chat_history.sqlite3'
+# Keeps one backlog page well inside a text frame, whatever the message lengths
+MAX_PAGE_CHARS = 100000
+MAX_WRITE_BATCH = 256
+WRITE_ATTEMPTS = 3
+WRITE_RETRY = 1.0
+
+
+def connect(path):
+    db = sqlite3.connect(path, timeout=5.0)
+    db.execute("PRAGMA journal_mode=WAL")
+    # With WAL this only syncs at checkpoints; a crash can lose the last few messages
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+class HistoryStore:
+    # Append-only chat log in SQLite with write-ahead logging. Pages are read newest
+    # first through the (room, id) index, so a late joiner costs one short index range
+    # scan however long the log has grown.
+    #
+    # Ids are handed out on the caller's thread and the rows are written by a thread of
+    # their own, several messages per transaction, so appending never waits on the disk
+    # or on another relay worker holding the write lock. Pages include the messages
+    # still waiting to be written. Apart from that, use it from one thread only.
+    def __init__(self, path=HISTORY_PATH, worker=0, workers=1):
+        self.path = path
+        self.db = connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            room TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            text TEXT NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_by_room ON messages (room, id)")
+        self.db.commit()
+        # Workers sharing the file take turns through the ids: worker w only uses ids
+        # that are w modulo the worker count, above everything already stored
+        top = self.db.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+        self.step = workers
+        self.next_id = top + 1 + (worker - top - 1) % workers
+        self.lock = threading.Lock()
+        self.unwritten = []  # rows queued for the writer, oldest first
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write, name='history', daemon=True)
+        self.thread.start()
+
+    def append(self, room_id, sender, timestamp, text):
+        message_id = self.next_id
+        self.next_id += self.step
+        row = (message_id, room_id, sender, timestamp, text)
+        with self.lock:
+            self.unwritten.append(row)
+        self.queue.put(row)
+        return message_id
+
+    def page(self, room_id, before=None, limit=50):
+        # Returns up to limit messages older than the id `before` (newest when None),
+        # oldest first, plus whether there are more before them
+        with self.lock:
+            # Taken before the query: a row written meanwhile then shows up twice, not never
+            pending = [row for row in self.unwritten
+                       if row[1] == room_id and (before is None or row[0] < before)]
+        if before is None:
+            rows = self.db.execute("SELECT id, room, sender, timestamp, text FROM messages WHERE room = ? "
+                                   "ORDER BY id DESC LIMIT ?", (room_id, limit + 1)).fetchall()
+        else:
+            rows = self.db.execute("SELECT id, room, sender, timestamp, text FROM messages WHERE room = ? AND id < ? "
+                                   "ORDER BY id DESC LIMIT ?", (room_id, before, limit + 1)).fetchall()
+        if pending:
+            rows = sorted(dict((row[0], row) for row in rows + pending).values(), reverse=True)[:limit + 1]
+        more = len(rows) > limit
+        messages = []
+        chars = 0
+        for message_id, room, sender, timestamp, text in rows[:limit]:
+            chars += len(text)
+            if messages and chars > MAX_PAGE_CHARS:
+                more = True
+                break
+            messages.append({'id': message_id, 'room': room_id, 'sender': sender, 'timestamp': timestamp,
+                             'text': text})
+        messages.reverse()
+        return messages, more
+
+    def flush(self):
+        # Blocks until every appended message is written, then stops the writer; call it
+        # off the event loop
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def _write(self):
+        db = connect(self.path)
+        try:
+            while True:
+                row = self.queue.get()
+                if row is None:
+                    return
+                batch = [row]
+                while len(batch) < MAX_WRITE_BATCH:
+                    try:
+                        row = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if row is None:
+                        self.queue.put(None)  # stop once this batch is in
+                        break
+                    batch.append(row)
+                self._insert(db, batch)
+                with self.lock:
+                    del self.unwritten[:len(batch)]
+        finally:
+            db.close()
+
+    def _insert(self, db, batch):
+        for attempt in range(WRITE_ATTEMPTS):
+            try:
+                with db:
+                    db.executemany("INSERT INTO messages (id, room, sender, timestamp, text) VALUES (?, ?, ?, ?, ?)",
+                                   batch)
+                return
+            except sqlite3.OperationalError as e:
+                # Most likely another worker held the write lock past the timeout
+                print(f"Could not write chat history: {e}")
+                time.sleep(WRITE_RETRY)
+        print(f"Gave up writing {len(batch)} chat messages to {self.path}")
@@ -0,0 +1,110 @@
+import math
+import threading
+import time
+
+from audio_mixer import LossConcealer
+
+SEQ_MASK = 0xFFFFFFFF
+SEQ_HALF = 0x80000000
+
+
+class JitterBuffer:
+    # Playout buffer keyed by sequence number. The network thread put()s frames as they
+    # arrive and the playback thread get()s one per device period. The target depth
+    # follows the RFC 3550 inter-arrival jitter estimate.
+    def __init__(self, frame_duration, min_depth=2, max_depth=12, jitter_factor=4.0):
+        self.frame_duration = frame_duration
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.jitter_factor = jitter_factor
+        self.target_depth = min_depth
+        self.lock = threading.Lock()
+        self.frames = {}
+        self.next_seq = None
+        self.playing = False
+        self.jitter = 0.0
+        self.last_transit = None
+        self.concealer = LossConcealer()
+        self.played = 0
+        self.late = 0
+        self.lost = 0
+        self.dropped = 0
+
+    @property
+    def depth(self):
+        return len(self.frames)
+
+    def put(self, seq, timestamp_us, payload):
+        transit = time.monotonic() - timestamp_us / 1e6
+        with self.lock:
+            if self.last_transit is not None:
+                self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+            self.last_transit = transit
+            if self.next_seq is None:
+                self.next_seq = seq
+            elif (seq - self.next_seq) & SEQ_MASK >= SEQ_HALF:
+                self.late += 1
+                return
+            self.frames[seq] = payload
+            while len(self.frames) > self.max_depth:
+                self._skip()
+
+    def get(self):
+        # Returns the next frame to play, or None when the caller should play silence
+        with self.lock:
+            if not self.playing:
+                if len(self.frames) < self.target_depth:
+                    return None
+                self.playing = True
+                # Resume from the oldest frame we hold: what went missing while we
+                # were rebuffering is gone, not waiting to be played
+                self.next_seq = min(self.frames, key=lambda seq: (seq - self.next_seq) & SEQ_MASK)
+            frame = self.frames.pop(self.next_seq, None)
+            self.next_seq = (self.next_seq + 1) & SEQ_MASK
+            if frame is None:
+                self.lost += 1
+                if not self.frames:
+                    # Starved: rebuffer up to the target depth before playing again
+                    self.playing = False
+                frame = self.concealer.conceal()
+            else:
+                self.played += 1
+                self.concealer.update(frame)
+            self._adapt()
+            return frame
+
+    def resync(self):
+        # The sender restarted its sequence numbers (a reconnect): forget the old
+        # numbering and rebuffer from the next frame that arrives
+        with self.lock:
+            self.frames.clear()
+            self.next_seq = None
+            self.playing = False
+            self.last_transit = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                'depth': len(self.frames),
+                'target_depth': self.target_depth,
+                'jitter_ms': self.jitter * 1000,
+                'played': self.played,
+                'late': self.late,
+                'lost': self.lost,
+                'dropped': self.dropped,
+            }
+
+    def _skip(self):
+        if self.frames.pop(self.next_seq, None) is None:
+            self.lost += 1
+        else:
+            self.dropped += 1
+        self.next_seq = (self.next_seq + 1) & SEQ_MASK
+
+    def _adapt(self):
+        wanted = math.ceil(self.jitter_factor * self.jitter / self.frame_duration) + 1
+        self.target_depth = max(self.min_depth, min(self.max_depth, wanted))
+        # Latency has built up past what the jitter calls for: drop one frame per
+        # period to catch up gradually rather than jumping
+        if len(self.frames) > self.target_depth + 2:
+            self._skip()
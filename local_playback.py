@@ -0,0 +1,54 @@
+import queue
+import threading
+
+from audio_config import CHANNELS
+
+
+class MixPlayback:
+    # Optional monitor that plays the room mix on the relay machine's speakers.
+    # PyAudio is only imported here, so headless relays never need a sound card.
+    def __init__(self, rate, chunk, max_frames=8):
+        self.rate = rate
+        self.chunk = chunk
+        self.frames = queue.Queue(maxsize=max_frames)
+        self.audio = None
+        self.stream = None
+        self.thread = None
+        self.is_running = False
+
+    def start(self):
+        import pyaudio
+        self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(format=pyaudio.paInt16, channels=CHANNELS, rate=self.rate, output=True,
+                                      frames_per_buffer=self.chunk)
+        self.is_running = True
+        self.thread = threading.Thread(target=self._play, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.is_running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.stream:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+        if self.audio:
+            self.audio.terminate()
+            self.audio = None
+
+    def queue_frame(self, frame):
+        # Called on the relay loop; never block it on the sound card
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:
+            pass
+
+    def _play(self):
+        while self.is_running:
+            try:
+                frame = self.frames.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.stream.write(frame)
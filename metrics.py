@@ -0,0 +1,221 @@
+import asyncio
+import bisect
+import collections
+import sys
+import time
+import urllib.parse
+
+METRICS_HOST = '127.0.0.1'
+# Mixer ticks are 20 ms by default, so anything past ~10 ms is eating into the budget
+TICK_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05)
+BLOCK_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+PROFILE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 60.0
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _bound(value):
+    return '+Inf' if value == float('inf') else repr(value)
+
+
+class Exposition:
+    # Builds the Prometheus text format, one metric family at a time
+    def __init__(self, prefix='synconnect_'):
+        self.prefix = prefix
+        self.lines = []
+
+    def add(self, name, kind, help_text, samples):
+        name = self.prefix + name
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            self.lines.append(f"{name}{_labels(labels)} {value}")
+
+    def histogram(self, name, help_text, series):
+        name = self.prefix + name
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in series:
+            for bound, count in histogram.cumulative():
+                self.lines.append(f"{name}_bucket{_labels(dict(labels, le=_bound(bound)))} {count}")
+            self.lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+            self.lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def render_relay(relay):
+    out = Exposition()
+    voice = relay.voice_connections.snapshot()
+    text = relay.text_connections.snapshot()
+    connections = [(conn, 'voice') for conn in voice] + [(conn, 'text') for conn in text]
+
+    def labels(conn, kind):
+        return {'conn': conn.id, 'kind': kind, 'room': conn.room.id if conn.room else ''}
+
+    def per_connection(value):
+        return [(labels(conn, kind), value(conn)) for conn, kind in connections]
+
+    out.add('connections', 'gauge', "Open client connections",
+            [({'kind': 'voice'}, len(voice)), ({'kind': 'text'}, len(text))])
+    out.add('connections_opened_total', 'counter', "Client connections accepted", [({}, relay.connections_opened)])
+    out.add('protocol_errors_total', 'counter', "Malformed frames or handshakes", [({}, relay.protocol_errors)])
+    out.add('text_messages_total', 'counter', "Text chat messages received", [({}, relay.text_messages)])
+    out.add('frames_received_total', 'counter', "Frames (voice) or messages (text) received from a client",
+            per_connection(lambda conn: conn.frames_received))
+    out.add('bytes_received_total', 'counter', "Bytes received from a client",
+            per_connection(lambda conn: conn.bytes_received))
+    out.add('frames_sent_total', 'counter', "Frames or messages written to a client",
+            per_connection(lambda conn: conn.frames_sent))
+    out.add('bytes_sent_total', 'counter', "Bytes written to a client",
+            per_connection(lambda conn: conn.bytes_sent))
+    out.add('frames_dropped_total', 'counter', "Outbound frames dropped because the client fell behind",
+            per_connection(lambda conn: conn.outbound.dropped))
+    out.add('send_queue_depth', 'gauge', "Frames waiting in the outbound queue",
+            per_connection(lambda conn: len(conn.outbound)))
+    out.add('send_blocked_seconds_total', 'counter', "Time spent waiting for a client's socket to drain",
+            per_connection(lambda conn: conn.send_blocked))
+    out.add('frames_lost_total', 'counter', "Gaps in a voice client's sequence numbers",
+            [(labels(conn, 'voice'), conn.rx_seq.lost) for conn in voice])
+    out.histogram('send_block_seconds', "Wait per drain of a client's socket", [({}, relay.block_time)])
+
+    rooms = list(relay.rooms.rooms.values())
+    out.add('room_members', 'gauge', "Members per room",
+            [({'room': room.id, 'kind': 'voice'}, len(room.voice_members)) for room in rooms] +
+            [({'room': room.id, 'kind': 'text'}, len(room.text_members)) for room in rooms])
+    out.add('room_active_speakers', 'gauge', "Senders with buffered audio in the room's mixer",
+            [({'room': room.id}, len(room.mixer.active)) for room in rooms])
+    out.histogram('room_mix_seconds', "Time to mix and fan out one room per tick",
+                  [({'room': room.id}, room.mix_time) for room in rooms])
+    out.histogram('tick_seconds', "Time to run one mixer tick over all rooms", [({}, relay.tick_time)])
+    out.add('ticks_overrun_total', 'counter', "Mixer ticks that started more than a frame late",
+            [({}, relay.ticks_overrun)])
+    if relay.recorder:
+        out.add('records_written_total', 'counter', "Frames and messages handed to the recorder",
+                [({}, relay.recorder.recorded)])
+        out.add('records_dropped_total', 'counter', "Frames and messages dropped because the recorder fell behind",
+                [({}, relay.recorder.dropped)])
+    return out.render()
+
+
+class SamplingProfiler:
+    # Samples one thread's Python stack from a helper thread and counts collapsed
+    # stacks (the input format of flamegraph.pl / speedscope). Nothing is sampled
+    # unless a profile is requested, so it costs nothing when idle.
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.running = False
+
+    def sample(self, seconds):
+        stacks = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return stacks
+
+    async def profile(self, seconds):
+        # One profile at a time; the sampler runs off the loop it is watching
+        if self.running:
+            return None
+        self.running = True
+        try:
+            stacks = await asyncio.get_running_loop().run_in_executor(None, self.sample, seconds)
+        finally:
+            self.running = False
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class MetricsServer:
+    # Minimal HTTP/1.0 server for scrapers: GET /metrics and, when profiling is enabled,
+    # GET /profile?seconds=N
+    def __init__(self, relay, host=METRICS_HOST, port=9100, profiler=None):
+        self.relay = relay
+        self.host = host
+        self.port = port
+        self.profiler = profiler
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()).strip():
+                pass  # headers are not needed
+            if len(request) < 2 or request[0] != 'GET':
+                await self._respond(writer, 405, "method not allowed\n")
+                return
+            url = urllib.parse.urlsplit(request[1])
+            if url.path == '/metrics':
+                await self._respond(writer, 200, render_relay(self.relay), 'text/plain; version=0.0.4')
+            elif url.path == '/profile' and self.profiler:
+                query = urllib.parse.parse_qs(url.query)
+                try:
+                    seconds = min(float(query.get('seconds', ['5'])[0]), MAX_PROFILE_SECONDS)
+                except ValueError:
+                    await self._respond(writer, 400, "seconds must be a number\n")
+                    return
+                stacks = await self.profiler.profile(seconds)
+                if stacks is None:
+                    await self._respond(writer, 409, "a profile is already running\n")
+                else:
+                    await self._respond(writer, 200, stacks)
+            else:
+                await self._respond(writer, 404, "not found\n")
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, body, content_type='text/plain'):
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict'}
+        data = body.encode()
+        writer.write(f"HTTP/1.0 {status} {reason[status]}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+        await writer.drain()
@@ -0,0 +1,265 @@
+import bisect
+import json
+import os
+import queue
+import re
+import struct
+import threading
+import time
+import zlib
+
+from audio_protocol import now_us
+
+RECORDING_MAGIC = b'SYNREC01'
+RECORDING_SUFFIX = '.synrec'
+CHUNK_MAGIC = b'CHNK'
+INDEX_MAGIC = b'SIDX'
+# File layout: magic, metadata length + JSON, chunks, chunk index, trailer
+META_HEADER = struct.Struct('!I')
+# Per chunk: magic, compressed size, record count, first and last timestamp (us)
+CHUNK_HEADER = struct.Struct('!4sIIQQ')
+# Per record inside a chunk: timestamp (us), speaker slot, kind, payload size
+RECORD_HEADER = struct.Struct('!QHBI')
+# Per index entry: first and last timestamp of a chunk, and its file offset
+INDEX_ENTRY = struct.Struct('!QQQ')
+TRAILER = struct.Struct('!QI4s')
+# Record kinds: a speaker's PCM frame at the room rate, a chat message (JSON), and a
+# speaker's display name, written before their first frame and whenever it changes
+AUDIO, TEXT, SPEAKER = 0, 1, 2
+CLOSE = None  # queue-only marker: the room emptied, finish its file
+CHUNK_BYTES = 256 * 1024
+CHUNK_SECONDS = 2.0
+COMPRESS_LEVEL = 6
+RECORD_QUEUE = 256  # mixer ticks' worth of records waiting for the writer
+
+
+def recording_path(directory, room_id, started):
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', room_id)
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(started / 1e6))
+    path = os.path.join(directory, f"{name}-{stamp}{RECORDING_SUFFIX}")
+    count = 1
+    while os.path.exists(path):
+        count += 1
+        path = os.path.join(directory, f"{name}-{stamp}-{count}{RECORDING_SUFFIX}")
+    return path
+
+
+class ArchiveWriter:
+    # One room's recording. Records are gathered raw and written as one compressed
+    # chunk once CHUNK_BYTES pile up or CHUNK_SECONDS pass, so a crash loses at most
+    # the last chunk. The chunk index goes at the end, for seeking by time.
+    def __init__(self, path, metadata):
+        self.path = path
+        self.file = open(path, 'wb')
+        data = json.dumps(metadata).encode()
+        self.file.write(RECORDING_MAGIC + META_HEADER.pack(len(data)) + data)
+        self.index = []
+        self.pending = bytearray()
+        self.count = 0
+        self.first = 0
+        self.last = 0
+        self.opened = 0.0
+
+    def add(self, timestamp, speaker, kind, payload):
+        if not self.count:
+            self.first = timestamp
+            self.opened = time.monotonic()
+        # Batches from one tick are not strictly in time order
+        self.first = min(self.first, timestamp)
+        self.pending += RECORD_HEADER.pack(timestamp, speaker, kind, len(payload))
+        self.pending += payload
+        self.count += 1
+        self.last = max(self.last, timestamp)
+
+    def due(self, now):
+        return self.count and (len(self.pending) >= CHUNK_BYTES or now - self.opened >= CHUNK_SECONDS)
+
+    def flush(self):
+        if not self.count:
+            return
+        data = zlib.compress(self.pending, COMPRESS_LEVEL)
+        self.index.append((self.first, self.last, self.file.tell()))
+        self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, len(data), self.count, self.first, self.last))
+        self.file.write(data)
+        self.file.flush()
+        self.pending.clear()
+        self.count = 0
+        self.last = 0
+
+    def close(self):
+        self.flush()
+        offset = self.file.tell()
+        self.file.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in self.index))
+        self.file.write(TRAILER.pack(offset, len(self.index), INDEX_MAGIC))
+        self.file.close()
+
+
+class Recorder:
+    # Records every room into its own archive in `directory`, off the forwarding path.
+    # The relay loop only appends to a list; once per mixer tick the list goes to the
+    # writer thread through a bounded queue. If the writer falls behind, whole ticks
+    # are dropped (and counted) rather than the loop ever waiting on the disk.
+    def __init__(self, directory, rate, chunk, queue_size=RECORD_QUEUE):
+        self.directory = directory
+        self.rate = rate
+        self.chunk = chunk
+        self.queue = queue.Queue(queue_size)
+        self.batch = []
+        self.speakers = {}  # room id -> {slot: name} as last recorded, for every room being recorded
+        self.thread = None
+        self.recorded = 0
+        self.dropped = 0
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._write, name='recorder', daemon=True)
+        self.thread.start()
+
+    def audio(self, room_id, conn, pcm):
+        timestamp = now_us()
+        speakers = self.speakers.setdefault(room_id, {})
+        if speakers.get(conn.id) != conn.name:
+            speakers[conn.id] = conn.name
+            self.batch.append((room_id, timestamp, conn.id, SPEAKER, conn.name.encode()))
+        self.batch.append((room_id, timestamp, conn.id, AUDIO, pcm))
+
+    def text(self, room_id, timestamp, sender, text):
+        data = json.dumps({'sender': sender, 'text': text}, ensure_ascii=False).encode()
+        self.speakers.setdefault(room_id, {})
+        self.batch.append((room_id, timestamp * 1000, 0, TEXT, data))
+
+    def close_room(self, room_id):
+        if self.speakers.pop(room_id, None) is not None:
+            self.batch.append((room_id, 0, 0, CLOSE, b''))
+
+    def tick(self):
+        if not self.batch:
+            return
+        try:
+            self.queue.put_nowait(self.batch)
+            self.recorded += len(self.batch)
+        except queue.Full:
+            self.dropped += len(self.batch)
+        self.batch = []
+
+    def close(self):
+        # Blocks until every open archive is finished; call it off the loop
+        self.tick()
+        if self.thread and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _open(self, room_id, started):
+        metadata = {'room': room_id, 'rate': self.rate, 'chunk': self.chunk, 'started': started}
+        return ArchiveWriter(recording_path(self.directory, room_id, started), metadata)
+
+    def _write(self):
+        archives = {}
+        try:
+            while True:
+                try:
+                    batch = self.queue.get(timeout=CHUNK_SECONDS)
+                except queue.Empty:
+                    batch = ()
+                if batch is None:
+                    break
+                for room_id, timestamp, speaker, kind, payload in batch:
+                    archive = archives.get(room_id)
+                    if kind is CLOSE:
+                        if archive:
+                            archives.pop(room_id).close()
+                        continue
+                    if archive is None:
+                        archive = archives[room_id] = self._open(room_id, timestamp)
+                    archive.add(timestamp, speaker, kind, payload)
+                now = time.monotonic()
+                for archive in archives.values():
+                    if archive.due(now):
+                        archive.flush()
+        except OSError as e:
+            print(f"Recording stopped: {e}")
+        finally:
+            for archive in archives.values():
+                try:
+                    archive.close()
+                except OSError:
+                    pass
+
+
+class RecordingReader:
+    # Reads an archive back. Seeking goes straight to the chunk holding a timestamp
+    # through the index; a file whose relay died before writing the index is still
+    # readable, the index is rebuilt by walking the chunk headers.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        if self.file.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError(f"{path} is not a SynConnect recording")
+        (length,) = META_HEADER.unpack(self.file.read(META_HEADER.size))
+        self.metadata = json.loads(self.file.read(length))
+        self.data_start = self.file.tell()
+        self.index = self._read_index() or self._scan()
+        self.starts = [first for first, last, offset in self.index]
+
+    @property
+    def started(self):
+        return self.metadata['started']
+
+    @property
+    def ended(self):
+        return max((last for first, last, offset in self.index), default=self.started)
+
+    def _read_index(self):
+        size = self.file.seek(0, os.SEEK_END)
+        if size - self.data_start < TRAILER.size:
+            return None
+        self.file.seek(size - TRAILER.size)
+        offset, count, magic = TRAILER.unpack(self.file.read(TRAILER.size))
+        if magic != INDEX_MAGIC or offset + count * INDEX_ENTRY.size + TRAILER.size != size:
+            return None
+        self.file.seek(offset)
+        data = self.file.read(count * INDEX_ENTRY.size)
+        return [INDEX_ENTRY.unpack_from(data, position * INDEX_ENTRY.size) for position in range(count)]
+
+    def _scan(self):
+        index = []
+        file_size = self.file.seek(0, os.SEEK_END)
+        offset = self.data_start
+        while offset + CHUNK_HEADER.size <= file_size:
+            self.file.seek(offset)
+            magic, size, count, first, last = CHUNK_HEADER.unpack(self.file.read(CHUNK_HEADER.size))
+            end = offset + CHUNK_HEADER.size + size
+            if magic != CHUNK_MAGIC or end > file_size:
+                break
+            index.append((first, last, offset))
+            offset = end
+        return index
+
+    def records(self, start=None, end=None):
+        # Yields (timestamp, speaker, kind, payload) from `start` (us) on; payloads are
+        # views into the decompressed chunk
+        position = 0
+        if start is not None:
+            position = max(0, bisect.bisect_right(self.starts, start) - 1)
+        for first, last, offset in self.index[position:]:
+            if end is not None and first > end:
+                return
+            if start is not None and last < start:
+                continue
+            self.file.seek(offset)
+            magic, size, count, first, last = CHUNK_HEADER.unpack(self.file.read(CHUNK_HEADER.size))
+            try:
+                data = memoryview(zlib.decompress(self.file.read(size)))
+            except zlib.error:
+                return  # a chunk cut short by a crash ends the recording
+            cursor = 0
+            for _ in range(count):
+                timestamp, speaker, kind, length = RECORD_HEADER.unpack_from(data, cursor)
+                cursor += RECORD_HEADER.size
+                payload = data[cursor:cursor + length]
+                cursor += length
+                if (start is None or timestamp >= start) and (end is None or timestamp <= end):
+                    yield timestamp, speaker, kind, payload
+
+    def close(self):
+        self.file.close()
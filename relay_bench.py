@@ -0,0 +1,469 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from audio_codec import CODECS, create_codec
+from audio_config import FRAME_MS, RATE, frame_samples
+from audio_protocol import (CODEC_CONTROL, CODEC_PCM16, FrameParser, ProtocolError, SequenceTracker, decode_control,
+                            encode_control, now_us, pack_frame)
+from text_protocol import TextReader, pack_text
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+HOST = '127.0.0.1'
+PORT = 5600
+TEXT_PORT = 5601
+CLIENT_COUNTS = '2,8,32,128'
+ROOM_SIZE = 8
+DURATION = 5.0
+WARMUP = 1.0
+TEXT_INTERVAL = 0.1
+STARTUP_TIMEOUT = 10.0
+HANDSHAKE_TIMEOUT = 5.0
+PROBE_ROOM = 'bench-probe'
+PROBE_LEVELS = 30000
+RELAY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'relay_server.py')
+
+
+def percentiles(values_us):
+    if not values_us:
+        return None
+    values = np.asarray(values_us, dtype=np.float64) / 1000
+    p50, p90, p99 = np.percentile(values, (50, 90, 99))
+    return {'p50': p50, 'p90': p90, 'p99': p99, 'max': values.max(), 'samples': len(values)}
+
+
+def synthetic_frames(index, rate, chunk, signal):
+    # One second of audio, looped: a sine per client so mixes are not just scaled copies
+    count = max(1, rate // chunk)
+    t = np.arange(count * chunk) / rate
+    if signal == 'noise':
+        samples = np.random.default_rng(index).normal(0, 2000, len(t))
+    else:
+        samples = 3000 * np.sin(2 * np.pi * (200 + 20 * (index % 40)) * t)
+    samples = samples.astype(np.int16).tobytes()
+    return [samples[offset:offset + chunk * 2] for offset in range(0, len(samples), chunk * 2)]
+
+
+def process_cpu_seconds(pid):
+    # utime + stime of a live process; only Linux exposes this without extra packages
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def raise_fd_limit():
+    # A few hundred clients need two sockets each on our side
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class BenchProtocol(asyncio.BufferedProtocol):
+    def __init__(self, client):
+        self.client = client
+        self.parser = FrameParser(client.on_frame)
+
+    def get_buffer(self, sizehint):
+        return self.parser.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        if self.client.recording:
+            self.client.bytes_received += nbytes
+        self.parser.buffer_updated(nbytes)
+
+    def connection_lost(self, exc):
+        if not self.client.welcome.done():
+            self.client.welcome.set_exception(ConnectionError("relay closed the connection"))
+
+
+class VoiceClient:
+    # Stands in for a VoiceCallWindow: pre-encoded frames replace stream.read() and
+    # whatever the relay sends back is timed instead of played
+    def __init__(self, room, frames, codec_id):
+        self.room = room
+        self.frames = frames
+        self.codec_id = codec_id
+        self.id = 0
+        self.transport = None
+        self.welcome = None
+        self.seq = 0
+        self.recording = False
+        self.reset()
+
+    def reset(self):
+        self.rx_seq = SequenceTracker()
+        self.latencies = []
+        self.jitter = 0.0
+        self.last_transit = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    async def connect(self, host, port, rate, chunk, codec_name):
+        loop = asyncio.get_running_loop()
+        self.welcome = loop.create_future()
+        self.transport, protocol = await loop.create_connection(lambda: BenchProtocol(self), host, port)
+        hello = {'type': 'hello', 'codecs': [codec_name], 'rate': rate, 'chunk': chunk, 'room': self.room}
+        self.transport.write(pack_frame(encode_control(hello), 0, 0, now_us(), CODEC_CONTROL))
+        message = await asyncio.wait_for(self.welcome, HANDSHAKE_TIMEOUT)
+        if message['type'] != 'welcome':
+            raise ProtocolError(f"relay refused the benchmark client: {message.get('reason')}")
+        self.id = message['client_id']
+
+    def send_next(self, timestamp):
+        frame = pack_frame(self.next_payload(), self.id, self.seq, timestamp, self.codec_id)
+        self.transport.write(frame)
+        self.seq += 1
+        if self.recording:
+            self.bytes_sent += len(frame)
+
+    def next_payload(self):
+        return self.frames[self.seq % len(self.frames)]
+
+    def on_frame(self, header, payload):
+        arrival = now_us()
+        if header.codec == CODEC_CONTROL:
+            if not self.welcome.done():
+                self.welcome.set_result(decode_control(payload))
+            return
+        if not self.recording:
+            return
+        self.rx_seq.update(header.seq)
+        # Mix timestamps come from the relay's clock, which on loopback is ours
+        transit = arrival - header.timestamp
+        self.latencies.append(transit)
+        if self.last_transit is not None:
+            self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+        self.last_transit = transit
+        self.on_audio(payload, arrival)
+
+    def on_audio(self, payload, arrival):
+        pass
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+
+class ProbeSender(VoiceClient):
+    # Alone in the probe room with one listener, so the listener's mix is exactly this
+    # client's frame. Every sample of a frame holds the same level, which maps the frame
+    # back to the moment it was sent.
+    def __init__(self, chunk):
+        super().__init__(PROBE_ROOM, None, CODEC_PCM16)
+        self.chunk = chunk
+        self.sent = {}
+
+    def next_payload(self):
+        level = self.seq % PROBE_LEVELS + 1
+        self.sent[level] = now_us()
+        return np.full(self.chunk, level, dtype=np.int16).tobytes()
+
+
+class ProbeListener(VoiceClient):
+    def __init__(self, sender):
+        super().__init__(PROBE_ROOM, [bytes(sender.chunk * 2)], CODEC_PCM16)
+        self.sender = sender
+        self.end_to_end = []
+
+    def on_audio(self, payload, arrival):
+        samples = np.frombuffer(payload, dtype=np.int16)
+        level = int(samples[0])
+        # Concealed or faded frames are not constant and tell us nothing
+        if level <= 0 or not (samples == level).all():
+            return
+        sent = self.sender.sent.get(level)
+        if sent is not None:
+            self.end_to_end.append(arrival - sent)
+
+    def reset(self):
+        super().reset()
+        self.end_to_end = []
+
+
+class TextClient:
+    def __init__(self, room):
+        self.room = room
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.recording = False
+        self.latencies = []
+
+    async def connect(self, host, port):
+        stream, self.writer = await asyncio.open_connection(host, port)
+        self.reader = TextReader(stream)
+        self.writer.write(pack_text({'type': 'join', 'room': self.room, 'history': 0}))
+        reply = await asyncio.wait_for(self.reader.read(), HANDSHAKE_TIMEOUT)
+        if reply is None or reply['type'] != 'joined':
+            raise ProtocolError(f"relay refused the benchmark text client: {reply}")
+        self.task = asyncio.create_task(self._read())
+
+    def send(self):
+        self.writer.write(pack_text({'type': 'message', 'text': str(now_us())}))
+
+    async def _read(self):
+        while True:
+            message = await self.reader.read()
+            if message is None:
+                break
+            if self.recording and message['type'] == 'message':
+                try:
+                    self.latencies.append(now_us() - int(message['text']))
+                except ValueError:
+                    pass
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+class RelayProcess:
+    def __init__(self, args):
+        self.args = args
+        self.process = None
+        # A fresh chat history per run, so earlier runs' logs do not skew the results
+        self.history_dir = tempfile.TemporaryDirectory(prefix='synconnect-bench-')
+
+    async def start(self):
+        args = self.args
+        command = [sys.executable, RELAY, '--host', args.host, '--port', str(args.port),
+                   '--text-port', str(args.text_port), '--rate', str(args.rate), '--frame-ms', str(args.frame_ms),
+                   '--no-udp', '--history', os.path.join(self.history_dir.name, 'history.sqlite3')]
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"relay exited with status {self.process.returncode} during startup")
+            try:
+                with socket.create_connection((args.host, args.text_port), timeout=0.5):
+                    return
+            except OSError:
+                await asyncio.sleep(0.1)
+        raise RuntimeError("relay did not start listening in time")
+
+    def cpu_seconds(self):
+        return process_cpu_seconds(self.process.pid)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.history_dir.cleanup()
+
+
+async def run_step(args, count):
+    chunk = frame_samples(args.rate, args.frame_ms)
+    codec = create_codec(args.codec, args.rate, chunk)
+    relay = RelayProcess(args)
+    await relay.start()
+    voice = []
+    text = []
+    sender_task = None
+    lag = []
+    try:
+        probe = ProbeSender(chunk)
+        listener = ProbeListener(probe)
+        voice += [probe, listener]
+        for index in range(count):
+            room = f"bench-{index // args.room_size}"
+            frames = [codec.encode(frame) for frame in synthetic_frames(index, args.rate, chunk, args.signal)]
+            voice.append(VoiceClient(room, frames, codec.codec_id))
+            if args.text:
+                text.append(TextClient(room))
+        for client in voice:
+            name = 'pcm16' if isinstance(client, (ProbeSender, ProbeListener)) else args.codec
+            await client.connect(args.host, args.port, args.rate, chunk, name)
+        for client in text:
+            await client.connect(args.host, args.text_port)
+        rooms = {}
+        for client in text:
+            rooms.setdefault(client.room, []).append(client)
+        sender_task = asyncio.create_task(send_loop(voice, list(rooms.values()), chunk / args.rate, lag))
+
+        await asyncio.sleep(WARMUP)
+        for client in voice + text:
+            client.recording = True
+        lag.clear()
+        cpu_start = relay.cpu_seconds()
+        started = time.monotonic()
+        await asyncio.sleep(args.duration)
+        elapsed = time.monotonic() - started
+        cpu_end = relay.cpu_seconds()
+        for client in voice + text:
+            client.recording = False
+    finally:
+        if sender_task:
+            sender_task.cancel()
+        for client in voice + text:
+            client.close()
+        relay.stop()
+
+    load = voice[2:]
+    latencies = [value for client in load for value in client.latencies]
+    jitters = [client.jitter / 1000 for client in load if client.last_transit is not None]
+    received = sum(client.rx_seq.received for client in load)
+    lost = sum(client.rx_seq.lost for client in load)
+    cpu = None
+    if cpu_start is not None and cpu_end is not None:
+        cpu = {'seconds': cpu_end - cpu_start, 'percent': 100 * (cpu_end - cpu_start) / elapsed}
+    return {
+        'clients': count,
+        'rooms': -(-count // args.room_size),
+        'duration_s': elapsed,
+        'latency_ms': {
+            'end_to_end': percentiles(listener.end_to_end),
+            'mix_to_client': percentiles(latencies),
+            'text': percentiles([value for client in text for value in client.latencies]),
+        },
+        'jitter_ms': {'mean': float(np.mean(jitters)), 'max': max(jitters)} if jitters else None,
+        'loss': {
+            'received': received,
+            'lost': lost,
+            'late': sum(client.rx_seq.late for client in load),
+            'ratio': lost / (received + lost) if received + lost else 0.0,
+        },
+        'server_cpu': cpu,
+        'bytes_per_sec': {
+            'to_relay': sum(client.bytes_sent for client in voice) / elapsed,
+            'from_relay': sum(client.bytes_received for client in voice) / elapsed,
+        },
+        # Late ticks mean the load generator, not the relay, was the bottleneck
+        'send_lag_ms': percentiles(lag),
+    }
+
+
+async def send_loop(voice, text_rooms, interval, lag):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time()
+    next_text = deadline
+    turn = 0
+    while True:
+        now = loop.time()
+        lag.append((now - deadline) * 1e6)
+        timestamp = now_us()
+        for client in voice:
+            client.send_next(timestamp)
+        if text_rooms and now >= next_text:
+            # One speaker per room per round, rotating through the members
+            for members in text_rooms:
+                members[turn % len(members)].send()
+            turn += 1
+            next_text += TEXT_INTERVAL
+        deadline += interval
+        delay = deadline - loop.time()
+        if delay < -interval:
+            deadline = loop.time()
+        await asyncio.sleep(max(delay, 0))
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(RELAY),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    # Flags steps whose p99 end-to-end latency or relay CPU grew by more than tolerance
+    previous = {step['clients']: step for step in baseline['steps']}
+    regressions = []
+    for step in results['steps']:
+        old = previous.get(step['clients'])
+        if old is None:
+            continue
+        checks = (
+            ('end-to-end p99 ms', (step['latency_ms']['end_to_end'] or {}).get('p99'),
+             (old['latency_ms']['end_to_end'] or {}).get('p99')),
+            ('relay CPU %', (step['server_cpu'] or {}).get('percent'), (old['server_cpu'] or {}).get('percent')),
+        )
+        for name, new_value, old_value in checks:
+            if new_value is not None and old_value and new_value > old_value * (1 + tolerance):
+                regressions.append(f"{step['clients']} clients: {name} {old_value:.2f} -> {new_value:.2f}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test a local SynConnect relay with synthetic clients")
+    parser.add_argument('--host', default=HOST, help="address for the relay under test (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=PORT, help="voice port (default: %(default)s)")
+    parser.add_argument('--text-port', type=int, default=TEXT_PORT, help="text port (default: %(default)s)")
+    parser.add_argument('--clients', default=CLIENT_COUNTS, help="comma-separated client counts (default: %(default)s)")
+    parser.add_argument('--room-size', type=int, default=ROOM_SIZE, help="clients per room (default: %(default)s)")
+    parser.add_argument('--duration', type=float, default=DURATION, help="measured seconds per step")
+    parser.add_argument('--rate', type=int, default=RATE, help="client and relay rate in Hz (default: %(default)s)")
+    parser.add_argument('--frame-ms', type=float, default=FRAME_MS, help="frame size in ms (default: %(default)s)")
+    parser.add_argument('--codec', choices=list(CODECS), default='pcm16', help="codec for the load clients")
+    parser.add_argument('--signal', choices=('sine', 'noise'), default='sine', help="synthetic audio to send")
+    parser.add_argument('--no-text', dest='text', action='store_false', help="skip the text chat load")
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    parser.add_argument('--baseline', help="earlier results to compare against; exits 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed growth over the baseline (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+    try:
+        args.clients = [int(count) for count in args.clients.split(',')]
+    except ValueError:
+        parser.error("--clients takes a comma-separated list of numbers")
+    if not CODECS[args.codec].supports(args.rate, frame_samples(args.rate, args.frame_ms)):
+        parser.error(f"{args.codec} is not available at this rate and frame size")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    raise_fd_limit()
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'rate': args.rate,
+        'frame_ms': args.frame_ms,
+        'codec': args.codec,
+        'room_size': args.room_size,
+        'steps': [],
+    }
+    for count in args.clients:
+        print(f"Benchmarking {count} clients...", file=sys.stderr)
+        results['steps'].append(asyncio.run(run_step(args, count)))
+    output = json.dumps(results, indent=2, default=float)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,313 @@
+import array
+import asyncio
+import base64
+import bisect
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+
+from audio_protocol import ProtocolError
+from relay_server import RelayServer
+
+IPC_BUFFER = 1 << 16
+HASH_REPLICAS = 64
+OUTBOX_LIMIT = 4096  # messages waiting for one busy worker before new ones are refused
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    # Consistent hashing with virtual nodes: changing the worker count only moves the
+    # rooms whose arc changed hands
+    def __init__(self, nodes, replicas=HASH_REPLICAS):
+        points = sorted((hash_key(f"{node}:{replica}"), node) for node in nodes for replica in range(replicas))
+        self.keys = [key for key, node in points]
+        self.nodes = [node for key, node in points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self.keys, hash_key(key)) % len(self.keys)
+        return self.nodes[index]
+
+
+class ClusterRouter:
+    # Every worker accepts on the shared ports through SO_REUSEPORT, so a client can land
+    # on any of them. Once its hello/join names a room, the socket is passed over a Unix
+    # datagram socket (SCM_RIGHTS) to the worker that owns the room. The same channel
+    # carries presence updates and announcements between workers.
+    #
+    # The kernel only queues a few datagrams per socket (net.unix.max_dgram_qlen), so
+    # each worker sends through its own connected socket per peer, which polls as
+    # writable only while the peer has room, and whatever does not fit waits in that
+    # peer's outbox.
+    def __init__(self, index, count, ipc_dir):
+        self.index = index
+        self.count = count
+        self.ipc_dir = ipc_dir
+        self.ring = HashRing(range(count))
+        self.relay = None
+        self.loop = None
+        self.sock = None
+        self.peers = {}
+        self.outboxes = {}
+        self.waiting = set()
+        self.remote = {}
+
+    def path(self, index):
+        return os.path.join(self.ipc_dir, f"worker-{index}.sock")
+
+    def bind(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path(self.index))
+        self.sock.setblocking(False)
+
+    def start(self, loop):
+        self.loop = loop
+        loop.add_reader(self.sock, self._on_readable)
+
+    def close(self):
+        if self.loop:
+            self.loop.remove_reader(self.sock)
+        self.sock.close()
+        for index in list(self.peers):
+            self._drop_peer(index)
+        try:
+            os.unlink(self.path(self.index))
+        except FileNotFoundError:
+            pass
+
+    def owner(self, room_id):
+        return self.ring.node_for(room_id)
+
+    def owns(self, room_id):
+        return self.owner(room_id) == self.index
+
+    def send(self, index, message, fds=(), done=None):
+        # Queues a message for another worker; done(ok) is called once it has gone out
+        # or cannot. The descriptors are duplicated, so the originals may close meanwhile.
+        data = json.dumps(message, separators=(',', ':')).encode()
+        entry = (data, [os.dup(fd) for fd in fds], done)
+        outbox = self.outboxes.setdefault(index, collections.deque())
+        if len(outbox) >= OUTBOX_LIMIT:
+            print(f"worker {self.index} dropped a message for worker {index}: its outbox is full")
+            self._finish(entry, False)
+            return
+        outbox.append(entry)
+        if len(outbox) == 1:
+            self._flush(index)
+
+    def _peer(self, index):
+        sock = self.peers.get(index)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            try:
+                sock.connect(self.path(index))
+            except OSError:
+                sock.close()
+                raise
+            self.peers[index] = sock
+        return sock
+
+    def _drop_peer(self, index):
+        sock = self.peers.pop(index, None)
+        if index in self.waiting:
+            self.waiting.discard(index)
+            self.loop.remove_writer(sock)
+        if sock:
+            sock.close()
+        for entry in self.outboxes.pop(index, ()):
+            self._finish(entry, False)
+
+    def _flush(self, index):
+        outbox = self.outboxes.get(index)
+        while outbox:
+            data, fds, done = outbox[0]
+            # socket.send_fds() drops its address argument, so build the SCM_RIGHTS message here
+            ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))] if fds else []
+            try:
+                sock = self._peer(index)
+                sock.sendmsg([data], ancillary)
+            except (BlockingIOError, InterruptedError):
+                # The peer's queue is full; carry on once it has read some
+                if index not in self.waiting:
+                    self.waiting.add(index)
+                    self.loop.add_writer(sock, self._flush, index)
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                self._drop_peer(index)  # that worker is shutting down
+                return
+            except OSError as e:
+                print(f"worker {self.index} could not reach worker {index}: {e}")
+                self._finish(outbox.popleft(), False)
+                continue
+            self._finish(outbox.popleft(), True)
+        if index in self.waiting:
+            self.waiting.discard(index)
+            self.loop.remove_writer(self.peers[index])
+
+    def _finish(self, entry, ok):
+        data, fds, done = entry
+        for fd in fds:
+            os.close(fd)
+        if done:
+            done(ok)
+
+    def publish(self, message):
+        if self.sock.fileno() < 0:
+            return
+        for index in range(self.count):
+            if index != self.index:
+                self.send(index, message)
+
+    def hand_off_voice(self, conn, hello, room_id):
+        # Stop reading now; whatever the parser already holds travels with the socket
+        conn.transport.pause_reading()
+        conn.parser.pause()
+        self.loop.call_soon(self._send_voice, conn, hello, room_id)
+
+    def _send_voice(self, conn, hello, room_id):
+        if conn not in self.relay.voice_connections:
+            return  # the client hung up before we got to it
+        pending = base64.b64encode(conn.parser.remaining()).decode()
+        message = {'type': 'adopt_voice', 'hello': hello, 'pending': pending}
+        self._transfer(conn, self.owner(room_id), message, self.relay.voice_connections,
+                       lambda: self._keep_voice(conn, hello))
+
+    def _keep_voice(self, conn, hello):
+        # The owner could not be reached: a room split across workers beats a lost client
+        self.relay._handle_control(conn, hello, local=True)
+        conn.transport.resume_reading()
+        try:
+            conn.parser.resume()
+        except ProtocolError as e:
+            print(e)
+            self.relay.protocol_errors += 1
+            conn.transport.abort()
+
+    def hand_off_text(self, conn, join, room_id):
+        # Resolves to whether the connection went to the owner; if not, serve it here
+        conn.transport.pause_reading()
+        handed_off = self.loop.create_future()
+
+        def kept():
+            conn.transport.resume_reading()
+            handed_off.set_result(False)
+
+        self._transfer(conn, self.owner(room_id), {'type': 'adopt_text', 'join': join}, self.relay.text_connections,
+                       kept, lambda: handed_off.done() or handed_off.set_result(True))
+        return handed_off
+
+    def _transfer(self, conn, owner, message, connections, kept, sent=None):
+        sock = conn.transport.get_extra_info('socket')
+
+        def done(ok):
+            if ok:
+                # The owner now holds its own copy of the descriptor; closing ours
+                # leaves the TCP connection open
+                self.relay._close_connection(conn, connections)
+                if sent:
+                    sent()
+            elif conn in connections:
+                kept()
+            elif sent:
+                sent()  # the client hung up meanwhile; there is nothing left to serve
+
+        if sock is None or sock.fileno() < 0:
+            done(False)
+            return
+        self.send(owner, message, [sock.fileno()], done)
+
+    def publish_presence(self, room_id, voice, text):
+        self.publish({'type': 'presence', 'worker': self.index, 'room': room_id, 'voice': voice, 'text': text})
+
+    def publish_announcement(self, sender, text):
+        self.publish({'type': 'announce', 'sender': sender, 'text': text})
+
+    def remote_presence(self):
+        presence = {}
+        for (worker, room_id), (voice, text) in self.remote.items():
+            totals = presence.setdefault(room_id, {'voice': 0, 'text': 0})
+            totals['voice'] += voice
+            totals['text'] += text
+        return presence
+
+    def _on_readable(self):
+        while True:
+            try:
+                data, fds, flags, address = socket.recv_fds(self.sock, IPC_BUFFER, 1)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                self._dispatch(json.loads(data), fds)
+            except (ValueError, KeyError) as e:
+                print(f"worker {self.index} ignored a malformed cluster message: {e}")
+                for fd in fds:
+                    os.close(fd)
+
+    def _dispatch(self, message, fds):
+        kind = message['type']
+        if kind == 'adopt_voice' and fds:
+            sock = self._adopt_socket(fds[0])
+            pending = base64.b64decode(message['pending'])
+            self.loop.create_task(self.relay.adopt_voice(sock, message['hello'], pending))
+        elif kind == 'adopt_text' and fds:
+            sock = self._adopt_socket(fds[0])
+            self.loop.create_task(self.relay.adopt_text(sock, message['join']))
+        elif kind == 'presence':
+            key = (message['worker'], message['room'])
+            if message['voice'] or message['text']:
+                self.remote[key] = (message['voice'], message['text'])
+            else:
+                self.remote.pop(key, None)
+        elif kind == 'announce':
+            self.relay.announce_local(message['sender'], message['text'])
+
+    def _adopt_socket(self, fd):
+        sock = socket.socket(fileno=fd)
+        sock.setblocking(False)
+        return sock
+
+
+def run_worker(index, count, ipc_dir, ready, options):
+    router = ClusterRouter(index, count, ipc_dir)
+    if options.get('metrics_port') is not None:
+        options = dict(options, metrics_port=options['metrics_port'] + index)
+    router.bind()
+    relay = RelayServer(**options, udp=False, reuse_port=True, router=router)
+    router.relay = relay
+    # Nobody hands a socket to a worker before every worker is listening on its channel
+    ready.wait()
+    asyncio.run(relay.serve(handle_signals=True))
+
+
+def run_cluster(workers, options):
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit("sharded mode needs SO_REUSEPORT, which this platform does not support")
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(prefix='synconnect-') as ipc_dir:
+        ready = context.Barrier(workers)
+        processes = [context.Process(target=run_worker, args=(index, workers, ipc_dir, ready, options),
+                                     name=f"relay-worker-{index}")
+                     for index in range(workers)]
+        for process in processes:
+            process.start()
+
+        def terminate(signum, frame):
+            for process in processes:
+                process.terminate()
+
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            # Workers got the same SIGINT from the terminal and shut down by themselves
+            for process in processes:
+                process.join()
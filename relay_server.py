@@ -0,0 +1,813 @@
+import argparse
+import asyncio
+import itertools
+import secrets
+import signal
+import threading
+import time
+
+from audio_codec import PcmCodec, create_codec, negotiate_codec
+from audio_config import CHUNK, FRAME_MS, RATE, frame_samples, validate_audio_params
+from audio_protocol import (CODEC_CONTROL, CODEC_DTX, HEADER, LEVEL_UNKNOWN, MAX_PAYLOAD, FrameParser,
+                            ProtocolError, SequenceTracker, decode_control, encode_control, now_us, pack_frame,
+                            unpack_frame)
+from connection_table import ConnectionTable
+from history import HISTORY_PATH, HistoryStore
+from metrics import BLOCK_BUCKETS, METRICS_HOST, TICK_BUCKETS, Histogram, MetricsServer, SamplingProfiler
+from recording import Recorder
+from resampler import Resampler
+from rooms import DEFAULT_ROOM, RoomRegistry, normalize_room_id
+from send_queue import SendQueue
+from sessions import SessionTable
+from text_protocol import HISTORY_PAGE, MAX_HISTORY_PAGE, TextReader, normalize_name, normalize_text, pack_text
+
+HOST = 'localhost'
+PORT = 5000
+TEXT_PORT = 5001
+QUEUE_SIZE = 32
+TEXT_QUEUE_SIZE = 256
+MAX_BATCH = 16
+# Keep the kernel-side backlog short so stale audio waits in the drop-oldest queue instead
+# of in the socket buffer, where nothing can drop it any more
+VOICE_WRITE_BUFFER = 4096
+BACKLOG = 128
+PEER_TIMEOUT = 5.0
+REAP_INTERVAL = 1.0
+WELCOME_RETRY = 0.5  # how often an unverified UDP peer that keeps sending gets its welcome again
+HOST_NAME = 'Host'  # sender shown for messages typed into the server window
+
+
+class Connection:
+    __slots__ = ('id', 'transport', 'drain', 'address', 'codec', 'room', 'parser', 'rate', 'chunk', 'resample_in',
+                 'resample_out', 'out_pending', 'outbound', 'frames_sent', 'bytes_sent', 'batched_writes',
+                 'send_blocked', 'frames_received', 'bytes_received', 'name', 'session', 'tx_seq', 'rx_seq', 'last_seen',
+                 'writer_task', 'cookie', 'verified', 'welcome', 'welcome_sent')
+
+    def __init__(self, transport, drain, outbound, codec):
+        self.id = 0  # assigned by the ConnectionTable
+        self.transport = transport
+        self.drain = drain
+        self.address = transport.get_extra_info('peername')
+        self.codec = codec
+        self.room = None
+        self.name = None
+        self.session = None
+        self.parser = None
+        self.rate = codec.rate
+        self.chunk = codec.chunk
+        self.resample_in = None
+        self.resample_out = None
+        self.out_pending = bytearray()
+        self.outbound = outbound
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.batched_writes = 0
+        self.send_blocked = 0.0
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.tx_seq = 0
+        self.rx_seq = SequenceTracker()
+        self.last_seen = 0.0
+        self.writer_task = None
+        # A UDP source address is only streamed to once it has echoed the cookie from
+        # its welcome, so a spoofed hello cannot aim the mix at someone else
+        self.cookie = None
+        self.verified = True
+        self.welcome = None
+        self.welcome_sent = 0.0
+
+    def close(self):
+        if self.writer_task:
+            self.writer_task.cancel()
+        self.transport.close()
+
+    def stats(self):
+        return {
+            'id': self.id,
+            'address': self.address,
+            'room': self.room.id if self.room else None,
+            'queued': len(self.outbound),
+            'queue_high_water': self.outbound.high_water,
+            'dropped': self.outbound.dropped,
+            'frames_sent': self.frames_sent,
+            'bytes_sent': self.bytes_sent,
+            'batched_writes': self.batched_writes,
+            'send_blocked_s': self.send_blocked,
+            'frames_received': self.frames_received,
+            'bytes_received': self.bytes_received,
+        }
+
+
+class VoiceProtocol(asyncio.BufferedProtocol):
+    # Frames are parsed straight out of the receive buffer, see FrameParser
+    def __init__(self, relay):
+        self.relay = relay
+        self.conn = None
+        self.parser = FrameParser(self._on_frame)
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    def connection_made(self, transport):
+        transport.set_write_buffer_limits(high=VOICE_WRITE_BUFFER)
+        self.conn = self.relay._open_connection(transport, self.drain, self.relay.voice_connections)
+        self.conn.parser = self.parser
+
+    def get_buffer(self, sizehint):
+        return self.parser.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        try:
+            self.parser.buffer_updated(nbytes)
+        except ProtocolError as e:
+            print(e)
+            self.relay.protocol_errors += 1
+            self.conn.transport.abort()
+
+    def feed(self, data):
+        try:
+            self.parser.feed(data)
+        except ProtocolError as e:
+            print(e)
+            self.relay.protocol_errors += 1
+            self.conn.transport.abort()
+
+    def _on_frame(self, header, payload):
+        self.relay._receive_frame(self.conn, header, payload)
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    async def drain(self):
+        await self.can_write.wait()
+
+    def connection_lost(self, exc):
+        if exc:
+            print(exc)
+        self.can_write.set()
+        self.relay._close_connection(self.conn, self.relay.voice_connections, dropped=exc is not None)
+
+
+class DatagramPeer:
+    # Gives one UDP source address the same write/close surface as a stream transport
+    def __init__(self, transport, addr):
+        self.transport = transport
+        self.addr = addr
+
+    def write(self, data):
+        self.transport.sendto(data, self.addr)
+
+    def writelines(self, frames):
+        # Every frame is its own datagram
+        for data in frames:
+            self.transport.sendto(data, self.addr)
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self.addr
+        return self.transport.get_extra_info(name, default)
+
+    def close(self):
+        pass
+
+
+class VoiceDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, relay):
+        self.relay = relay
+        self.transport = None
+        self.peers = {}
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            header, payload = unpack_frame(data)
+        except ProtocolError:
+            self.relay.protocol_errors += 1
+            return
+        conn = self.peers.get(addr)
+        if conn is None:
+            conn = self.relay._open_connection(DatagramPeer(self.transport, addr), self.drain, self.relay.voice_connections)
+            conn.cookie = secrets.token_urlsafe(12)
+            conn.verified = False
+            self.peers[addr] = conn
+        conn.last_seen = self.relay.loop.time()
+        try:
+            self.relay._receive_frame(conn, header, payload)
+        except ProtocolError:
+            self.relay.protocol_errors += 1
+
+    def error_received(self, exc):
+        pass
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    async def drain(self):
+        await self.can_write.wait()
+
+    def drop_peer(self, addr, dropped=False):
+        conn = self.peers.pop(addr, None)
+        if conn:
+            self.relay._close_connection(conn, self.relay.voice_connections, dropped)
+
+    def reap(self, timeout):
+        now = self.relay.loop.time()
+        for addr, conn in list(self.peers.items()):
+            # An address that never proved itself gets one reap interval, not a full timeout
+            if now - conn.last_seen > timeout or (not conn.verified and now - conn.last_seen > REAP_INTERVAL):
+                self.drop_peer(addr, dropped=True)
+
+
+class RelayServer:
+    def __init__(self, host=HOST, port=PORT, text_port=TEXT_PORT, chunk=CHUNK, rate=RATE,
+                 queue_size=QUEUE_SIZE, udp=True, on_text=None, on_mix=None, monitor_room=DEFAULT_ROOM,
+                 reuse_port=False, router=None, metrics_port=None, metrics_host=METRICS_HOST, profile=False,
+                 history_path=None, max_speakers=None, record_dir=None):
+        self.host = host
+        self.port = port
+        self.text_port = text_port
+        self.queue_size = queue_size
+        self.udp = udp
+        self.reuse_port = reuse_port
+        # Set when running as one worker of a sharded cluster, see relay_cluster.py
+        self.router = router
+        self.on_text = on_text
+        self.on_mix = on_mix
+        self.monitor_room = monitor_room
+        self.chunk = chunk
+        self.rate = rate
+        # In big rooms only the loudest few speakers are mixed, see AudioMixer
+        self.rooms = RoomRegistry(chunk, rate, on_change=self._room_changed, max_speakers=max_speakers)
+        self.voice_connections = ConnectionTable()
+        self.text_connections = ConnectionTable()
+        self.sessions = SessionTable()
+        self.voice_server = None
+        self.text_server = None
+        self.datagram_transport = None
+        self.datagram_protocol = None
+        self.tasks = []
+        self.text_tasks = set()
+        self.loop = None
+        self.stop_event = None
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.profile = profile
+        self.metrics_server = None
+        self.history_path = history_path
+        self.history = None
+        self.record_dir = record_dir
+        self.recorder = None
+        # Message ids when there is no history store to hand them out
+        self.message_ids = itertools.count(1)
+        self.connections_opened = 0
+        self.protocol_errors = 0
+        self.text_messages = 0
+        self.ticks_overrun = 0
+        self.tick_time = Histogram(TICK_BUCKETS)
+        self.block_time = Histogram(BLOCK_BUCKETS)
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        if self.history_path:
+            # Opened here rather than in __init__ so it belongs to the loop's thread
+            worker, workers = (self.router.index, self.router.count) if self.router else (0, 1)
+            self.history = HistoryStore(self.history_path, worker, workers)
+        if self.record_dir:
+            self.recorder = Recorder(self.record_dir, self.rate, self.chunk)
+            self.recorder.start()
+        if self.router:
+            self.router.start(self.loop)
+        self.voice_server = await self.loop.create_server(lambda: VoiceProtocol(self), self.host, self.port,
+                                                          backlog=BACKLOG, reuse_port=self.reuse_port)
+        self.text_server = await asyncio.start_server(self._handle_text, self.host, self.text_port,
+                                                      backlog=BACKLOG, reuse_port=self.reuse_port)
+        if self.udp:
+            self.datagram_transport, self.datagram_protocol = await self.loop.create_datagram_endpoint(
+                lambda: VoiceDatagramProtocol(self), local_addr=(self.host, self.port))
+        self.tasks.append(asyncio.create_task(self._reap_loop()))
+        self.tasks.append(asyncio.create_task(self._mix_loop()))
+        if self.metrics_port is not None:
+            # The profiler watches this thread, which runs the whole forwarding path
+            profiler = SamplingProfiler(threading.get_ident()) if self.profile else None
+            self.metrics_server = MetricsServer(self, self.metrics_host, self.metrics_port, profiler)
+            await self.metrics_server.start()
+
+    async def serve(self, handle_signals=False):
+        await self.start()
+        if handle_signals:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    self.loop.add_signal_handler(signum, self.stop_event.set)
+                except NotImplementedError:
+                    pass  # Windows event loops have no signal handlers
+        try:
+            await self.stop_event.wait()
+        finally:
+            await self.stop()
+
+    def request_stop(self):
+        # Safe to call from any thread, e.g. the Qt front-end
+        if self.loop and self.stop_event:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    async def stop(self):
+        for server in (self.voice_server, self.text_server):
+            if server:
+                server.close()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+        if self.datagram_transport:
+            self.datagram_transport.close()
+            self.datagram_transport = None
+            self.datagram_protocol = None
+        for conn in self.voice_connections.snapshot() + self.text_connections.snapshot():
+            conn.close()
+        if self.text_tasks:
+            # Let text handlers see EOF and return; cancelling them mid-read gets logged
+            await asyncio.wait(self.text_tasks, timeout=1.0)
+        for server in (self.voice_server, self.text_server):
+            if server:
+                await server.wait_closed()
+        self.voice_server = None
+        self.text_server = None
+        if self.metrics_server:
+            await self.metrics_server.close()
+            self.metrics_server = None
+        if self.history:
+            # Waits for the writer thread to finish what is queued
+            await self.loop.run_in_executor(None, self.history.flush)
+            self.history.close()
+            self.history = None
+        if self.recorder:
+            # Finishing the archives compresses what is left, so keep it off the loop
+            await self.loop.run_in_executor(None, self.recorder.close)
+            self.recorder = None
+        if self.router:
+            self.router.close()
+
+    async def adopt_voice(self, sock, hello, pending=b''):
+        # Takes over a voice connection another worker accepted, starting from its hello
+        transport, protocol = await self.loop.connect_accepted_socket(lambda: VoiceProtocol(self), sock)
+        self._handle_control(protocol.conn, hello)
+        if pending:
+            protocol.feed(pending)
+
+    async def adopt_text(self, sock, join):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await self._handle_text(reader, writer, join)
+
+    def presence(self):
+        presence = self.rooms.presence()
+        if self.router:
+            for room_id, counts in self.router.remote_presence().items():
+                totals = presence.setdefault(room_id, {'voice': 0, 'text': 0})
+                totals['voice'] += counts['voice']
+                totals['text'] += counts['text']
+        return presence
+
+    def _room_changed(self, room_id, voice, text):
+        if self.recorder and not voice and not text:
+            self.recorder.close_room(room_id)
+        if self.router:
+            self.router.publish_presence(room_id, voice, text)
+
+    def _open_connection(self, transport, drain, connections, text=False):
+        codec = PcmCodec(self.rate, self.chunk)
+        if text:
+            outbound = SendQueue(TEXT_QUEUE_SIZE, drop_oldest=False)
+        else:
+            outbound = SendQueue(self.queue_size)
+        conn = Connection(transport, drain, outbound, codec)
+        connections.add(conn)
+        self.connections_opened += 1
+        conn.writer_task = asyncio.create_task(self._drain_outbound(conn))
+        print(f"Student connected: {conn.address}")
+        return conn
+
+    def _close_connection(self, conn, connections, dropped=False):
+        # A connection lost to the network keeps its slot held until its session expires;
+        # one the client closed gives it up straight away
+        hold = False
+        if conn.session is not None:
+            if dropped:
+                hold = self.sessions.park(conn, self.loop.time()) is not None
+            else:
+                self.sessions.close(conn)
+        if not connections.remove(conn, hold=hold):
+            return  # already closed, e.g. handed off to another worker
+        self.rooms.leave(conn)
+        conn.close()
+
+    def _resume_session(self, conn, token, room_id, connections, voice=True):
+        # Puts a reconnecting client back in the slot its session holds, or opens a new
+        # session. Returns whether it resumed.
+        session = self.sessions.resume(token, room_id, voice)
+        if session is None:
+            self.sessions.open(conn, room_id, voice)
+            return False
+        if session.conn is not None and session.conn is not conn:
+            # The old connection has not noticed it is dead yet
+            self._close_connection(session.conn, connections, dropped=True)
+        connections.claim(conn, session.slot)
+        self.sessions.attach(session, conn)
+        conn.name = session.name
+        return True
+
+    async def _drain_outbound(self, conn):
+        try:
+            while True:
+                batch = await conn.outbound.get_batch(MAX_BATCH)
+                if len(batch) == 1:
+                    conn.transport.write(batch[0])
+                else:
+                    # A recipient that fell behind gets its backlog in one gathered write
+                    conn.transport.writelines(batch)
+                    conn.batched_writes += 1
+                conn.frames_sent += len(batch)
+                conn.bytes_sent += sum(map(len, batch))
+                started = self.loop.time()
+                await conn.drain()
+                blocked = self.loop.time() - started
+                conn.send_blocked += blocked
+                self.block_time.observe(blocked)
+        except (OSError, asyncio.CancelledError):
+            pass
+
+    def _receive_frame(self, conn, header, payload):
+        conn.frames_received += 1
+        conn.bytes_received += HEADER.size + len(payload)
+        if header.codec == CODEC_CONTROL:
+            self._handle_control(conn, decode_control(payload))
+            return
+        if not conn.verified:
+            # Its welcome or its verify went missing; sending audio shows it is still there
+            self._resend_welcome(conn)
+            return
+        if conn.rx_seq.update(header.seq) < 0:
+            return  # late frames are worthless once the mixer has moved past them
+        room = conn.room
+        if room is None:
+            return  # no audio is routed before the hello has put us in a room
+        if header.codec == CODEC_DTX:
+            room.mixer.set_inactive(conn)
+            return
+        if payload and header.codec == conn.codec.codec_id:
+            if (room.mixer.max_speakers and header.level != LEVEL_UNKNOWN and not self.recorder
+                    and conn.resample_in is None and conn.chunk == self.chunk):
+                # Ranked by the level in the header and decoded only if picked; the
+                # recorder needs everyone's audio, and other frame sizes need re-chunking
+                room.mixer.push_encoded(conn, bytes(payload), header.level, conn.codec.decode)
+                return
+            pcm = conn.codec.decode(payload)
+            if conn.resample_in:
+                pcm = conn.resample_in.process(pcm)
+            room.mixer.push(conn, pcm)
+            if self.recorder:
+                self.recorder.audio(room.id, conn, pcm)
+
+    def _handle_control(self, conn, message, local=False):
+        if message['type'] == 'hello':
+            rate = message.get('rate', self.rate)
+            chunk = message.get('chunk', self.chunk)
+            room_id = normalize_room_id(message.get('room', DEFAULT_ROOM))
+            codecs = message.get('codecs', [])
+            error = validate_audio_params(rate, chunk, MAX_PAYLOAD)
+            if room_id is None:
+                error = "invalid room id"
+            elif not isinstance(codecs, list):
+                error = "codecs must be a list"
+            if error:
+                self._send_control(conn, {'type': 'error', 'reason': error})
+                return
+            if self.router and conn.parser and not local and not self.router.owns(room_id):
+                self.router.hand_off_voice(conn, message, room_id)
+                return
+            conn.name = normalize_name(message.get('name')) or f"Student {conn.id}"
+            resumed = self._resume_session(conn, message.get('session'), room_id, self.voice_connections)
+            name = negotiate_codec(codecs, rate, chunk)
+            self._configure_audio(conn, rate, chunk, name)
+            self.rooms.join(conn, room_id)
+            welcome = {'type': 'welcome', 'client_id': conn.id, 'codec': name, 'rate': rate, 'chunk': chunk,
+                       'room': room_id, 'session': conn.session, 'resumed': resumed}
+            if conn.cookie:
+                welcome['cookie'] = conn.cookie
+                conn.welcome = welcome
+                conn.welcome_sent = self.loop.time()
+            self._send_control(conn, welcome)
+        elif message['type'] == 'verify':
+            if conn.cookie and message.get('cookie') == conn.cookie:
+                conn.verified = True
+
+    def _resend_welcome(self, conn):
+        now = self.loop.time()
+        if conn.welcome is None or now - conn.welcome_sent < WELCOME_RETRY:
+            return
+        conn.welcome_sent = now
+        self._send_control(conn, conn.welcome)
+
+    def _configure_audio(self, conn, rate, chunk, codec_name):
+        # Each client keeps its own device rate and frame size; the room mixes at ours
+        conn.codec = create_codec(codec_name, rate, chunk)
+        conn.rate = rate
+        conn.chunk = chunk
+        conn.out_pending.clear()
+        if rate == self.rate:
+            conn.resample_in = conn.resample_out = None
+        else:
+            conn.resample_in = Resampler(rate, self.rate)
+            conn.resample_out = Resampler(self.rate, rate)
+
+    def _send_control(self, conn, message):
+        conn.outbound.put(pack_frame(encode_control(message), 0, 0, now_us(), CODEC_CONTROL))
+
+    async def _handle_text(self, reader, writer, join=None):
+        conn = self._open_connection(writer.transport, writer.drain, self.text_connections, text=True)
+        reader = TextReader(reader)
+        dropped = False
+        task = asyncio.current_task()
+        self.text_tasks.add(task)
+        try:
+            # Text connections open with a join naming their room and wait for the
+            # joined reply before sending anything else
+            if join is None:
+                join = await reader.read()
+                if join is None:
+                    return
+            room_id = normalize_room_id(join.get('room', DEFAULT_ROOM))
+            if join['type'] != 'join' or room_id is None:
+                raise ProtocolError("text connection did not join a room")
+            if self.router and not self.router.owns(room_id):
+                if await self.router.hand_off_text(conn, join, room_id):
+                    return
+                if conn not in self.text_connections:
+                    return
+            conn.name = normalize_name(join.get('name')) or f"Student {conn.id}"
+            resumed = self._resume_session(conn, join.get('session'), room_id, self.text_connections, voice=False)
+            room = self.rooms.join(conn, room_id, voice=False)
+            conn.outbound.put(pack_text({'type': 'joined', 'room': room_id, 'client_id': conn.id,
+                                         'name': conn.name, 'session': conn.session, 'resumed': resumed}))
+            if resumed and join.get('since') is not None:
+                self._send_replay(conn, room, join['since'])
+            else:
+                self._send_history(conn, room_id, None, join.get('history', HISTORY_PAGE))
+            while True:
+                message = await reader.read()
+                if message is None:
+                    break
+                conn.frames_received += 1
+                conn.bytes_received = reader.bytes_read
+                self.text_messages += 1
+                if message['type'] == 'message':
+                    text = normalize_text(message.get('text'))
+                    if text is None:
+                        raise ProtocolError("empty or oversized chat message")
+                    self.broadcast_text(text, room, conn.name, exclude=conn)
+                    if self.on_text:
+                        self.on_text(room.id, conn.name, text)
+                elif message['type'] == 'history':
+                    self._send_history(conn, room_id, message.get('before'), message.get('limit', HISTORY_PAGE))
+                elif message['type'] == 'ping':
+                    conn.outbound.put(pack_text({'type': 'pong'}))
+                else:
+                    raise ProtocolError(f"unknown text message type {message['type']!r}")
+        except (OSError, ProtocolError) as e:
+            print(e)
+            if isinstance(e, ProtocolError):
+                self.protocol_errors += 1
+            else:
+                dropped = True
+        finally:
+            self.text_tasks.discard(task)
+            self._close_connection(conn, self.text_connections, dropped)
+
+    def _send_history(self, conn, room_id, before, limit):
+        if not isinstance(limit, int) or not (before is None or isinstance(before, int)):
+            raise ProtocolError("malformed history request")
+        limit = max(0, min(limit, MAX_HISTORY_PAGE))
+        if not limit:
+            return
+        messages, more = self.history.page(room_id, before, limit) if self.history else ([], False)
+        conn.outbound.put(pack_text({'type': 'history', 'room': room_id, 'messages': messages, 'more': more}))
+
+    def _send_replay(self, conn, room, since):
+        # Catches a resumed client up on what it missed from the room's recent messages
+        if not isinstance(since, int):
+            raise ProtocolError("malformed replay request")
+        messages, complete = room.replay(since)
+        conn.outbound.put(pack_text({'type': 'replay', 'room': room.id, 'messages': messages,
+                                     'complete': complete}))
+
+    def broadcast_text(self, text, room=None, sender=HOST_NAME, exclude=None):
+        if room is not None:
+            self._post_text(room, sender, text, exclude)
+            return
+        # Without a room the message is an announcement to every room
+        if self.router:
+            self.router.publish_announcement(sender, text)
+        self.announce_local(sender, text)
+
+    def announce_local(self, sender, text):
+        for room in list(self.rooms.rooms.values()):
+            self._post_text(room, sender, text)
+
+    def _post_text(self, room, sender, text, exclude=None):
+        # Logged first so every copy carries the id clients page history from
+        timestamp = now_us() // 1000
+        if self.history:
+            message_id = self.history.append(room.id, sender, timestamp, text)
+        else:
+            message_id = next(self.message_ids)
+        message = {'id': message_id, 'room': room.id, 'sender': sender, 'timestamp': timestamp, 'text': text}
+        room.remember(message)
+        if self.recorder:
+            self.recorder.text(room.id, timestamp, sender, text)
+        data = pack_text({'type': 'message', **message})
+        # The one encoded copy is shared by every recipient's queue, and each queue goes
+        # out in batched writes
+        for conn in tuple(room.text_members):
+            if conn is exclude:
+                continue
+            if not conn.outbound.put(data):
+                # A text reader this far behind is stalled; drop it rather than the room
+                self._close_connection(conn, self.text_connections, dropped=True)
+
+    def _announce_speakers(self, room):
+        # Tells the room's text clients who is audible, only when that changes
+        speakers = [{'id': conn.id, 'name': conn.name} for conn in room.speakers]
+        data = pack_text({'type': 'speakers', 'room': room.id, 'speakers': speakers})
+        for conn in tuple(room.text_members):
+            conn.outbound.put(data)
+
+    def connection_stats(self):
+        # Safe from any thread: it only reads the tables' snapshots
+        return [conn.stats() for conn in self.voice_connections.snapshot() + self.text_connections.snapshot()]
+
+    def send_text_threadsafe(self, text):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.broadcast_text, text)
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(REAP_INTERVAL)
+            if self.datagram_protocol:
+                # UDP has no close, so peers that stop sending keepalives are expired
+                self.datagram_protocol.reap(PEER_TIMEOUT)
+            for session in self.sessions.expire(self.loop.time()):
+                connections = self.voice_connections if session.voice else self.text_connections
+                connections.release(session.slot)
+
+    def _send_audio(self, conn, pcm, timestamp):
+        if conn.resample_out:
+            pcm = conn.resample_out.process(pcm)
+        frame_bytes = conn.chunk * 2
+        if len(pcm) == frame_bytes and not conn.out_pending:
+            frames = (pcm,)
+        else:
+            # Re-chunk the room's frames into the client's frame size
+            conn.out_pending += pcm
+            usable = len(conn.out_pending) - len(conn.out_pending) % frame_bytes
+            frames = [bytes(conn.out_pending[offset:offset + frame_bytes]) for offset in range(0, usable, frame_bytes)]
+            del conn.out_pending[:usable]
+        for frame in frames:
+            payload = conn.codec.encode(frame)
+            conn.outbound.put(pack_frame(payload, 0, conn.tx_seq, timestamp, conn.codec.codec_id))
+            conn.tx_seq += 1
+
+    def _abort_voice(self, conn, error):
+        print(f"Dropping voice client {conn.address}: {error!r}")
+        self.protocol_errors += 1
+        if conn.parser is None and self.datagram_protocol:
+            self.datagram_protocol.drop_peer(conn.address)
+        else:
+            self._close_connection(conn, self.voice_connections)
+
+    async def _mix_loop(self):
+        interval = self.chunk / self.rate
+        deadline = self.loop.time()
+        while True:
+            timestamp = now_us()
+            tick_start = time.perf_counter()
+            for room in list(self.rooms.rooms.values()):
+                room_start = time.perf_counter()
+                room_mix, outputs = room.mixer.mix()
+                for conn, frame in outputs.items():
+                    if not conn.verified:
+                        continue
+                    try:
+                        self._send_audio(conn, frame, timestamp)
+                    except Exception as e:
+                        # One client's bad state must not stop the mixer for everyone
+                        self._abort_voice(conn, e)
+                if room_mix and self.on_mix and room.id == self.monitor_room:
+                    self.on_mix(room_mix)
+                if room.mixer.max_speakers and set(room.mixer.speakers) != set(room.speakers):
+                    room.speakers = room.mixer.speakers
+                    self._announce_speakers(room)
+                room.mix_time.observe(time.perf_counter() - room_start)
+            if self.recorder:
+                self.recorder.tick()
+            self.tick_time.observe(time.perf_counter() - tick_start)
+            deadline += interval
+            delay = deadline - self.loop.time()
+            if delay < -interval:
+                self.ticks_overrun += 1
+                deadline = self.loop.time()
+            await asyncio.sleep(max(delay, 0))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SynConnect voice and text relay")
+    parser.add_argument('--host', default=HOST, help="address to listen on (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=PORT, help="voice port, TCP and UDP (default: %(default)s)")
+    parser.add_argument('--text-port', type=int, default=TEXT_PORT, help="text chat port (default: %(default)s)")
+    parser.add_argument('--rate', type=int, default=RATE, help="room mixing rate in Hz (default: %(default)s)")
+    parser.add_argument('--frame-ms', type=float, default=FRAME_MS, help="mixer tick in ms (default: %(default)s)")
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help="outbound frames buffered per client")
+    parser.add_argument('--no-udp', dest='udp', action='store_false', help="disable the UDP voice transport")
+    parser.add_argument('--playback', action='store_true', help="play a room's mix on this machine's speakers")
+    parser.add_argument('--monitor-room', default=DEFAULT_ROOM, help="room heard with --playback (default: %(default)s)")
+    parser.add_argument('--gui', action='store_true', help="open the Qt server window instead of running headless")
+    parser.add_argument('--history', default=HISTORY_PATH, help="SQLite file for chat history (default: %(default)s)")
+    parser.add_argument('--no-history', dest='history', action='store_const', const=None,
+                        help="keep no chat history")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve Prometheus metrics on this port (with --workers, worker N uses port + N)")
+    parser.add_argument('--metrics-host', default=METRICS_HOST, help="address for the metrics endpoint")
+    parser.add_argument('--profile', action='store_true',
+                        help="allow sampling the relay loop via GET /profile?seconds=N on the metrics port")
+    parser.add_argument('--record', metavar='DIR',
+                        help="record every room to a seekable archive in DIR (see replay_recording.py)")
+    parser.add_argument('--max-speakers', type=int,
+                        help="mix only this many of the loudest speakers in each room (default: everyone)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="relay processes sharing the ports, rooms sharded between them (TCP only)")
+    args = parser.parse_args(argv)
+    args.chunk = frame_samples(args.rate, args.frame_ms)
+    if args.profile and args.metrics_port is None:
+        parser.error("--profile needs --metrics-port")
+    if args.max_speakers is not None and args.max_speakers < 1:
+        parser.error("--max-speakers must be at least 1")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and (args.gui or args.playback):
+        parser.error("--workers cannot be combined with --gui or --playback")
+    error = validate_audio_params(args.rate, args.chunk, MAX_PAYLOAD)
+    if error:
+        parser.error(error)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.gui:
+        from PyQt5 import QtWidgets
+        from voice_chat_server import VoiceChatServer
+        app = QtWidgets.QApplication([])
+        app.setStyle("Fusion")
+        window = VoiceChatServer(args.host, args.port, args.text_port, args.rate, args.chunk, args.udp, args.playback,
+                                 args.history, queue_size=args.queue_size, monitor_room=args.monitor_room,
+                                 metrics_port=args.metrics_port, metrics_host=args.metrics_host, profile=args.profile,
+                                 max_speakers=args.max_speakers, record_dir=args.record)
+        window.showMaximized()
+        return app.exec_()
+    if args.workers > 1:
+        from relay_cluster import run_cluster
+        options = dict(host=args.host, port=args.port, text_port=args.text_port, chunk=args.chunk, rate=args.rate,
+                       queue_size=args.queue_size, metrics_port=args.metrics_port, metrics_host=args.metrics_host,
+                       profile=args.profile, history_path=args.history, max_speakers=args.max_speakers,
+                       record_dir=args.record)
+        print(f"Relay listening on {args.host}: voice {args.port}, text {args.text_port} ({args.workers} workers)")
+        run_cluster(args.workers, options)
+        return 0
+    playback = None
+    if args.playback:
+        from local_playback import MixPlayback
+        playback = MixPlayback(args.rate, args.chunk)
+        playback.start()
+    relay = RelayServer(args.host, args.port, args.text_port, args.chunk, args.rate, args.queue_size, args.udp,
+                        on_mix=playback.queue_frame if playback else None, monitor_room=args.monitor_room,
+                        metrics_port=args.metrics_port, metrics_host=args.metrics_host, profile=args.profile,
+                        history_path=args.history, max_speakers=args.max_speakers, record_dir=args.record)
+    print(f"Relay listening on {args.host}: voice {args.port}, text {args.text_port}")
+    try:
+        asyncio.run(relay.serve(handle_signals=True))
+    finally:
+        if playback:
+            playback.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
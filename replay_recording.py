@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+import wave
+
+import numpy as np
+
+from audio_protocol import (CODEC_CONTROL, CODEC_PCM16, HEADER, ProtocolError, decode_control, encode_control, now_us,
+                            pack_frame, unpack_frame)
+from audio_mixer import INT16_MAX, INT16_MIN
+from recording import AUDIO, SPEAKER, TEXT, RecordingReader
+from text_protocol import TextReader, pack_text
+
+HOST = '127.0.0.1'
+PORT = 5000
+TEXT_PORT = 5001
+# A speaker's frames are laid end to end like the live mixer takes them; one whose
+# next frame arrives further than this from where it would go is re-anchored
+REANCHOR_FRAMES = 8
+HANDSHAKE_TIMEOUT = 5.0
+REPLAY_NAME = 'Recording'
+
+
+def offset_us(reader, seconds):
+    return None if seconds is None else reader.started + int(seconds * 1e6)
+
+
+def describe(reader):
+    speakers = {}
+    frames = messages = 0
+    for timestamp, speaker, kind, payload in reader.records():
+        if kind == AUDIO:
+            frames += 1
+        elif kind == TEXT:
+            messages += 1
+        elif kind == SPEAKER:
+            speakers[speaker] = bytes(payload).decode()
+    return dict(reader.metadata, seconds=(reader.ended - reader.started) / 1e6, chunks=len(reader.index),
+                frames=frames, messages=messages, speakers=sorted(set(speakers.values())))
+
+
+def _mix_into(blocks, block_size, position, samples):
+    while len(samples):
+        index, offset = divmod(position, block_size)
+        block = blocks.get(index)
+        if block is None:
+            block = blocks[index] = np.zeros(block_size, dtype=np.int32)
+        count = min(len(samples), block_size - offset)
+        block[offset:offset + count] += samples[:count]
+        samples = samples[count:]
+        position += count
+
+
+def _write_block(wav, block, length=None):
+    wav.writeframes(np.clip(block[:length], INT16_MIN, INT16_MAX).astype(np.int16).tobytes())
+
+
+def render_wav(reader, path, start=None, end=None):
+    # Mixes the recorded speakers into a WAV file as fast as the disk allows. Audio is
+    # summed in one-second blocks that are written out once every speaker is past them,
+    # so memory stays flat however long the lecture was.
+    rate = reader.metadata['rate']
+    chunk = reader.metadata['chunk']
+    origin = start if start is not None else reader.started
+    block_size = rate
+    blocks = {}
+    positions = {}
+    written = 0
+    length = 0
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        for timestamp, speaker, kind, payload in reader.records(start, end):
+            if kind != AUDIO:
+                continue
+            arrival = max(0, round((timestamp - origin) * rate / 1e6))
+            position = positions.get(speaker)
+            if position is None or abs(arrival - position) > REANCHOR_FRAMES * chunk:
+                position = arrival
+            samples = np.frombuffer(payload, dtype=np.int16)
+            _mix_into(blocks, block_size, position, samples)
+            positions[speaker] = position + len(samples)
+            length = max(length, position + len(samples))
+            while written < arrival // block_size - 1:
+                _write_block(wav, blocks.pop(written, np.zeros(block_size, dtype=np.int32)))
+                written += 1
+        while written * block_size < length:
+            block = blocks.pop(written, np.zeros(block_size, dtype=np.int32))
+            _write_block(wav, block, min(block_size, length - written * block_size))
+            written += 1
+    return length / rate
+
+
+async def _discard(reader):
+    # The relay sends the room mix back to every voice connection; nobody listens here
+    while await reader.read(65536):
+        pass
+
+
+class ReplayVoice:
+    # One relay voice connection playing back one recorded speaker
+    def __init__(self, name):
+        self.name = name
+        self.writer = None
+        self.seq = 0
+        self.task = None
+
+    async def connect(self, host, port, room, rate, chunk):
+        reader, self.writer = await asyncio.open_connection(host, port)
+        hello = {'type': 'hello', 'codecs': ['pcm16'], 'rate': rate, 'chunk': chunk, 'room': room,
+                 'name': self.name}
+        self.writer.write(pack_frame(encode_control(hello), 0, 0, now_us(), CODEC_CONTROL))
+        # The welcome is the first frame back
+        data = await asyncio.wait_for(reader.readexactly(HEADER.size), HANDSHAKE_TIMEOUT)
+        data += await asyncio.wait_for(reader.readexactly(HEADER.unpack(data)[0]), HANDSHAKE_TIMEOUT)
+        header, payload = unpack_frame(data)
+        message = decode_control(payload) if header.codec == CODEC_CONTROL else {}
+        if message.get('type') != 'welcome' or message.get('codec') != 'pcm16':
+            raise ProtocolError(f"relay refused the replay of {self.name}: {message.get('reason')}")
+        self.task = asyncio.create_task(_discard(reader))
+
+    def send(self, pcm):
+        self.writer.write(pack_frame(pcm, 0, self.seq, now_us(), CODEC_PCM16))
+        self.seq += 1
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+async def replay(reader, host, port, text_port, room, speed=1.0, start=None, end=None):
+    # Plays a recording into a live room: each recorded speaker gets a voice connection
+    # of their own, and the chat is re-posted through one text connection
+    rate = reader.metadata['rate']
+    chunk = reader.metadata['chunk']
+    names = {}
+    voices = {}
+    text_writer = text_task = None
+    loop = asyncio.get_running_loop()
+    origin = None
+    began = loop.time()
+    try:
+        for timestamp, speaker, kind, payload in reader.records(start, end):
+            if kind == SPEAKER:
+                names[speaker] = bytes(payload).decode()
+                continue
+            if origin is None:
+                origin = timestamp
+            delay = began + (timestamp - origin) / 1e6 / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if kind == AUDIO:
+                voice = voices.get(speaker)
+                if voice is None:
+                    voice = voices[speaker] = ReplayVoice(f"{names.get(speaker, f'Speaker {speaker}')} (recorded)")
+                    await voice.connect(host, port, room, rate, chunk)
+                voice.send(payload)
+            elif kind == TEXT:
+                message = json.loads(bytes(payload))
+                if text_writer is None:
+                    text_reader, text_writer = await asyncio.open_connection(host, text_port)
+                    text_writer.write(pack_text({'type': 'join', 'room': room, 'name': REPLAY_NAME, 'history': 0}))
+                    await asyncio.wait_for(TextReader(text_reader).read(), HANDSHAKE_TIMEOUT)
+                    text_task = asyncio.create_task(_discard(text_reader))
+                text_writer.write(pack_text({'type': 'message', 'text': f"{message['sender']}: {message['text']}"}))
+    finally:
+        for voice in voices.values():
+            voice.close()
+        if text_task:
+            text_task.cancel()
+        if text_writer:
+            text_writer.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect, render or replay a SynConnect room recording")
+    commands = parser.add_subparsers(dest='command', required=True)
+    info = commands.add_parser('info', help="print what a recording holds")
+    info.add_argument('recording')
+    render = commands.add_parser('render', help="mix a recording down to a WAV file")
+    render.add_argument('recording')
+    render.add_argument('output', help="WAV file to write")
+    play = commands.add_parser('play', help="play a recording into a room on a running relay")
+    play.add_argument('recording')
+    play.add_argument('--room', help="room to play into (default: the recorded room)")
+    play.add_argument('--host', default=HOST, help="relay address (default: %(default)s)")
+    play.add_argument('--port', type=int, default=PORT, help="voice port (default: %(default)s)")
+    play.add_argument('--text-port', type=int, default=TEXT_PORT, help="text port (default: %(default)s)")
+    play.add_argument('--speed', type=float, default=1.0,
+                      help="playback speed; above 1 the relay drops audio it cannot mix in time")
+    for command in (render, play):
+        command.add_argument('--start', type=float, help="seconds into the recording to start from")
+        command.add_argument('--end', type=float, help="seconds into the recording to stop at")
+    args = parser.parse_args(argv)
+    if args.command == 'play' and args.speed <= 0:
+        parser.error("--speed must be positive")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        reader = RecordingReader(args.recording)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    try:
+        if args.command == 'info':
+            print(json.dumps(describe(reader), indent=2))
+        elif args.command == 'render':
+            started = time.perf_counter()
+            seconds = render_wav(reader, args.output, offset_us(reader, args.start), offset_us(reader, args.end))
+            elapsed = time.perf_counter() - started
+            print(f"Rendered {seconds:.1f} s of audio in {elapsed:.1f} s to {args.output}", file=sys.stderr)
+        else:
+            asyncio.run(replay(reader, args.host, args.port, args.text_port, args.room or reader.metadata['room'],
+                               args.speed, offset_us(reader, args.start), offset_us(reader, args.end)))
+    except (OSError, ProtocolError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        reader.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,45 @@
+import numpy as np
+
+FILTER_TAPS = 31
+
+
+class Resampler:
+    # Streaming int16 resampler: windowed-sinc low-pass when downsampling, then linear
+    # interpolation. Filter history and interpolation phase carry over between calls,
+    # so consecutive frames join without clicks.
+    def __init__(self, src_rate, dst_rate):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        self.step = src_rate / dst_rate
+        self.position = 1.0
+        self.last = 0.0
+        self.taps = None
+        self.history = None
+        if dst_rate < src_rate:
+            cutoff = 0.45 * dst_rate / src_rate
+            n = np.arange(FILTER_TAPS) - (FILTER_TAPS - 1) / 2
+            taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(FILTER_TAPS)
+            self.taps = (taps / taps.sum()).astype(np.float32)
+            self.history = np.zeros(FILTER_TAPS - 1, dtype=np.float32)
+
+    def process(self, pcm):
+        if self.src_rate == self.dst_rate:
+            return bytes(pcm)
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+        if self.taps is not None:
+            padded = np.concatenate((self.history, samples))
+            self.history = padded[-(FILTER_TAPS - 1):]
+            samples = np.convolve(padded, self.taps, mode='valid')
+        # Index 0 is the last sample of the previous call
+        source = np.concatenate(([self.last], samples))
+        end = len(source) - 1
+        if self.position > end:
+            self.position -= len(samples)
+            self.last = source[-1]
+            return b''
+        count = int((end - self.position) // self.step) + 1
+        points = self.position + np.arange(count) * self.step
+        output = np.interp(points, np.arange(len(source)), source)
+        self.position = points[-1] + self.step - end
+        self.last = source[-1]
+        return np.clip(np.rint(output), -32768, 32767).astype(np.int16).tobytes()
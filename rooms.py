@@ -0,0 +1,94 @@
+import collections
+
+from audio_mixer import AudioMixer
+from metrics import TICK_BUCKETS, Histogram
+
+DEFAULT_ROOM = 'lobby'
+MAX_ROOM_ID = 64
+REPLAY_MESSAGES = 50  # recent chat kept in memory for clients that reconnect
+
+
+def normalize_room_id(room_id):
+    # Returns the canonical room id, or None if the client sent something unusable
+    if not isinstance(room_id, str):
+        return None
+    room_id = room_id.strip()
+    if not room_id or len(room_id) > MAX_ROOM_ID:
+        return None
+    return room_id
+
+
+class Room:
+    def __init__(self, room_id, chunk, rate, max_speakers=None):
+        self.id = room_id
+        self.mixer = AudioMixer(chunk, rate, max_speakers=max_speakers)
+        self.speakers = ()  # the audible speakers last announced to the room
+        self.voice_members = set()
+        self.text_members = set()
+        self.mix_time = Histogram(TICK_BUCKETS)
+        self.recent = collections.deque(maxlen=REPLAY_MESSAGES)
+        self.recent_floor = 0  # id of the newest message that has fallen out of recent
+
+    def is_empty(self):
+        return not self.voice_members and not self.text_members
+
+    def remember(self, message):
+        if len(self.recent) == self.recent.maxlen:
+            self.recent_floor = self.recent[0]['id']
+        self.recent.append(message)
+
+    def replay(self, since):
+        # Messages newer than the id `since`, and whether that is all of them
+        return [message for message in self.recent if message['id'] > since], since >= self.recent_floor
+
+
+class RoomRegistry:
+    # Rooms are created on first join and dropped when the last member leaves. Every
+    # connection points back at its room, so joins, leaves and routing are all O(1).
+    def __init__(self, chunk, rate, on_change=None, max_speakers=None):
+        self.chunk = chunk
+        self.rate = rate
+        self.max_speakers = max_speakers
+        self.on_change = on_change
+        self.rooms = {}
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def get(self, room_id):
+        return self.rooms.get(room_id)
+
+    def join(self, conn, room_id, voice=True):
+        if conn.room is not None:
+            self.leave(conn)
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = Room(room_id, self.chunk, self.rate, self.max_speakers)
+        if voice:
+            room.voice_members.add(conn)
+            room.mixer.add_client(conn)
+        else:
+            room.text_members.add(conn)
+        conn.room = room
+        self._changed(room)
+        return room
+
+    def leave(self, conn):
+        room = conn.room
+        if room is None:
+            return
+        conn.room = None
+        room.voice_members.discard(conn)
+        room.text_members.discard(conn)
+        room.mixer.remove_client(conn)
+        if room.is_empty():
+            del self.rooms[room.id]
+        self._changed(room)
+
+    def presence(self):
+        return {room.id: {'voice': len(room.voice_members), 'text': len(room.text_members)}
+                for room in self.rooms.values()}
+
+    def _changed(self, room):
+        if self.on_change:
+            self.on_change(room.id, len(room.voice_members), len(room.text_members))
@@ -0,0 +1,38 @@
+import asyncio
+import collections
+
+
+class SendQueue:
+    # Bounded per-recipient outbound queue. Producers never wait: for audio the oldest
+    # frame is discarded when full (stale audio is worthless), for text put() fails and
+    # the caller decides what to do with the slow reader.
+    def __init__(self, maxsize, drop_oldest=True):
+        self.maxsize = maxsize
+        self.drop_oldest = drop_oldest
+        self.frames = collections.deque()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame):
+        if len(self.frames) >= self.maxsize:
+            if not self.drop_oldest:
+                return False
+            self.frames.popleft()
+            self.dropped += 1
+        self.frames.append(frame)
+        if len(self.frames) > self.high_water:
+            self.high_water = len(self.frames)
+        self.ready.set()
+        return True
+
+    async def get_batch(self, limit):
+        # Everything queued while the previous write was draining goes out together
+        while not self.frames:
+            self.ready.clear()
+            await self.ready.wait()
+        count = min(limit, len(self.frames))
+        return [self.frames.popleft() for _ in range(count)]
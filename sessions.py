@@ -0,0 +1,70 @@
+import secrets
+
+RESUME_WINDOW = 30.0  # seconds a dropped client has to come back and keep its place
+
+
+class Session:
+    __slots__ = ('token', 'conn', 'slot', 'room_id', 'voice', 'name', 'expires')
+
+    def __init__(self, token, conn, room_id, voice):
+        self.token = token
+        self.conn = conn
+        self.slot = conn.id
+        self.room_id = room_id
+        self.voice = voice
+        self.name = conn.name
+        self.expires = None
+
+
+class SessionTable:
+    # Every joined connection gets a token. When the connection drops (rather than being
+    # closed by the client), its session is parked with its slot held for it, and a client that reconnects with the token
+    # inside the window gets the same slot, room and name back. Loop thread only.
+    def __init__(self, window=RESUME_WINDOW):
+        self.window = window
+        self.sessions = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def open(self, conn, room_id, voice):
+        if conn.session is not None:
+            # Re-joining on a live connection replaces its session
+            self.sessions.pop(conn.session, None)
+        token = secrets.token_urlsafe(16)
+        session = self.sessions[token] = Session(token, conn, room_id, voice)
+        conn.session = token
+        return session
+
+    def park(self, conn, now):
+        # Returns the session if conn was the live connection of one
+        session = self.sessions.get(conn.session)
+        if session is None or session.conn is not conn:
+            return None
+        session.conn = None
+        session.expires = now + self.window
+        return session
+
+    def resume(self, token, room_id, voice):
+        # A session is only resumed into the room and kind of connection it was opened for
+        session = self.sessions.get(token) if isinstance(token, str) else None
+        if session is None or session.room_id != room_id or session.voice != voice:
+            return None
+        return session
+
+    def attach(self, session, conn):
+        session.conn = conn
+        session.expires = None
+        conn.session = session.token
+
+    def expire(self, now):
+        expired = [session for session in self.sessions.values()
+                   if session.expires is not None and session.expires <= now]
+        for session in expired:
+            del self.sessions[session.token]
+        return expired
+
+    def close(self, conn):
+        session = self.sessions.get(conn.session)
+        if session is not None and session.conn is conn:
+            del self.sessions[session.token]
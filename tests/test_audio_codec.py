@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import audio_codec
+from audio_codec import AdpcmCodec, PcmCodec, adpcm_decode, adpcm_encode, negotiate_codec
+from audio_protocol import ProtocolError
+
+CHUNK = 320
+
+
+def tone(seconds=0.2, rate=16000, freq=440, amplitude=8000):
+    t = np.arange(int(seconds * rate))
+    return (np.sin(2 * np.pi * freq * t / rate) * amplitude).astype(np.int16)
+
+
+def snr_db(reference, decoded):
+    noise = reference.astype(np.float64) - decoded.astype(np.float64)
+    return 10 * np.log10(np.sum(reference.astype(np.float64) ** 2) / np.sum(noise ** 2))
+
+
+def encode_frames(codec, samples):
+    return [codec.encode(samples[offset:offset + CHUNK].tobytes()) for offset in range(0, len(samples), CHUNK)]
+
+
+def test_adpcm_round_trip_stays_close_to_the_input():
+    samples = tone()
+    encoder, decoder = AdpcmCodec(16000, CHUNK), AdpcmCodec(16000, CHUNK)
+    payloads = encode_frames(encoder, samples)
+    assert all(len(payload) == CHUNK // 2 + 4 for payload in payloads)
+    decoded = np.frombuffer(b''.join(decoder.decode(payload) for payload in payloads), dtype=np.int16)
+    assert len(decoded) == len(samples)
+    assert snr_db(samples, decoded) > 20
+
+
+def test_adpcm_frames_decode_independently():
+    payloads = encode_frames(AdpcmCodec(16000, CHUNK), tone())
+    in_order = [AdpcmCodec(16000, CHUNK).decode(payload) for payload in payloads]
+    # A fresh decoder given only the last frame produces the same audio
+    assert AdpcmCodec(16000, CHUNK).decode(payloads[-1]) == in_order[-1]
+
+
+def test_pure_python_adpcm_matches_audioop():
+    if audio_codec.audioop is None:
+        pytest.skip("audioop is not available")
+    pcm = tone(0.02).tobytes()
+    data, state = adpcm_encode(pcm, 0, 0)
+    assert (data, state) == audio_codec.audioop.lin2adpcm(pcm, 2, (0, 0))
+    assert adpcm_decode(data, 0, 0) == audio_codec.audioop.adpcm2lin(data, 2, (0, 0))[0]
+
+
+def test_adpcm_rejects_malformed_frames():
+    codec = AdpcmCodec(16000, CHUNK)
+    with pytest.raises(ProtocolError):
+        codec.decode(b'\x00')
+    with pytest.raises(ProtocolError):
+        codec.decode(b'\x00\x00\x59\x00' + bytes(CHUNK // 2))
+
+
+def test_pcm_is_passed_through():
+    pcm = tone(0.02).tobytes()
+    codec = PcmCodec(16000, CHUNK)
+    assert codec.decode(codec.encode(memoryview(pcm))) == pcm
+
+
+def test_negotiation_takes_the_first_codec_both_sides_have():
+    assert negotiate_codec(['nonsense', 'adpcm', 'pcm16'], 16000, CHUNK) == 'adpcm'
+    assert negotiate_codec(['nonsense'], 16000, CHUNK) == 'pcm16'
+    # ADPCM packs two samples per byte, so odd frame sizes fall back to PCM
+    assert negotiate_codec(['adpcm'], 16000, 321) == 'pcm16'
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from audio_config import validate_audio_params
+from audio_protocol import MAX_PAYLOAD
+from resampler import Resampler
+
+
+@pytest.mark.parametrize('rate, chunk', [(16000, 320), (48000, 960), (8000, 20)])
+def test_accepts_usable_rates_and_frames(rate, chunk):
+    assert validate_audio_params(rate, chunk, MAX_PAYLOAD) is None
+
+
+@pytest.mark.parametrize('rate, chunk', [
+    (16000, 320.5),  # a float frame size once crashed the mixer
+    (16000.0, 320),
+    (True, 320),
+    (16000, '320'),
+    (12345, 320),  # unsupported rate
+    (16000, 8),  # 0.5 ms frames
+    (8000, 8000),  # 1 s frames
+    (48000, 5760),  # 120 ms, but larger than a packet
+])
+def test_rejects_unusable_params(rate, chunk):
+    assert isinstance(validate_audio_params(rate, chunk, MAX_PAYLOAD), str)
+
+
+def resample(src_rate, dst_rate, samples, chunk):
+    resampler = Resampler(src_rate, dst_rate)
+    out = b''.join(resampler.process(samples[offset:offset + chunk].tobytes())
+                   for offset in range(0, len(samples), chunk))
+    return np.frombuffer(out, dtype=np.int16)
+
+
+def dominant_frequency(samples, rate):
+    spectrum = np.abs(np.fft.rfft(samples * np.hanning(len(samples))))
+    return np.argmax(spectrum) * rate / len(samples)
+
+
+@pytest.mark.parametrize('src_rate, dst_rate', [(48000, 16000), (16000, 48000), (44100, 16000), (8000, 11025)])
+def test_resampling_keeps_length_and_pitch_across_frames(src_rate, dst_rate):
+    t = np.arange(src_rate)  # one second
+    samples = (np.sin(2 * np.pi * 440 * t / src_rate) * 8000).astype(np.int16)
+    out = resample(src_rate, dst_rate, samples, src_rate // 50)
+    assert abs(len(out) - dst_rate) <= 2
+    assert abs(dominant_frequency(out[dst_rate // 10:], dst_rate) - 440) < 5
+
+
+def test_downsampling_filters_out_what_no_longer_fits():
+    t = np.arange(48000)
+    samples = (np.sin(2 * np.pi * 12000 * t / 48000) * 8000).astype(np.int16)
+    out = resample(48000, 16000, samples, 960)
+    assert np.abs(out[1600:]).max() < 800
+
+
+def test_same_rate_is_a_copy():
+    pcm = np.arange(320, dtype=np.int16).tobytes()
+    assert Resampler(16000, 16000).process(pcm) == pcm
@@ -0,0 +1,64 @@
+import numpy as np
+
+from audio_mixer import AudioMixer, frame_level, level_power
+
+CHUNK = 160
+
+
+def tone(amplitude):
+    return (np.sin(np.arange(CHUNK) / 3) * amplitude).astype(np.int16).tobytes()
+
+
+def samples(frame):
+    return np.frombuffer(frame, dtype=np.int16)
+
+
+def test_each_speaker_hears_everyone_but_themselves():
+    mixer = AudioMixer(CHUNK, 8000, jitter_frames=1)
+    for key in 'abc':
+        mixer.add_client(key)
+    mixer.push('a', tone(1000))
+    mixer.push('b', tone(2000))
+    room_mix, outputs = mixer.mix()
+    assert np.array_equal(samples(room_mix), samples(tone(1000)) + samples(tone(2000)))
+    assert outputs['a'] == tone(2000)
+    assert outputs['b'] == tone(1000)
+    assert outputs['c'] == room_mix
+
+
+def test_selective_mixing_decodes_only_the_loudest():
+    mixer = AudioMixer(CHUNK, 8000, jitter_frames=1, max_speakers=2)
+    decoded = []
+
+    def decoder(key):
+        def decode(payload):
+            decoded.append(key)
+            return payload
+        return decode
+
+    for key in range(6):
+        mixer.add_client(key)
+    for tick in range(10):
+        for key in range(6):
+            frame = tone(500 * (key + 1))
+            mixer.push_encoded(key, frame, frame_level(frame), decoder(key))
+        mixer.mix()
+    assert set(mixer.speakers) == {4, 5}
+    assert set(decoded) == {4, 5}
+
+
+def test_undecodable_frames_are_concealed_not_mixed():
+    mixer = AudioMixer(CHUNK, 8000, jitter_frames=1, max_speakers=1)
+    mixer.add_client('a')
+    mixer.push_encoded('a', tone(1000), 40, bytes)
+    mixer.mix()
+    mixer.push_encoded('a', b'short', 40, bytes)
+    room_mix, outputs = mixer.mix()
+    assert len(room_mix) == CHUNK * 2
+
+
+def test_level_bytes_follow_the_frame_power():
+    assert frame_level(bytes(CHUNK * 2)) == 254
+    assert frame_level(tone(32767)) <= 4
+    assert frame_level(tone(3276)) - frame_level(tone(32767)) == 20
+    assert level_power(0) > level_power(10) > level_power(254)
@@ -0,0 +1,74 @@
+import pytest
+
+from audio_protocol import (CODEC_ADPCM, CODEC_PCM16, HEADER, LEVEL_UNKNOWN, FrameParser, FrameWriter, ProtocolError,
+                            SequenceTracker, pack_frame, unpack_frame)
+
+
+def collect():
+    frames = []
+    parser = FrameParser(lambda header, payload: frames.append((header, bytes(payload))), max_payload=64)
+    return parser, frames
+
+
+def test_parser_reassembles_frames_split_anywhere():
+    data = b''.join(pack_frame(bytes([seq]) * (seq + 1), 7, seq, 1000 + seq) for seq in range(5))
+    parser, frames = collect()
+    for offset in range(0, len(data), 3):
+        parser.feed(data[offset:offset + 3])
+    assert [header.seq for header, payload in frames] == [0, 1, 2, 3, 4]
+    assert [payload for header, payload in frames] == [bytes([seq]) * (seq + 1) for seq in range(5)]
+    assert all(header.sender_id == 7 for header, payload in frames)
+
+
+def test_parser_rejects_oversized_frames():
+    parser, frames = collect()
+    with pytest.raises(ProtocolError):
+        parser.feed(pack_frame(bytes(65), 0, 0, 0))
+
+
+def test_parser_pause_keeps_the_rest_for_later():
+    parser, frames = collect()
+    parser.feed(pack_frame(b'a', 0, 0, 0))
+    parser.pause()
+    parser.feed(pack_frame(b'b', 0, 1, 0) + pack_frame(b'c', 0, 2, 0)[:5])
+    assert [payload for header, payload in frames] == [b'a']
+    assert parser.remaining() == pack_frame(b'b', 0, 1, 0) + pack_frame(b'c', 0, 2, 0)[:5]
+    parser.resume()
+    assert [payload for header, payload in frames] == [b'a', b'b']
+
+
+def test_unpack_frame_checks_the_datagram_length():
+    header, payload = unpack_frame(pack_frame(b'abc', 1, 2, 3, CODEC_ADPCM, 40))
+    assert (header.seq, header.codec, header.level, bytes(payload)) == (2, CODEC_ADPCM, 40, b'abc')
+    with pytest.raises(ProtocolError):
+        unpack_frame(pack_frame(b'abc', 1, 2, 3) + b'x')
+    with pytest.raises(ProtocolError):
+        unpack_frame(b'short')
+
+
+def test_frame_writer_numbers_frames_and_defaults_the_level():
+    writer = FrameWriter(sender_id=9)
+    first = bytes(writer.pack(b'one', timestamp=5))
+    second = bytes(writer.pack(b'two', timestamp=6, codec=CODEC_PCM16, level=12))
+    assert unpack_frame(first)[0].seq == 0
+    assert unpack_frame(first)[0].level == LEVEL_UNKNOWN
+    header, payload = unpack_frame(second)
+    assert (header.sender_id, header.seq, header.level, bytes(payload)) == (9, 1, 12, b'two')
+    assert len(second) == HEADER.size + 3
+
+
+def test_sequence_tracker_counts_gaps_and_late_frames():
+    tracker = SequenceTracker()
+    assert tracker.update(10) == 0
+    assert tracker.update(11) == 0
+    assert tracker.update(14) == 2
+    assert tracker.update(12) == -1
+    assert (tracker.received, tracker.lost, tracker.late) == (4, 2, 1)
+
+
+def test_sequence_tracker_wraps_around():
+    tracker = SequenceTracker()
+    tracker.update(0xFFFFFFFE)
+    assert tracker.update(0xFFFFFFFF) == 0
+    assert tracker.update(1) == 1
+    assert tracker.update(0xFFFFFFFF) == -1
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+from connection_table import ConnectionTable
+
+
+def connection():
+    return SimpleNamespace(id=0)
+
+
+def test_slots_are_stable_and_reused_oldest_first():
+    table = ConnectionTable()
+    a, b, c = connection(), connection(), connection()
+    assert [table.add(conn) for conn in (a, b, c)] == [1, 2, 3]
+    table.remove(b)
+    table.remove(a)
+    assert c.id == 3 and len(table) == 1
+    assert table.add(connection()) == 2
+    assert table.add(connection()) == 1
+    assert not table.remove(a)
+
+
+def test_snapshot_is_rebuilt_only_after_a_change():
+    table = ConnectionTable()
+    a, b = connection(), connection()
+    table.add(a)
+    first = table.snapshot()
+    assert table.snapshot() is first
+    table.add(b)
+    assert table.snapshot() == (a, b)
+    assert first == (a,)
+    assert a in table and list(table) == [a, b]
+
+
+def test_held_slots_wait_for_their_owner():
+    table = ConnectionTable()
+    old = connection()
+    table.add(old)
+    table.remove(old, hold=True)
+    newcomer = connection()
+    assert table.add(newcomer) == 2
+    back = connection()
+    table.add(back)
+    assert table.claim(back, 1)
+    assert back.id == 1 and table.get(1) is back
+    # The slot it arrived in is free again, the held one is not
+    assert table.add(connection()) == 3
+    assert not table.claim(connection(), 1)
+
+
+def test_released_slots_become_free():
+    table = ConnectionTable()
+    conn = connection()
+    table.add(conn)
+    table.remove(conn, hold=True)
+    table.release(1)
+    assert table.add(connection()) == 1
@@ -0,0 +1,38 @@
+from history import HistoryStore
+
+
+def test_pages_come_newest_first_in_oldest_first_order(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.sqlite3'))
+    ids = [store.append('lobby', 'ada', index, f"message {index}") for index in range(5)]
+    store.append('other', 'bob', 9, 'elsewhere')
+    messages, more = store.page('lobby', limit=2)
+    assert [message['id'] for message in messages] == ids[3:]
+    assert more
+    messages, more = store.page('lobby', before=ids[3], limit=10)
+    assert [message['text'] for message in messages] == ['message 0', 'message 1', 'message 2']
+    assert not more
+    store.close()
+
+
+def test_messages_are_paged_before_and_after_they_are_written(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.sqlite3'))
+    first = store.append('lobby', 'ada', 1, 'hello')
+    assert [message['id'] for message in store.page('lobby')[0]] == [first]
+    store.flush()
+    assert not store.unwritten
+    assert [message['text'] for message in store.page('lobby')[0]] == ['hello']
+    store.close()
+
+
+def test_workers_sharing_a_file_never_reuse_ids(tmp_path):
+    path = str(tmp_path / 'history.sqlite3')
+    first, second = HistoryStore(path, 0, 2), HistoryStore(path, 1, 2)
+    ids = [first.append('a', 'x', 0, 'one'), second.append('b', 'y', 0, 'two'),
+           first.append('a', 'x', 1, 'three'), second.append('b', 'y', 1, 'four')]
+    first.close()
+    second.close()
+    assert len(set(ids)) == 4
+    reopened = HistoryStore(path)
+    assert reopened.append('a', 'x', 2, 'five') > max(ids)
+    assert [message['text'] for message in reopened.page('a')[0]] == ['one', 'three', 'five']
+    reopened.close()
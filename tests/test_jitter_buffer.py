@@ -0,0 +1,84 @@
+from jitter_buffer import JitterBuffer
+
+FRAME = 0.02
+
+
+def frame(seq):
+    return bytes([seq % 256]) * 4
+
+
+def put(buffer, seq):
+    # Arrivals come back to back, so the jitter estimate and target depth stay minimal
+    buffer.put(seq & 0xFFFFFFFF, 0, frame(seq))
+
+
+def test_waits_for_the_target_depth_then_plays_in_order():
+    buffer = JitterBuffer(FRAME)
+    put(buffer, 0)
+    assert buffer.get() is None
+    put(buffer, 2)
+    put(buffer, 1)
+    assert [buffer.get() for _ in range(3)] == [frame(0), frame(1), frame(2)]
+
+
+def test_drops_frames_older_than_the_playout_point():
+    buffer = JitterBuffer(FRAME)
+    for seq in range(3):
+        put(buffer, seq)
+    buffer.get()
+    buffer.get()
+    put(buffer, 0)
+    assert buffer.stats()['late'] == 1
+    assert buffer.get() == frame(2)
+
+
+def test_conceals_a_single_lost_frame():
+    buffer = JitterBuffer(FRAME)
+    for seq in (0, 1, 3):
+        put(buffer, seq)
+    assert buffer.get() == frame(0)
+    assert buffer.get() == frame(1)
+    concealed = buffer.get()
+    assert concealed is not None and concealed != frame(2)
+    assert buffer.get() == frame(3)
+    assert buffer.stats()['lost'] == 1
+
+
+def test_resumes_from_the_oldest_frame_after_starving():
+    buffer = JitterBuffer(FRAME)
+    for seq in range(4):
+        put(buffer, seq)
+        buffer.get()
+    for _ in range(50):  # a second without packets
+        buffer.get()
+    lost = buffer.stats()['lost']
+    put(buffer, 54)
+    put(buffer, 55)
+    assert buffer.get() == frame(54)
+    assert buffer.get() == frame(55)
+    assert buffer.stats()['lost'] == lost
+
+
+def test_resumes_across_sequence_wraparound():
+    buffer = JitterBuffer(FRAME)
+    put(buffer, 0xFFFFFFF0)
+    put(buffer, 0xFFFFFFF1)
+    buffer.get()
+    buffer.get()
+    buffer.get()  # starves
+    put(buffer, 0x100000002)
+    put(buffer, 0x100000001)
+    assert buffer.get() == frame(0x100000001)
+    assert buffer.get() == frame(0x100000002)
+
+
+def test_resync_accepts_a_restarted_sequence():
+    buffer = JitterBuffer(FRAME)
+    for seq in range(100, 103):
+        put(buffer, seq)
+        buffer.get()
+    buffer.resync()
+    put(buffer, 0)
+    put(buffer, 1)
+    assert buffer.get() == frame(0)
+    assert buffer.stats()['late'] == 0
@@ -0,0 +1,103 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import recording
+from recording import AUDIO, SPEAKER, TEXT, ArchiveWriter, Recorder, RecordingReader
+
+METADATA = {'room': 'lecture', 'rate': 16000, 'chunk': 320, 'started': 1000}
+
+
+def write_archive(path, records, chunk_size=4, close=True):
+    archive = ArchiveWriter(path, METADATA)
+    for index, record in enumerate(records):
+        archive.add(*record)
+        if (index + 1) % chunk_size == 0:
+            archive.flush()
+    if close:
+        archive.close()
+    else:
+        archive.flush()
+        archive.file.close()
+
+
+def audio_records(count, start=1000, step=20000):
+    return [(start + index * step, 1 + index % 2, AUDIO, bytes([index]) * 640) for index in range(count)]
+
+
+def test_round_trip_keeps_every_record(tmp_path):
+    path = str(tmp_path / 'room.synrec')
+    records = audio_records(10) + [(300000, 0, TEXT, b'{"sender":"a","text":"hi"}')]
+    write_archive(path, records)
+    reader = RecordingReader(path)
+    assert reader.metadata == METADATA
+    assert len(reader.index) == 3
+    assert [(t, s, k, bytes(p)) for t, s, k, p in reader.records()] == records
+    assert reader.ended == 300000
+    reader.close()
+
+
+def test_seeking_reads_only_the_requested_span(tmp_path):
+    path = str(tmp_path / 'room.synrec')
+    records = audio_records(20)
+    write_archive(path, records)
+    reader = RecordingReader(path)
+    span = [timestamp for timestamp, speaker, kind, payload in reader.records(start=101000, end=201000)]
+    assert span == [timestamp for timestamp, *rest in records if 101000 <= timestamp <= 201000]
+    reader.close()
+
+
+def test_an_archive_without_its_index_is_rebuilt_by_scanning(tmp_path):
+    path = str(tmp_path / 'room.synrec')
+    records = audio_records(10)
+    write_archive(path, records, close=False)
+    # A crash in the middle of writing the next chunk leaves a partial header behind
+    with open(path, 'ab') as file:
+        file.write(recording.CHUNK_MAGIC + b'\x00\x00')
+    reader = RecordingReader(path)
+    assert len(reader.index) == 3
+    assert [timestamp for timestamp, *rest in reader.records()] == [timestamp for timestamp, *rest in records]
+    reader.close()
+
+
+def test_other_files_are_refused(tmp_path):
+    path = tmp_path / 'notes.txt'
+    path.write_bytes(b'just some text')
+    with pytest.raises(ValueError):
+        RecordingReader(str(path))
+
+
+def test_recorder_writes_one_archive_per_room(tmp_path):
+    recorder = Recorder(str(tmp_path), 16000, 320)
+    recorder.start()
+    alice = SimpleNamespace(id=1, name='alice')
+    bob = SimpleNamespace(id=2, name='bob')
+    for tick in range(5):
+        recorder.audio('lecture', alice, bytes(640))
+        recorder.audio('seminar', bob, bytes(640))
+        recorder.tick()
+    recorder.text('lecture', 5, 'alice', 'question')
+    recorder.close_room('seminar')
+    recorder.tick()
+    recorder.close()
+    assert recorder.recorded == 14 and recorder.dropped == 0
+    paths = sorted(os.listdir(tmp_path))
+    assert [name.split('-')[0] for name in paths] == ['lecture', 'seminar']
+    reader = RecordingReader(str(tmp_path / paths[0]))
+    kinds = [kind for timestamp, speaker, kind, payload in reader.records()]
+    assert kinds == [SPEAKER] + [AUDIO] * 5 + [TEXT]
+    texts = [json.loads(bytes(payload)) for timestamp, speaker, kind, payload in reader.records() if kind == TEXT]
+    assert texts == [{'sender': 'alice', 'text': 'question'}]
+    reader.close()
+
+
+def test_recorder_drops_ticks_instead_of_waiting(tmp_path):
+    recorder = Recorder(str(tmp_path), 16000, 320, queue_size=2)  # writer never started
+    conn = SimpleNamespace(id=1, name='alice')
+    for tick in range(4):
+        recorder.audio('lecture', conn, bytes(640))
+        recorder.tick()
+    assert recorder.dropped == 2
+    assert recorder.recorded == 3  # the first tick also carried the speaker's name
@@ -0,0 +1,23 @@
+import collections
+
+from relay_cluster import HashRing
+
+ROOMS = [f"room {index}" for index in range(2000)]
+
+
+def test_rooms_always_land_on_the_same_worker():
+    ring, again = HashRing(range(4)), HashRing(range(4))
+    assert [ring.node_for(room) for room in ROOMS] == [again.node_for(room) for room in ROOMS]
+
+
+def test_rooms_spread_over_every_worker():
+    counts = collections.Counter(HashRing(range(4)).node_for(room) for room in ROOMS)
+    assert set(counts) == {0, 1, 2, 3}
+    assert min(counts.values()) > len(ROOMS) / 4 / 2
+
+
+def test_adding_a_worker_only_moves_rooms_onto_it():
+    before, after = HashRing(range(4)), HashRing(range(5))
+    moved = [room for room in ROOMS if before.node_for(room) != after.node_for(room)]
+    assert {after.node_for(room) for room in moved} == {4}
+    assert len(moved) < len(ROOMS) / 3
@@ -0,0 +1,242 @@
+import asyncio
+import socket
+import struct
+
+import numpy as np
+
+from audio_protocol import (CODEC_CONTROL, CODEC_PCM16, HEADER, FrameHeader, decode_control, encode_control,
+                            pack_frame, unpack_frame)
+from relay_server import WELCOME_RETRY, RelayServer
+from text_protocol import TextReader, pack_text
+
+CHUNK = 320
+RATE = 16000
+
+
+async def start_relay(udp=False):
+    relay = RelayServer('127.0.0.1', 0, 0, CHUNK, RATE, udp=udp)
+    await relay.start()
+    relay.port = relay.voice_server.sockets[0].getsockname()[1]
+    relay.text_port = relay.text_server.sockets[0].getsockname()[1]
+    return relay
+
+
+class VoiceClient:
+    @classmethod
+    async def connect(cls, relay, **hello):
+        client = cls()
+        client.reader, client.writer = await asyncio.open_connection('127.0.0.1', relay.port)
+        client.seq = 0
+        client.send_control({'type': 'hello', 'rate': RATE, 'chunk': CHUNK, **hello})
+        client.welcome = await client.read_control()
+        return client
+
+    def send_control(self, message):
+        self.writer.write(pack_frame(encode_control(message), 0, 0, 0, CODEC_CONTROL))
+
+    def send_audio(self, pcm):
+        self.writer.write(pack_frame(pcm, 0, self.seq, 0, CODEC_PCM16))
+        self.seq += 1
+
+    async def read_frame(self):
+        header = FrameHeader._make(HEADER.unpack(await self.reader.readexactly(HEADER.size)))
+        return header, await self.reader.readexactly(header.length)
+
+    async def read_control(self):
+        while True:
+            header, payload = await asyncio.wait_for(self.read_frame(), 2.0)
+            if header.codec == CODEC_CONTROL:
+                return decode_control(payload)
+
+    async def loudest(self, ticks):
+        # Peak sample over the next `ticks` audio frames, 0 if nothing arrived
+        peak = 0
+        for _ in range(ticks):
+            try:
+                header, payload = await asyncio.wait_for(self.read_frame(), 0.1)
+            except asyncio.TimeoutError:
+                break
+            if header.codec == CODEC_PCM16:
+                peak = max(peak, int(np.abs(np.frombuffer(payload, dtype=np.int16)).max()))
+        return peak
+
+    def close(self):
+        self.writer.close()
+
+
+async def text_client(relay, **join):
+    reader, writer = await asyncio.open_connection('127.0.0.1', relay.text_port)
+    writer.write(pack_text({'type': 'join', **join}))
+    reader = TextReader(reader)
+    joined = await asyncio.wait_for(reader.read(), 2.0)
+    assert joined['type'] == 'joined'
+    return reader, writer, joined
+
+
+async def next_of_type(reader, kind):
+    while True:
+        message = await asyncio.wait_for(reader.read(), 2.0)
+        if message['type'] == kind:
+            return message
+
+
+def tone(amplitude=8000):
+    return (np.sin(np.arange(CHUNK) / 4) * amplitude).astype(np.int16).tobytes()
+
+
+def drop(writer):
+    # Close with a reset, the way a dead network link looks to the relay
+    writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    writer.transport.abort()
+
+
+def test_hello_is_welcomed_into_its_room():
+    async def run():
+        relay = await start_relay()
+        try:
+            client = await VoiceClient.connect(relay, room=' lecture ', name='Ada', codecs=['no-such-codec', 'adpcm'])
+            welcome = client.welcome
+            assert welcome['type'] == 'welcome'
+            assert (welcome['room'], welcome['codec']) == ('lecture', 'adpcm')
+            assert (welcome['rate'], welcome['chunk']) == (RATE, CHUNK)
+            assert not welcome['resumed'] and welcome['session']
+            assert relay.presence() == {'lecture': {'voice': 1, 'text': 0}}
+            client.close()
+        finally:
+            await relay.stop()
+    asyncio.run(run())
+
+
+def test_unusable_hellos_get_an_error_and_no_room():
+    async def run():
+        relay = await start_relay()
+        try:
+            for hello in ({'rate': 12345}, {'room': ''}, {'codecs': 5}, {'codecs': None}):
+                client = await VoiceClient.connect(relay, **hello)
+                assert client.welcome['type'] == 'error'
+                client.close()
+            assert relay.presence() == {}
+        finally:
+            await relay.stop()
+    asyncio.run(run())
+
+
+def test_audio_and_chat_stay_inside_their_room():
+    async def run():
+        relay = await start_relay()
+        try:
+            speaker = await VoiceClient.connect(relay, room='lecture')
+            listener = await VoiceClient.connect(relay, room='lecture')
+            elsewhere = await VoiceClient.connect(relay, room='seminar')
+            for _ in range(10):
+                speaker.send_audio(tone())
+            assert await listener.loudest(20) > 4000
+            assert await elsewhere.loudest(20) == 0
+            author = await text_client(relay, room='lecture', name='Ada')
+            reader, writer, joined = await text_client(relay, room='lecture')
+            outsider = await text_client(relay, room='seminar')
+            author[1].write(pack_text({'type': 'message', 'text': 'hello lecture'}))
+            message = await next_of_type(reader, 'message')
+            assert (message['sender'], message['text'], message['room']) == ('Ada', 'hello lecture', 'lecture')
+            assert not relay.rooms.get('seminar').recent
+            for client in (speaker, listener, elsewhere):
+                client.close()
+            for client in (author, (reader, writer, joined), outsider):
+                client[1].close()
+        finally:
+            await relay.stop()
+    asyncio.run(run())
+
+
+def test_a_dropped_voice_client_resumes_its_session_and_slot():
+    async def run():
+        relay = await start_relay()
+        try:
+            client = await VoiceClient.connect(relay, room='lecture')
+            first = client.welcome
+            drop(client.writer)
+            await asyncio.sleep(0.1)
+            assert relay.presence() == {}
+            client = await VoiceClient.connect(relay, room='lecture', session=first['session'])
+            assert client.welcome['resumed']
+            assert (client.welcome['client_id'], client.welcome['session']) == (first['client_id'], first['session'])
+            # A session is only good for the room it was opened in
+            other = await VoiceClient.connect(relay, room='seminar', session=first['session'])
+            assert not other.welcome['resumed']
+            client.close()
+            other.close()
+        finally:
+            await relay.stop()
+    asyncio.run(run())
+
+
+def test_a_resumed_text_client_gets_what_it_missed():
+    async def run():
+        relay = await start_relay()
+        try:
+            author = await text_client(relay, room='lecture', name='Ada')
+            reader, writer, joined = await text_client(relay, room='lecture')
+            author[1].write(pack_text({'type': 'message', 'text': 'one'}))
+            seen = await next_of_type(reader, 'message')
+            drop(writer)
+            await asyncio.sleep(0.1)
+            author[1].write(pack_text({'type': 'message', 'text': 'two'}))
+            author[1].write(pack_text({'type': 'message', 'text': 'three'}))
+            await asyncio.sleep(0.1)
+            reader, writer, rejoined = await text_client(relay, room='lecture', session=joined['session'],
+                                                         since=seen['id'])
+            assert rejoined['resumed'] and rejoined['client_id'] == joined['client_id']
+            replay = await next_of_type(reader, 'replay')
+            assert [message['text'] for message in replay['messages']] == ['two', 'three']
+            assert replay['complete']
+            author[1].close()
+            writer.close()
+        finally:
+            await relay.stop()
+    asyncio.run(run())
+
+
+def test_idle_text_clients_are_answered_when_they_ping():
+    async def run():
+        relay = await start_relay()
+        try:
+            reader, writer, joined = await text_client(relay, room='lecture')
+            writer.write(pack_text({'type': 'ping'}))
+            assert await next_of_type(reader, 'pong') == {'type': 'pong'}
+            writer.close()
+        finally:
+            await relay.stop()
+    asyncio.run(run())
+
+
+def test_a_udp_peer_whose_verify_was_lost_is_sent_its_welcome_again():
+    async def run():
+        relay = await start_relay(udp=True)
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.connect(relay.datagram_transport.get_extra_info('sockname'))
+
+        async def receive_control():
+            while True:
+                header, payload = unpack_frame(await asyncio.wait_for(loop.sock_recv(sock, 65536), 2.0))
+                if header.codec == CODEC_CONTROL:
+                    return decode_control(payload)
+
+        try:
+            hello = {'type': 'hello', 'rate': RATE, 'chunk': CHUNK}
+            sock.send(pack_frame(encode_control(hello), 0, 0, 0, CODEC_CONTROL))
+            welcome = await receive_control()
+            assert welcome['cookie']
+            # The verify never arrives, but the audio does
+            await asyncio.sleep(WELCOME_RETRY + 0.1)
+            sock.send(pack_frame(tone(), 0, 0, 0, CODEC_PCM16))
+            assert await receive_control() == welcome
+            verify = {'type': 'verify', 'cookie': welcome['cookie']}
+            sock.send(pack_frame(encode_control(verify), 0, 0, 0, CODEC_CONTROL))
+            await asyncio.sleep(0.1)
+            assert [conn.verified for conn in relay.datagram_protocol.peers.values()] == [True]
+        finally:
+            sock.close()
+            await relay.stop()
+    asyncio.run(run())
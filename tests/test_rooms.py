@@ -0,0 +1,52 @@
+from rooms import REPLAY_MESSAGES, RoomRegistry, normalize_room_id
+
+
+class Connection:
+    room = None
+
+
+
+def test_room_ids_are_trimmed_and_bounded():
+    assert normalize_room_id('  lecture ') == 'lecture'
+    assert normalize_room_id('') is None
+    assert normalize_room_id('x' * 65) is None
+    assert normalize_room_id(7) is None
+
+
+def test_rooms_come_and_go_with_their_members():
+    changes = []
+    rooms = RoomRegistry(320, 16000, on_change=lambda *change: changes.append(change))
+    voice, text = Connection(), Connection()
+    room = rooms.join(voice, 'lecture')
+    assert rooms.join(text, 'lecture', voice=False) is room
+    assert rooms.presence() == {'lecture': {'voice': 1, 'text': 1}}
+    assert voice in room.mixer.queues and text not in room.mixer.queues
+    rooms.leave(voice)
+    rooms.leave(text)
+    assert len(rooms) == 0 and rooms.get('lecture') is None
+    assert changes == [('lecture', 1, 0), ('lecture', 1, 1), ('lecture', 0, 1), ('lecture', 0, 0)]
+
+
+def test_joining_another_room_leaves_the_first():
+    rooms = RoomRegistry(320, 16000)
+    conn = Connection()
+    rooms.join(conn, 'lecture')
+    seminar = rooms.join(conn, 'seminar')
+    assert conn.room is seminar
+    assert rooms.presence() == {'seminar': {'voice': 1, 'text': 0}}
+    rooms.leave(conn)
+    rooms.leave(conn)
+    assert conn.room is None
+
+
+def test_replay_returns_what_a_client_missed():
+    rooms = RoomRegistry(320, 16000)
+    room = rooms.join(Connection(), 'lecture', voice=False)
+    for message_id in range(1, REPLAY_MESSAGES + 11):
+        room.remember({'id': message_id})
+    messages, complete = room.replay(REPLAY_MESSAGES + 5)
+    assert [message['id'] for message in messages] == list(range(REPLAY_MESSAGES + 6, REPLAY_MESSAGES + 11))
+    assert complete
+    # Older messages have fallen out, so the client has to page the rest from history
+    messages, complete = room.replay(5)
+    assert len(messages) == REPLAY_MESSAGES and not complete
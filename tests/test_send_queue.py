@@ -0,0 +1,33 @@
+import asyncio
+
+from send_queue import SendQueue
+
+
+def test_audio_queue_drops_the_oldest_frame_when_full():
+    queue = SendQueue(3)
+    for frame in range(5):
+        assert queue.put(frame)
+    assert list(queue.frames) == [2, 3, 4]
+    assert (queue.dropped, queue.high_water) == (2, 3)
+
+
+def test_text_queue_refuses_instead_of_dropping():
+    queue = SendQueue(2, drop_oldest=False)
+    assert queue.put('a') and queue.put('b')
+    assert not queue.put('c')
+    assert list(queue.frames) == ['a', 'b']
+    assert queue.dropped == 0
+
+
+def test_batches_take_everything_queued_up_to_the_limit():
+    async def run():
+        queue = SendQueue(10)
+        waiter = asyncio.ensure_future(queue.get_batch(3))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        for frame in range(5):
+            queue.put(frame)
+        assert await waiter == [0, 1, 2]
+        assert await queue.get_batch(3) == [3, 4]
+        assert len(queue) == 0
+    asyncio.run(run())
@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+from sessions import SessionTable
+
+
+def connection(name='Student'):
+    return SimpleNamespace(id=0, name=name, session=None)
+
+
+def test_session_is_parked_on_a_drop_and_resumed_with_its_token():
+    sessions = SessionTable(window=30)
+    conn = connection('Ada')
+    conn.id = 4
+    session = sessions.open(conn, 'lecture', voice=True)
+    assert conn.session == session.token
+    assert sessions.park(conn, now=100) is session
+    assert sessions.resume(session.token, 'lecture', voice=False) is None
+    assert sessions.resume(session.token, 'other room', voice=True) is None
+    assert sessions.resume(session.token, 'lecture', voice=True) is session
+    again = connection()
+    sessions.attach(session, again)
+    assert (session.conn, session.expires, again.session) == (again, None, session.token)
+    assert (session.slot, session.name) == (4, 'Ada')
+
+
+def test_parked_sessions_expire_after_the_window():
+    sessions = SessionTable(window=30)
+    conn = connection()
+    session = sessions.open(conn, 'lobby', voice=False)
+    sessions.park(conn, now=100)
+    assert sessions.expire(now=129) == []
+    assert sessions.expire(now=130) == [session]
+    assert sessions.resume(session.token, 'lobby', voice=False) is None
+
+
+def test_a_clean_close_ends_the_session():
+    sessions = SessionTable()
+    conn = connection()
+    session = sessions.open(conn, 'lobby', voice=True)
+    sessions.close(conn)
+    assert len(sessions) == 0
+    assert sessions.resume(session.token, 'lobby', voice=True) is None
+
+
+def test_only_the_live_connection_parks_or_closes_a_session():
+    sessions = SessionTable()
+    old, new = connection(), connection()
+    session = sessions.open(old, 'lobby', voice=True)
+    sessions.attach(session, new)
+    assert sessions.park(old, now=0) is None
+    sessions.close(old)
+    assert len(sessions) == 1
+
+
+def test_rejoining_replaces_the_session():
+    sessions = SessionTable()
+    conn = connection()
+    first = sessions.open(conn, 'lobby', voice=False)
+    second = sessions.open(conn, 'lecture', voice=False)
+    assert len(sessions) == 1
+    assert sessions.resume(first.token, 'lobby', voice=False) is None
+    assert conn.session == second.token
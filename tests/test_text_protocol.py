@@ -0,0 +1,75 @@
+import asyncio
+import socket
+
+import pytest
+
+from audio_protocol import ProtocolError
+from text_protocol import MAX_NAME, TEXT_HEADER, TextReader, normalize_name, normalize_text, pack_text, recv_text
+
+MESSAGES = [{'type': 'message', 'text': 'héllo'}, {'type': 'history', 'before': 7, 'limit': 20}]
+
+
+def read_all(data):
+    async def run():
+        stream = asyncio.StreamReader()
+        stream.feed_data(data)
+        stream.feed_eof()
+        reader = TextReader(stream)
+        messages = []
+        while (message := await reader.read()) is not None:
+            messages.append(message)
+        return messages, reader.bytes_read
+    return asyncio.run(run())
+
+
+def test_messages_round_trip_through_the_stream_reader():
+    data = b''.join(pack_text(message) for message in MESSAGES)
+    assert read_all(data) == (MESSAGES, len(data))
+
+
+def test_messages_round_trip_through_a_blocking_socket():
+    left, right = socket.socketpair()
+    with left, right:
+        for message in MESSAGES:
+            data = pack_text(message)
+            # Arriving a byte at a time must not split a message
+            for index in range(len(data)):
+                left.send(data[index:index + 1])
+        left.shutdown(socket.SHUT_WR)
+        assert [recv_text(right) for _ in MESSAGES] == MESSAGES
+        assert recv_text(right) is None
+
+
+@pytest.mark.parametrize('data', [
+    pack_text({'type': 'message'})[:-1],  # cut short inside the body
+    pack_text({'type': 'message'})[:2],  # cut short inside the header
+    TEXT_HEADER.pack(4) + b'nope',
+    TEXT_HEADER.pack(2) + b'[]',  # not an object
+    TEXT_HEADER.pack(2) + b'{}',  # no message type
+    TEXT_HEADER.pack(1 << 30),  # far too long
+])
+def test_broken_frames_are_protocol_errors(data):
+    with pytest.raises(ProtocolError):
+        read_all(data)
+
+
+def test_chat_text_and_names_are_normalized():
+    assert normalize_text('  hi  ') == 'hi'
+    assert normalize_text('   ') is None
+    assert normalize_text('x' * 2001) is None
+    assert normalize_name(' ' + 'n' * 40) == 'n' * MAX_NAME
+    assert normalize_name(None) is None
+
+
+def test_a_timeout_between_messages_keeps_the_stream_but_one_inside_does_not():
+    left, right = socket.socketpair()
+    with left, right:
+        right.settimeout(0.05)
+        with pytest.raises(socket.timeout):
+            recv_text(right)
+        data = pack_text(MESSAGES[0])
+        left.sendall(data)
+        assert recv_text(right) == MESSAGES[0]
+        left.sendall(data[:-1])
+        with pytest.raises(ProtocolError):
+            recv_text(right)
@@ -0,0 +1,49 @@
+import numpy as np
+
+from vad import VoiceActivityDetector
+
+CHUNK = 320
+
+
+def silence():
+    return bytes(CHUNK * 2)
+
+
+def hiss(amplitude=30, seed=0):
+    return (np.random.default_rng(seed).normal(0, amplitude, CHUNK)).astype(np.int16).tobytes()
+
+
+def voice(amplitude=6000):
+    return (np.sin(2 * np.pi * 200 * np.arange(CHUNK) / 16000) * amplitude).astype(np.int16).tobytes()
+
+
+def test_speech_is_detected_and_silence_is_not():
+    vad = VoiceActivityDetector()
+    assert not vad.is_speech(silence())
+    assert not vad.is_speech(hiss())
+    assert vad.is_speech(voice())
+
+
+def test_frames_come_out_lookahead_late_with_the_onset_included():
+    vad = VoiceActivityDetector(hangover=0, lookahead=1)
+    assert vad.process(silence()) == (None, False)
+    onset = hiss(seed=1)
+    assert vad.process(onset) == (silence(), False)
+    # The quiet frame before the word is sent along with it
+    assert vad.process(voice()) == (onset, True)
+
+
+def test_hangover_keeps_word_endings():
+    vad = VoiceActivityDetector(hangover=2, lookahead=0)
+    assert vad.process(voice())[1]
+    assert [vad.process(silence())[1] for _ in range(3)] == [True, True, False]
+
+
+def test_noise_floor_follows_a_noisy_room():
+    fresh, adapted = VoiceActivityDetector(min_energy=100), VoiceActivityDetector(min_energy=100)
+    for seed in range(200):
+        assert not adapted.is_speech(hiss(amplitude=18, seed=seed))
+    assert adapted.noise_level_db() < fresh.noise_level_db()
+    # A murmur that stands out in a silent room is part of the background in a noisy one
+    assert fresh.is_speech(voice(amplitude=40))
+    assert not adapted.is_speech(voice(amplitude=40))
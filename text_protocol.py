@@ -0,0 +1,108 @@
+import asyncio
+import json
+import socket
+import struct
+
+from audio_protocol import ProtocolError
+
+# Every text message is a 4-byte big-endian length followed by that many bytes of UTF-8 JSON
+TEXT_HEADER = struct.Struct('!I')
+MAX_TEXT_FRAME = 1 << 20
+MAX_MESSAGE_CHARS = 2000
+MAX_NAME = 32
+HISTORY_PAGE = 50
+MAX_HISTORY_PAGE = 100
+
+
+def pack_text(message):
+    data = json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode()
+    if len(data) > MAX_TEXT_FRAME:
+        raise ProtocolError(f"text message of {len(data)} bytes exceeds {MAX_TEXT_FRAME}")
+    return TEXT_HEADER.pack(len(data)) + data
+
+
+def _decode(data):
+    try:
+        message = json.loads(data.decode())
+    except ValueError as e:
+        raise ProtocolError(f"malformed text message: {e}") from None
+    if not isinstance(message, dict) or 'type' not in message:
+        raise ProtocolError("text message without a message type")
+    return message
+
+
+def _check_length(header):
+    (length,) = TEXT_HEADER.unpack(header)
+    if length > MAX_TEXT_FRAME:
+        raise ProtocolError(f"text message of {length} bytes exceeds {MAX_TEXT_FRAME}")
+    return length
+
+
+class TextReader:
+    # Reads messages off an asyncio StreamReader, counting the bytes consumed
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    async def read(self):
+        # Returns the next message, or None on a clean EOF
+        try:
+            header = await self.stream.readexactly(TEXT_HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise ProtocolError("connection closed inside a text message header") from None
+            return None
+        length = _check_length(header)
+        try:
+            data = await self.stream.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise ProtocolError("connection closed inside a text message") from None
+        self.bytes_read += TEXT_HEADER.size + length
+        return _decode(data)
+
+
+def _recv_exactly(sock, size, started=False):
+    data = bytearray()
+    while len(data) < size:
+        try:
+            chunk = sock.recv(size - len(data))
+        except socket.timeout:
+            # Only a timeout between messages leaves the stream in step
+            if data or started:
+                raise ProtocolError("timed out inside a text message") from None
+            raise
+        if not chunk:
+            return None if not data else bytes(data)
+        data += chunk
+    return bytes(data)
+
+
+def recv_text(sock):
+    # Blocking counterpart of TextReader.read for the client's socket threads. A socket
+    # timeout is raised as is only if it came before the message started.
+    header = _recv_exactly(sock, TEXT_HEADER.size)
+    if header is None:
+        return None
+    if len(header) < TEXT_HEADER.size:
+        raise ProtocolError("connection closed inside a text message header")
+    length = _check_length(header)
+    data = _recv_exactly(sock, length, started=True) if length else b''
+    if data is None or len(data) < length:
+        raise ProtocolError("connection closed inside a text message")
+    return _decode(data)
+
+
+def normalize_text(text):
+    if not isinstance(text, str):
+        return None
+    text = text.strip()
+    if not text or len(text) > MAX_MESSAGE_CHARS:
+        return None
+    return text
+
+
+def normalize_name(name):
+    if not isinstance(name, str):
+        return None
+    name = name.strip()[:MAX_NAME]
+    return name or None
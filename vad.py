@@ -0,0 +1,60 @@
+import collections
+
+import numpy as np
+
+
+class VoiceActivityDetector:
+    # Energy + zero-crossing detector with an adaptive noise floor. Frames come out
+    # `lookahead` frames late so the quiet onset of a word is sent along with it, and
+    # stay active for `hangover` frames after speech so word endings are not clipped.
+    def __init__(self, hangover=15, lookahead=1, speech_ratio=4.0, min_energy=2.0e4, max_zcr=0.35):
+        self.hangover = hangover
+        self.lookahead = lookahead
+        self.speech_ratio = speech_ratio
+        self.min_energy = min_energy
+        self.max_zcr = max_zcr
+        self.noise_floor = min_energy
+        self.hangover_left = 0
+        self.pending = collections.deque()
+
+    def is_speech(self, pcm):
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        if not len(samples):
+            return False
+        values = samples.astype(np.float32)
+        energy = float(np.dot(values, values)) / len(values)
+        signs = np.signbit(samples)
+        zcr = np.count_nonzero(signs[1:] != signs[:-1]) / len(samples)
+        threshold = max(self.min_energy, self.noise_floor * self.speech_ratio)
+        # Hiss has a high crossing rate; only accept it when it is clearly loud
+        speech = energy > threshold and (zcr < self.max_zcr or energy > 4 * threshold)
+        if not speech:
+            # Drop to quieter rooms immediately, climb to louder ones slowly
+            if energy < self.noise_floor:
+                self.noise_floor = max(energy, self.min_energy / self.speech_ratio)
+            else:
+                self.noise_floor += (energy - self.noise_floor) * 0.05
+        return speech
+
+    def process(self, pcm):
+        # Returns (frame, active) for the frame `lookahead` steps back, or (None, False)
+        # while the lookahead window is still filling
+        if self.is_speech(pcm):
+            self.hangover_left = self.hangover
+            for entry in self.pending:
+                entry[1] = True
+            active = True
+        elif self.hangover_left:
+            self.hangover_left -= 1
+            active = True
+        else:
+            active = False
+        self.pending.append([pcm, active])
+        if len(self.pending) <= self.lookahead:
+            return None, False
+        frame, active = self.pending.popleft()
+        return frame, active
+
+    def noise_level_db(self):
+        # Noise floor in dB below full scale, sent with DTX frames for comfort noise
+        return int(min(255, max(0, -10 * np.log10(self.noise_floor / 32768 ** 2))))
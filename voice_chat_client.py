@@ -1,16 +1,38 @@
+import random
 import socket
+import struct
 import threading
+import time
 import pyaudio
 from PyQt5 import QtWidgets, QtGui, QtCore
 
+from audio_codec import available_codecs, create_codec
+from audio_engine import CAPTURE_FRAMES, PERIOD_MS, AudioEngine
+from audio_mixer import frame_level
+from audio_config import FRAME_MS, RATE, frame_samples
+from audio_protocol import (CODEC_CONTROL, CODEC_DTX, HEADER, MAX_PAYLOAD, FrameParser, FrameWriter, ProtocolError,
+                            decode_control, encode_control, now_us, pack_frame, unpack_frame)
+from chat_view import ChatFeed, ChatLogModel, ChatLogView
+from jitter_buffer import JitterBuffer
+from text_protocol import HISTORY_PAGE, pack_text, recv_text
+from vad import VoiceActivityDetector
+
 HOST = 'localhost'
 PORT = 5000
 TEXT_PORT = 5001
-
-FORMAT = pyaudio.paInt16
-CHANNELS = 1
-RATE = 44100
-CHUNK = 1024
+ROOM = 'lobby'
+NAME = None  # how others see you in text chat; the relay picks "Student <n>" when unset
+
+KEEPALIVE_INTERVAL = 1.0
+HANDSHAKE_TIMEOUT = 2.0
+HANDSHAKE_ATTEMPTS = 3
+SOCKET_TIMEOUT = 0.5
+# The relay sends every member a frame each tick, even in a silent room, so a voice link
+# this quiet is dead. Text can be quiet for long, so it is pinged when idle instead.
+LINK_TIMEOUT = 1.5
+TEXT_KEEPALIVE_INTERVAL = 5.0
+RECONNECT_DELAY = 0.25
+MAX_RECONNECT_DELAY = 8.0
 
 google_font_css = """
 @font-face {
@@ -19,13 +41,56 @@ google_font_css = """
 }
 """
 
+
+def backoff_delays(first=RECONNECT_DELAY, limit=MAX_RECONNECT_DELAY):
+    # Exponential backoff with jitter, so a classroom of clients that lost the same
+    # network does not come back in lockstep
+    delay = first
+    while True:
+        yield random.uniform(delay / 2, delay)
+        delay = min(delay * 2, limit)
+
+
+def abort_socket(sock):
+    # Closes with a reset instead of a FIN. The relay reads a clean close as the client
+    # leaving and drops its session; a reset keeps the session open for resuming.
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    except OSError:
+        pass
+    sock.close()
+
+
 class VoiceCallWindow(QtWidgets.QWidget):
-    def __init__(self):
+    status_changed = QtCore.pyqtSignal(str)
+
+    def __init__(self, room=ROOM, rate=RATE, frame_ms=FRAME_MS, period_ms=PERIOD_MS, capture_frames=CAPTURE_FRAMES,
+                 name=NAME):
         super().__init__()
+        self.room = room
+        self.name = name
+        self.rate = rate
+        self.chunk = frame_samples(rate, frame_ms)
         self.client_socket = None
+        # Held by whoever replaces or closes client_socket
+        self.socket_lock = threading.Lock()
+        self.link_up = threading.Event()
+        self.use_udp = False
+        self.client_id = 0
+        self.session = None
+        self.codec = None
+        self.cookie = None
+        self.frame_writer = FrameWriter()
+        self.frame_parser = FrameParser(self._on_frame)
+        self.datagram_buffer = bytearray(HEADER.size + MAX_PAYLOAD)
+        self.jitter_buffer = None
+        # One PyAudio for the window's lifetime, so reconnecting never reopens the devices
         self.audio_stream = pyaudio.PyAudio()
+        # Shorter periods cut device latency at the cost of more callbacks
+        self.audio_engine = AudioEngine(self.audio_stream, rate, self.chunk, period_ms, capture_frames)
         self.is_streaming = False
         self.is_muted = False
+        self.use_vad = True
         self.setWindowTitle("Voice Chat")
         self.connect_button = QtWidgets.QPushButton("Connect")
         self.begin_voice_call_button = QtWidgets.QPushButton("Begin Voice Call")
@@ -39,6 +104,13 @@ class VoiceCallWindow(QtWidgets.QWidget):
         QtWidgets.QApplication.instance().setStyleSheet(google_font_css)
         self.mute_button = QtWidgets.QPushButton("Mute")
         self.mute_button.setVisible(False)
+        self.udp_checkbox = QtWidgets.QCheckBox("Low latency mode (UDP)")
+        self.vad_checkbox = QtWidgets.QCheckBox("Only send audio while I'm talking")
+        self.vad_checkbox.setChecked(True)
+        self.buffer_label = QtWidgets.QLabel("")
+        self.stats_timer = QtCore.QTimer(self)
+        self.stats_timer.setInterval(1000)
+        self.stats_timer.timeout.connect(self.update_buffer_stats)
 
         # Use QGridLayout
         layout = QtWidgets.QGridLayout()
@@ -48,6 +120,9 @@ class VoiceCallWindow(QtWidgets.QWidget):
         layout.addWidget(self.disconnect_button, 3, 0)
         layout.addWidget(self.status_label, 4, 0)
         layout.addWidget(self.mute_button, 5, 0)
+        layout.addWidget(self.udp_checkbox, 6, 0)
+        layout.addWidget(self.vad_checkbox, 7, 0)
+        layout.addWidget(self.buffer_label, 8, 0)
         layout.setVerticalSpacing(5)
 
         self.setLayout(layout)
@@ -56,6 +131,9 @@ class VoiceCallWindow(QtWidgets.QWidget):
         self.stop_voice_call_button.clicked.connect(self.stop_voice_call)
         self.disconnect_button.clicked.connect(self.disconnect)
         self.mute_button.clicked.connect(self.toggle_mute)
+        self.vad_checkbox.toggled.connect(self.toggle_vad)
+        # Socket threads report reconnects through the signal, never the label itself
+        self.status_changed.connect(self.status_label.setText)
         self.set_styles()
 
     def set_styles(self):
@@ -84,14 +162,115 @@ class VoiceCallWindow(QtWidgets.QWidget):
     def connect(self):
         if self.client_socket:
             return
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((HOST, PORT))
-        self.status_label.setText("Connected")
+        self.use_udp = self.udp_checkbox.isChecked()
+        self.session = None
+        try:
+            self.client_socket = self._open_socket()
+            self._handshake()
+        except (OSError, ProtocolError) as e:
+            print(e)
+            if self.client_socket:
+                self.client_socket.close()
+            self.client_socket = None
+            self.status_label.setText("Connection failed")
+            return
+        self.link_up.set()
+        self.status_label.setText(f"Connected ({self.codec.name})")
+        self.udp_checkbox.setEnabled(False)
         self.connect_button.setEnabled(False)
         self.begin_voice_call_button.setEnabled(True)
         self.stop_voice_call_button.setEnabled(False)
         self.disconnect_button.setEnabled(True)
 
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM if self.use_udp else socket.SOCK_STREAM)
+        sock.settimeout(HANDSHAKE_TIMEOUT)
+        try:
+            sock.connect((HOST, PORT))
+        except OSError:
+            sock.close()
+            raise
+        # A send that blocks this long means the link is gone, so both directions time out
+        sock.settimeout(SOCKET_TIMEOUT)
+        return sock
+
+    def _handshake(self):
+        # Offer our codecs, most preferred first; the server answers with the one to use.
+        # After a drop the session token gets us our old slot in the room back.
+        hello = {'type': 'hello', 'codecs': available_codecs(self.rate, self.chunk),
+                 'rate': self.rate, 'chunk': self.chunk, 'room': self.room}
+        if self.name:
+            hello['name'] = self.name
+        if self.session:
+            hello['session'] = self.session
+        frame = pack_frame(encode_control(hello), 0, 0, now_us(), CODEC_CONTROL)
+        self.codec = None
+        self.cookie = None
+        self.frame_parser = FrameParser(self._on_frame)
+        timeout = self.client_socket.gettimeout()
+        self.client_socket.settimeout(HANDSHAKE_TIMEOUT)
+        # Only a datagram can go missing. Over TCP the hello arrives or the link fails,
+        # and a second one would open a second session.
+        attempts = HANDSHAKE_ATTEMPTS if self.use_udp else 1
+        for attempt in range(attempts):
+            self.client_socket.sendall(frame)
+            try:
+                while self.codec is None:
+                    if not self._receive_once():
+                        raise ConnectionResetError("server closed the connection during the handshake")
+            except socket.timeout:
+                continue
+            break
+        self.client_socket.settimeout(timeout)
+        if self.codec is None:
+            raise ProtocolError("server did not answer the handshake")
+        if self.cookie:
+            # Over UDP the relay only streams to us once we echo its cookie, proving the
+            # address is ours. A few copies, since a lost one would leave the call silent
+            # until the relay sends the welcome again.
+            self._send_verify(HANDSHAKE_ATTEMPTS)
+
+    def _send_verify(self, copies=1):
+        verify = encode_control({'type': 'verify', 'cookie': self.cookie})
+        verify = pack_frame(verify, 0, 0, now_us(), CODEC_CONTROL)
+        for _ in range(copies):
+            self.client_socket.sendall(verify)
+
+    def _receive_once(self):
+        if not self.use_udp:
+            return self.frame_parser.feed_from(self.client_socket)
+        nbytes = self.client_socket.recv_into(self.datagram_buffer)
+        try:
+            header, payload = unpack_frame(self.datagram_buffer, nbytes)
+            self._on_frame(header, payload)
+        except ProtocolError:
+            pass  # a corrupt datagram only costs that one frame
+        return nbytes
+
+    def _on_frame(self, header, payload):
+        if header.codec == CODEC_CONTROL:
+            message = decode_control(payload)
+            if message['type'] == 'welcome':
+                if self.codec is not None:
+                    # A late answer to a retried hello, or the relay repeating the welcome
+                    # because our verify was lost. The call is already set up on the first
+                    # one; only the session the relay now holds us by can have changed.
+                    self.session = message.get('session', self.session)
+                    if self.cookie and message.get('cookie') == self.cookie:
+                        self._send_verify()
+                    return
+                self.client_id = message['client_id']
+                self.session = message.get('session')
+                self.cookie = message.get('cookie')
+                self.frame_writer = FrameWriter(self.client_id)
+                self.codec = create_codec(message['codec'], self.rate, self.chunk)
+            elif message['type'] == 'error':
+                raise ProtocolError(message['reason'])
+            return
+        jitter_buffer = self.jitter_buffer
+        if jitter_buffer and self.codec and header.codec == self.codec.codec_id:
+            jitter_buffer.put(header.seq, header.timestamp, self.codec.decode(payload))
+
     def begin_voice_call(self):
         if self.is_streaming:
             return
@@ -101,9 +280,12 @@ class VoiceCallWindow(QtWidgets.QWidget):
         self.begin_voice_call_button.setEnabled(False)
         self.stop_voice_call_button.setEnabled(True)
         self.mute_button.setVisible(True)
+        self.stats_timer.start()
 
     def stop_voice_call(self):
         self.is_streaming = False
+        self.stats_timer.stop()
+        self.buffer_label.setText("")
         self.stop_voice_call_button.setEnabled(False)
         self.begin_voice_call_button.setEnabled(True)
         self.mute_button.setVisible(False)
@@ -114,16 +296,35 @@ class VoiceCallWindow(QtWidgets.QWidget):
         if not self.client_socket:
             return
         self.is_streaming = False
-        self.client_socket.shutdown(socket.SHUT_RDWR)
-        self.client_socket.close()
-        self.client_socket = None
-        self.audio_stream.terminate()
+        self.link_up.clear()
+        self.stats_timer.stop()
+        self.buffer_label.setText("")
+        with self.socket_lock:
+            if not self.use_udp:
+                try:
+                    # A clean close tells the relay not to hold our slot
+                    self.client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.client_socket.close()
+            self.client_socket = None
+        self.session = None
         self.status_label.setText("Disconnected")
+        self.udp_checkbox.setEnabled(True)
         self.connect_button.setEnabled(True)
         self.begin_voice_call_button.setEnabled(False)
         self.stop_voice_call_button.setEnabled(False)
         self.disconnect_button.setEnabled(False)
 
+    def update_buffer_stats(self):
+        if self.jitter_buffer:
+            stats = self.jitter_buffer.stats()
+            latency = self.audio_engine.stats()
+            self.buffer_label.setText(f"Buffer {stats['depth']}/{stats['target_depth']} frames, "
+                                      f"{stats['late']} late, {stats['lost']} lost\n"
+                                      f"Capture {latency['capture_ms']:.1f} ms, queue {latency['queue_ms']:.1f} ms, "
+                                      f"playback {latency['playback_ms']:.1f} ms")
+
     def toggle_mute(self):
         self.is_muted = not self.is_muted
         if self.is_muted:
@@ -131,37 +332,143 @@ class VoiceCallWindow(QtWidgets.QWidget):
         else:
             self.mute_button.setText("Mute")
 
+    def toggle_vad(self, checked):
+        self.use_vad = checked
+
     def _send_audio(self):
-        stream = self.audio_stream.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=CHUNK)
+        engine = self.audio_engine
+        engine.start_capture()
+        vad = VoiceActivityDetector()
+        was_active = False
+        last_sent = 0.0
         while self.is_streaming:
+            # The microphone keeps being read while reconnecting, so the ring never
+            # overflows and the first frame after the link comes back is current
+            data = engine.read_frame(SOCKET_TIMEOUT)
+            if data is None:
+                continue
+            # Frames are views into the capture ring, released once sent. The VAD
+            # holds on to its lookahead, so the frame it returns is the oldest held.
+            if self.use_vad:
+                data, active = vad.process(data)
+            else:
+                active = True
+                if vad.pending:
+                    engine.release_frame(len(vad.pending))
+                    vad.pending.clear()
+            codec = self.codec
+            if not self.link_up.is_set() or codec is None:
+                active = False
+            else:
+                active = active and data is not None and not self.is_muted
+                try:
+                    if active:
+                        # The level lets a relay rank speakers without decoding us
+                        level = frame_level(data)
+                        self.client_socket.sendall(self.frame_writer.pack(codec.encode(data), codec=codec.codec_id,
+                                                                          level=level))
+                        last_sent = time.monotonic()
+                    elif was_active or time.monotonic() - last_sent > KEEPALIVE_INTERVAL:
+                        # Silence is a tiny DTX marker instead of audio; repeating it keeps a
+                        # UDP address registered with the server
+                        self.client_socket.sendall(self.frame_writer.pack(bytes((vad.noise_level_db(),)), codec=CODEC_DTX))
+                        last_sent = time.monotonic()
+                except OSError as e:
+                    print(e)
+                    self._link_lost()
+            if data is not None:
+                engine.release_frame()
+            was_active = active
+        engine.stop_capture()
+
+    def _link_lost(self):
+        # Wakes the receive thread, which is the one that reconnects. Only the read side
+        # is shut: shutting the write side would send the relay a FIN, and it takes a
+        # FIN for a client that left on purpose and forgets its session.
+        sock = self.client_socket
+        if self.link_up.is_set() and sock:
+            self.link_up.clear()
             try:
-                data = stream.read(CHUNK, exception_on_overflow=False)
-                if not self.is_muted:
-                    self.client_socket.sendall(data)
-            except (OSError, BrokenPipeError):
-                break
-        stream.stop_stream()
-        stream.close()
+                sock.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+
+    def _reconnect(self):
+        # Runs on the receive thread while the audio devices stay open and playout
+        # conceals the gap. Returns False if the call ended first.
+        self.link_up.clear()
+        self.status_changed.emit("Reconnecting...")
+        for delay in backoff_delays():
+            try:
+                sock = self._open_socket()
+            except OSError as e:
+                print(e)
+                sock = None
+            with self.socket_lock:
+                if not self.is_streaming or self.client_socket is None:
+                    if sock:
+                        sock.close()
+                    return False
+                if sock:
+                    abort_socket(self.client_socket)
+                    self.client_socket = sock
+            if sock is None:
+                time.sleep(delay)
+                continue
+            # The relay numbers frames afresh on the new connection
+            self.jitter_buffer.resync()
+            try:
+                self._handshake()
+            except (OSError, ProtocolError) as e:
+                print(e)
+                time.sleep(delay)
+                continue
+            self.link_up.set()
+            self.status_changed.emit(f"Connected ({self.codec.name})")
+            return True
 
     def _receive_audio(self):
-        stream = self.audio_stream.open(format=FORMAT, channels=CHANNELS, rate=RATE, output=True, frames_per_buffer=CHUNK)
+        jitter_buffer = JitterBuffer(self.chunk / self.rate)
+        self.jitter_buffer = jitter_buffer
+        # The playback callback pulls straight from the jitter buffer
+        self.audio_engine.start_playback(jitter_buffer.get)
+        last_heard = time.monotonic()
         while self.is_streaming:
             try:
-                data = self.client_socket.recv(CHUNK)
-                stream.write(data)
-            except (OSError, ConnectionResetError):
+                if not self.link_up.is_set() or not self._receive_once():
+                    raise ConnectionResetError("lost the connection to the relay")
+                last_heard = time.monotonic()
+                continue
+            except socket.timeout:
+                if time.monotonic() - last_heard < LINK_TIMEOUT:
+                    continue
+                print("the relay has gone quiet")
+            except (OSError, ProtocolError) as e:
+                print(e)
+            if not self._reconnect():
                 break
-        stream.stop_stream()
-        stream.close()
+            last_heard = time.monotonic()
+        self.is_streaming = False
+        self.audio_engine.stop_playback()
+        self.jitter_buffer = None
 
 class TextChatWindow(QtWidgets.QWidget):
-    def __init__(self):
+    def __init__(self, room=ROOM, name=NAME):
         super().__init__()
-        self.text_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.text_socket.connect((HOST, TEXT_PORT))
+        self.room = room
+        self.name = name
+        self.session = None
+        self.last_id = None  # newest message id seen, where a resumed session picks up
+        self.more_history = False
+        # The GUI thread sends chat while the receive thread sends keepalives
+        self.send_lock = threading.Lock()
+        self.text_socket = self._join()
         QtWidgets.QApplication.instance().setStyleSheet(google_font_css)
         self.setWindowTitle("Text Chat")
-        self.chat_area = QtWidgets.QTextEdit()
+        # Who the relay is mixing right now, when it runs with --max-speakers
+        self.speakers_label = QtWidgets.QLabel("")
+        self.chat_model = ChatLogModel()
+        self.chat_area = ChatLogView(self.chat_model)
         font = QtGui.QFont("Arial", 30)
         self.chat_area.setFont(font)
         self.text_edit = QtWidgets.QTextEdit()
@@ -170,13 +477,42 @@ class TextChatWindow(QtWidgets.QWidget):
         self.text_edit.setMaximumHeight(100)
         self.send_button = QtWidgets.QPushButton("Send")
         layout = QtWidgets.QVBoxLayout()
+        layout.addWidget(self.speakers_label)
         layout.addWidget(self.chat_area)
         layout.addWidget(self.text_edit)
         layout.addWidget(self.send_button)
         self.setLayout(layout)
         self.send_button.clicked.connect(self.send_text)
+        self.chat_area.history_wanted.connect(self.load_earlier)
+        # The receive thread never touches widgets; everything goes through the feed
+        self.feed = ChatFeed(self._deliver, parent=self)
         self.set_styles()
-        threading.Thread(target=self._receive_text).start()
+        threading.Thread(target=self._receive_text, daemon=True).start()
+
+    def _join(self):
+        sock = socket.create_connection((HOST, TEXT_PORT), timeout=HANDSHAKE_TIMEOUT)
+        try:
+            join = {'type': 'join', 'room': self.room, 'history': HISTORY_PAGE}
+            if self.name:
+                join['name'] = self.name
+            if self.session:
+                join['session'] = self.session
+                join['since'] = self.last_id or 0
+            sock.sendall(pack_text(join))
+            reply = recv_text(sock)
+            if reply is None or reply['type'] != 'joined':
+                raise ProtocolError(f"could not join room {self.room}")
+        except (OSError, ProtocolError):
+            sock.close()
+            raise
+        sock.settimeout(TEXT_KEEPALIVE_INTERVAL)
+        if self.session and not reply.get('resumed'):
+            # Too late to pick up where we left off: start over from the history page
+            self.feed.post({'type': 'reset'})
+            self.last_id = None
+        self.session = reply.get('session')
+        self.name = reply['name']
+        return sock
 
     def set_styles(self):
         self.setStyleSheet("""
@@ -192,7 +528,7 @@ class TextChatWindow(QtWidgets.QWidget):
                 padding: 8px;
                 min-width: 100px;
             }
-            QTextEdit {
+            QTextEdit, QListView {
                 background-color: #44475a;  /* Darker color for the text area */
                 border-style: none;
                 color: #f8f8f2;
@@ -201,34 +537,95 @@ class TextChatWindow(QtWidgets.QWidget):
                 padding: 8px;
             }
         """)
-        self.chat_area.setReadOnly(True)
-        self.chat_area.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
-        self.chat_area.setAlignment(QtCore.Qt.AlignRight)
 
     def send_text(self):
         text = self.text_edit.toPlainText().strip()
         if text:
-            encoded_text = text.encode()
-            self.text_socket.sendall(encoded_text)
-            self.add_message_to_chat("<b style='color: #409EFF;'>You: </b>" + text)
+            try:
+                with self.send_lock:
+                    self.text_socket.sendall(pack_text({'type': 'message', 'text': text}))
+            except OSError as e:
+                print(e)
+                return  # left in the box to send again once reconnected
+            self.chat_area.follow = True
+            self.chat_model.append_messages([{'sender': 'You', 'text': text, 'outgoing': True}])
             self.text_edit.clear()
 
-    def add_message_to_chat(self, message):
-        cursor = self.chat_area.textCursor()
-        cursor.movePosition(QtGui.QTextCursor.End)
-        cursor.insertHtml(message + "<br>")
-        self.chat_area.setTextCursor(cursor)
-        self.chat_area.ensureCursorVisible()
+    def load_earlier(self):
+        if not self.more_history or self.chat_model.is_full():
+            self.chat_area.history_loaded(0)
+            return
+        before = self.chat_model.oldest_id()
+        try:
+            with self.send_lock:
+                self.text_socket.sendall(pack_text({'type': 'history', 'before': before, 'limit': HISTORY_PAGE}))
+        except OSError:
+            self.chat_area.history_loaded(0)
+
+    def _deliver(self, batch):
+        # Runs on the GUI thread once per frame with everything received since the last one
+        messages = []
+        for item in batch:
+            if item['type'] == 'message':
+                messages.append(item)
+                continue
+            self.chat_model.append_messages(messages)
+            messages = []
+            if item['type'] == 'history':
+                count = self.chat_model.prepend_messages(item['messages'])
+                self.more_history = item['more']
+                self.chat_area.history_loaded(count)
+            elif item['type'] == 'replay':
+                if not item['complete']:
+                    # More was missed than the relay keeps; older lines come from history
+                    self.chat_model.clear()
+                    self.more_history = True
+                messages = item['messages']
+            elif item['type'] == 'reset':
+                self.chat_model.clear()
+            elif item['type'] == 'speakers':
+                names = ', '.join(speaker['name'] for speaker in item['speakers'])
+                self.speakers_label.setText(f"Speaking: {names}" if names else "")
+        self.chat_model.append_messages(messages)
 
     def _receive_text(self):
+        pinged = False
         while True:
             try:
-                data = self.text_socket.recv(1024)
-                if not data:
-                    break
-                self.add_message_to_chat("<b style='color: #67C23A;'>Student 2: </b>" + data.decode())
-            except (OSError, ConnectionResetError):
-                break
+                try:
+                    message = recv_text(self.text_socket)
+                except socket.timeout:
+                    if pinged:
+                        raise ConnectionResetError("the relay stopped answering") from None
+                    # Nothing for a while; a live relay answers this with a pong
+                    with self.send_lock:
+                        self.text_socket.sendall(pack_text({'type': 'ping'}))
+                    pinged = True
+                    continue
+                pinged = False
+                if message is None:
+                    raise ConnectionResetError("the relay closed the text connection")
+                if message['type'] == 'message':
+                    self.last_id = message['id']
+                elif message['type'] in ('history', 'replay') and message['messages']:
+                    self.last_id = max(self.last_id or 0, message['messages'][-1]['id'])
+                elif message['type'] not in ('speakers', 'history', 'replay'):
+                    continue
+                self.feed.post(message)
+            except (OSError, ProtocolError) as e:
+                print(e)
+                self._rejoin()
+                pinged = False
+
+    def _rejoin(self):
+        abort_socket(self.text_socket)
+        for delay in backoff_delays():
+            try:
+                self.text_socket = self._join()
+                return
+            except (OSError, ProtocolError) as e:
+                print(e)
+                time.sleep(delay)
 
 class HomeWindow(QtWidgets.QWidget):
     def __init__(self):
@@ -336,3 +733,4 @@ if __name__ == "__main__":
     home_window = HomeWindow()
     home_window.showMaximized()
     app.exec_()
+    home_window.voice_call_window.audio_stream.terminate()
@@ -1,33 +1,42 @@
-import socket
+import asyncio
 import threading
-import pyaudio
-from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5 import QtGui, QtWidgets
+
+from audio_config import CHUNK, RATE
+from chat_view import ChatFeed, ChatLogModel, ChatLogView
+from history import HISTORY_PATH
+from local_playback import MixPlayback
+from metrics import METRICS_HOST
+from relay_server import QUEUE_SIZE, RelayServer
+from rooms import DEFAULT_ROOM
 
-FORMAT = pyaudio.paInt16
-CHANNELS = 1
-RATE = 44100
-CHUNK = 1024
 HOST = 'localhost'
 PORT = 5000
 TEXT_PORT = 5001
 
 class VoiceChatServer(QtWidgets.QWidget):
-    def __init__(self):
+    def __init__(self, host=HOST, port=PORT, text_port=TEXT_PORT, rate=RATE, chunk=CHUNK, udp=True, playback=False,
+                 history_path=HISTORY_PATH, queue_size=QUEUE_SIZE, monitor_room=DEFAULT_ROOM, metrics_port=None,
+                 metrics_host=METRICS_HOST, profile=False, max_speakers=None, record_dir=None):
         super().__init__()
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.text_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.audio_stream = pyaudio.PyAudio()
-        self.client_connections = []
-        self.client_threads = []
-        self.streams = []
-        self.text_connections = []
-        self.text_threads = []
+        self.relay_options = dict(host=host, port=port, text_port=text_port, rate=rate, chunk=chunk, udp=udp,
+                                  history_path=history_path, queue_size=queue_size, monitor_room=monitor_room,
+                                  metrics_port=metrics_port, metrics_host=metrics_host, profile=profile,
+                                  max_speakers=max_speakers, record_dir=record_dir)
+        self.relay = None
+        self.relay_thread = None
+        self.playback = None
+        self.is_running = False
         self.setWindowTitle("SynConnect")
         self.start_button = QtWidgets.QPushButton("Start Connecting")
         self.stop_button = QtWidgets.QPushButton("End Connection")
         self.stop_button.setEnabled(False)
         self.status_label = QtWidgets.QLabel("Disconnected")
-        self.chat_area = QtWidgets.QTextEdit()
+        self.playback_checkbox = QtWidgets.QCheckBox("Play room audio on this machine")
+        self.playback_checkbox.setChecked(playback)
+        # Incoming messages are the blue ones here, as before
+        self.chat_model = ChatLogModel(show_room=True, incoming_color='#409EFF', outgoing_color='#67C23A')
+        self.chat_area = ChatLogView(self.chat_model)
         font = QtGui.QFont("Arial", 40, 30)  # Set font and size here
         self.chat_area.setFont(font)  # Apply the font to the QTextEdit widget
         self.text_edit = QtWidgets.QTextEdit()
@@ -39,6 +48,7 @@ class VoiceChatServer(QtWidgets.QWidget):
         layout.addWidget(self.start_button)
         layout.addWidget(self.stop_button)
         layout.addWidget(self.status_label)
+        layout.addWidget(self.playback_checkbox)
         layout.addWidget(self.chat_area)
         layout.addWidget(self.text_edit)
         layout.addWidget(self.send_button)
@@ -46,6 +56,8 @@ class VoiceChatServer(QtWidgets.QWidget):
         self.start_button.clicked.connect(self.start)
         self.stop_button.clicked.connect(self.stop)
         self.send_button.clicked.connect(self.send_text)
+        # Relay callbacks arrive on the relay thread and reach the model in per-frame batches
+        self.feed = ChatFeed(self.chat_model.append_messages, parent=self)
         self.set_styles()
 
     def set_styles(self):
@@ -68,7 +80,7 @@ class VoiceChatServer(QtWidgets.QWidget):
             QLabel {
                 font: bold 16px; /* Updated font size */
             }
-            QTextEdit {
+            QTextEdit, QListView {
                 background-color: #282D46;
                 border-style: none;
                 color: #F5F5F5;
@@ -76,109 +88,58 @@ class VoiceChatServer(QtWidgets.QWidget):
                 padding: 10px; /* Updated padding */
             }
         """)
-        self.chat_area.setReadOnly(True)
-        self.chat_area.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
-        self.chat_area.setAlignment(QtCore.Qt.AlignRight)
 
     def start(self):
-        self.server_socket.bind((HOST, PORT))
-        self.server_socket.listen(2)
-        self.text_socket.bind((HOST, TEXT_PORT))
-        self.text_socket.listen(2)
+        on_mix = None
+        if self.playback_checkbox.isChecked():
+            self.playback = MixPlayback(self.relay_options['rate'], self.relay_options['chunk'])
+            self.playback.start()
+            on_mix = self.playback.queue_frame
+        self.relay = RelayServer(**self.relay_options, on_text=self.add_received_text, on_mix=on_mix)
+        self.is_running = True
+        self.playback_checkbox.setEnabled(False)
+        self.relay_thread = threading.Thread(target=self._run_relay)
+        self.relay_thread.start()
         self.start_button.setEnabled(False)
         self.stop_button.setEnabled(True)
         self.status_label.setText("Connection enabled")
-        threading.Thread(target=self._accept_connections).start()
-        threading.Thread(target=self._accept_text_connections).start()
 
     def stop(self):
-        self.server_socket.close()
-        self.text_socket.close()
-        for conn in self.client_connections:
-            conn.close()
-        self.client_connections.clear()
-        for thread in self.client_threads:
-            thread.join()
-        self.client_threads.clear()
-        for stream in self.streams:
-            stream.stop_stream()
-            stream.close()
-        self.streams.clear()
-        for conn in self.text_connections:
-            conn.close()
-        self.text_connections.clear()
-        for thread in self.text_threads:
-            thread.join()
-        self.text_threads.clear()
+        self.is_running = False
+        if self.relay:
+            self.relay.request_stop()
+        if self.relay_thread:
+            self.relay_thread.join()
+            self.relay_thread = None
+        self.relay = None
+        if self.playback:
+            self.playback.stop()
+            self.playback = None
+        self.playback_checkbox.setEnabled(True)
         self.start_button.setEnabled(True)
         self.stop_button.setEnabled(False)
         self.status_label.setText("Disconnected")
 
-    def _accept_connections(self):
-        while True:
-            client_socket, address = self.server_socket.accept()
-            print(f"Student 1 connected: {address}")
-            self.client_connections.append(client_socket)
-            client_thread = threading.Thread(target=self._handle_client, args=(client_socket,))
-            self.client_threads.append(client_thread)
-            self.streams.append(self.audio_stream.open(format=FORMAT, channels=CHANNELS, rate=RATE, output=True, frames_per_buffer=CHUNK))
-            client_thread.start()
-
-    def _accept_text_connections(self):
-        while True:
-            text_socket, address = self.text_socket.accept()
-            print(f"Student 1 connected: {address}")
-            self.text_connections.append(text_socket)
-            text_thread = threading.Thread(target=self._handle_text_client, args=(text_socket,))
-            self.text_threads.append(text_thread)
-            text_thread.start()
+    def _run_relay(self):
+        try:
+            asyncio.run(self.relay.serve())
+        except OSError as e:
+            print(e)
 
-    def _handle_client(self, client_socket):
-        stream_index = self.client_connections.index(client_socket)
-        while True:
-            try:
-                data = client_socket.recv(CHUNK)
-                if not data:
-                    break
-                for index, conn in enumerate(self.client_connections):
-                    if index != stream_index:
-                        conn.sendall(data)
-                        self.streams[index].write(data)
-                self.streams[stream_index].write(data)
-            except Exception as e:
-                print(e)
-                break
-        client_socket.close()
-        self.client_connections.remove(client_socket)
-        self.client_threads.remove(threading.current_thread())
-        self.streams[stream_index].stop_stream()
-        self.streams[stream_index].close()
-        self.streams.pop(stream_index)
+    def closeEvent(self, event):
+        if self.is_running:
+            self.stop()
+        super().closeEvent(event)
 
-    def _handle_text_client(self, text_socket):
-        while True:
-            try:
-                data = text_socket.recv(1024)
-                if not data:
-                    break
-                for conn in self.text_connections:
-                    if conn != text_socket:
-                        conn.sendall(data)
-                self.chat_area.append("<b style='color: #409EFF;'>Student 1: </b>" + data.decode())
-            except Exception as e:
-                print(e)
-                break
-        text_socket.close()
-        self.text_connections.remove(text_socket)
-        self.text_threads.remove(threading.current_thread())
+    def add_received_text(self, room_id, sender, text):
+        self.feed.post({'sender': sender, 'room': room_id, 'text': text})
 
     def send_text(self):
         text = self.text_edit.toPlainText().strip()
-        if text:
-            encoded_text = text.encode()
-            for conn in self.text_connections:
-                conn.sendall(encoded_text)
-                self.chat_area.append("<b style='color: #67C23A;'>Student 2: </b>" + text)
+        if text and self.relay:
+            self.relay.send_text_threadsafe(text)
+            self.chat_area.follow = True
+            self.chat_model.append_messages([{'sender': 'You', 'text': text, 'outgoing': True}])
             self.text_edit.clear()
 
 if __name__ == "__main__":